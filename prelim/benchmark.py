@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# @File    :   benchmark.py
+# @Time    :   2026/10/18 14:48:16
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+在 sampled_{50,100,200}.json 和 test.json 上跑 ProgramExecutor 的基准测试
+
+每个 split 在一个新的进程中运行，记录 engine 加载时间、每个 program 的延迟分位数（p50/p95/p99）、
+吞吐量和峰值内存（RSS）。每个 program 执行 repeat 遍，延迟取各遍中的最小值，吞吐量取最快的一遍，
+减少单次计时的噪声。第一次运行把结果写成 baseline，之后的运行与 baseline 比较，
+变差超过 TOLERANCE 并且绝对差值超过 NOISE_FLOOR 时才报告为退化；--update 时用本次结果覆盖 baseline。
+找不到 KQA 的 KB 时退回到 basic_kopl.py 中的 example_kb，此时大部分 program 会报错或者返回空，
+只用来检查执行路径本身的开销。test.json 没有 program 标注，会被记为跳过。
+--kb / --data 可以换成 synthetic_kb.py 生成的 KB 和 program，测量不同规模下的吞吐量。
+'''
+import os
+import json
+import math
+import time
+import platform
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "kqa")
+SPLITS = {
+    "sampled_50": os.path.join(DATA_DIR, "sampled", "sampled_50.json"),
+    "sampled_100": os.path.join(DATA_DIR, "sampled", "sampled_100.json"),
+    "sampled_200": os.path.join(DATA_DIR, "sampled", "sampled_200.json"),
+    "test": os.path.join(DATA_DIR, "test.json"),
+}
+BASELINE_PATH = os.path.join(DATA_DIR, "benchmark_baseline.json")
+
+# 与 baseline 相比，延迟变大或吞吐量变小超过这个比例就报告为退化
+TOLERANCE = 0.2
+
+# 绝对差值不超过这些时视为噪声：微秒级的延迟、毫秒级的加载时间差 20% 只是计时抖动
+NOISE_FLOOR = {
+    "load_time": 0.01,       # 秒
+    "p50": 1e-5,             # 秒 / program
+    "p95": 1e-5,
+    "p99": 1e-5,
+    "per_program": 1e-5,     # 吞吐量换算成每个 program 的时间再比较
+    "peak_rss_mb": 5.0,
+}
+
+DEFAULT_REPEAT = 5
+
+
+def percentile(sorted_values, q):
+    """ nearest-rank 分位数，sorted_values 已经升序排列 """
+    if not sorted_values:
+        return None
+    rank = math.ceil(q / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def _peak_rss_mb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是字节
+    return rss / (1 << 20) if platform.system() == "Darwin" else rss / 1024
+
+
+def run_split(path, repeat=DEFAULT_REPEAT, kb_path=None):
+    """
+    在当前进程中加载 engine 并执行一个 split，应该在新进程中调用，峰值内存才只属于这个 split
+
+    Args:
+        kb_path (str): 使用指定的 KB（例如 synthetic_kb.py 生成的），快照放在同一目录下
+
+    Returns:
+        dict: 这个 split 的各项指标
+    """
+    start = time.perf_counter()
+    import convert_program_to_executable as c
+    if kb_path is not None:
+        # 不访问 c.engine，KQA 的 engine 不会被加载，加载时间和内存只属于这个 KB
+        from engine_snapshot import load_engine
+        engine = load_engine(kb_path, os.path.splitext(kb_path)[0] + ".snapshot")
+        kb = os.path.basename(kb_path)
+    else:
+        engine = c.engine
+        kb = "kqa"
+    if engine is None:
+        import basic_kopl
+        engine = basic_kopl.engine
+        kb = "example_kb"
+    load_time = time.perf_counter() - start
+
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    programs = [item for item in data if item.get("program")]
+    result = {
+        "kb": kb,
+        "kb_fingerprint": getattr(engine, "kb_fingerprint", None),
+        "samples": len(data),
+        "skipped": len(data) - len(programs),
+        "load_time": load_time,
+    }
+    if not programs:
+        result["peak_rss_mb"] = _peak_rss_mb()
+        return result
+
+    executor = c.ProgramExecutor(engine)
+    latencies = [math.inf] * len(programs)    # 每个 program 各遍中最小的延迟
+    best_wall = math.inf
+    errors = correct = 0
+    for r in range(max(repeat, 1)):
+        wall = time.perf_counter()
+        for i, item in enumerate(programs):
+            t = time.perf_counter()
+            try:
+                ans = executor.run(item["program"])
+            except Exception:
+                latencies[i] = min(latencies[i], time.perf_counter() - t)
+                errors += r == 0
+                continue
+            latencies[i] = min(latencies[i], time.perf_counter() - t)
+            if r == 0 and "answer" in item:
+                correct += c.compare_result(item["answer"], ans)
+        best_wall = min(best_wall, time.perf_counter() - wall)
+
+    latencies.sort()
+    result.update({
+        "programs": len(programs),
+        "repeat": repeat,
+        "errors": errors,
+        "correct": correct,
+        "mean": sum(latencies) / len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "throughput": len(programs) / best_wall,
+        "peak_rss_mb": _peak_rss_mb(),
+    })
+    return result
+
+
+def _worse(old, cur, tolerance, floor):
+    """ cur 比 old 大超过 tolerance 的比例，并且绝对差值超过噪声下限 """
+    return cur > old * (1 + tolerance) and cur - old > floor
+
+
+def compare(result, baseline, tolerance=TOLERANCE, noise_floor=NOISE_FLOOR):
+    """ Returns: list[str]，每个退化的指标一行 """
+    regressions = []
+    for split, cur in result["splits"].items():
+        old = baseline.get("splits", {}).get(split)
+        if old is None or old.get("kb") != cur.get("kb"):
+            continue
+        for metric in ("load_time", "p50", "p95", "p99", "peak_rss_mb"):
+            if cur.get(metric) and old.get(metric) and _worse(old[metric], cur[metric], tolerance, noise_floor[metric]):
+                regressions.append(f"{split} {metric}: {old[metric]:.6g} -> {cur[metric]:.6g}")
+        if cur.get("throughput") and old.get("throughput") and _worse(
+            1 / old["throughput"], 1 / cur["throughput"], tolerance, noise_floor["per_program"]
+        ):
+            regressions.append(f"{split} throughput: {old['throughput']:.6g} -> {cur['throughput']:.6g}")
+    return regressions
+
+
+def run_benchmark(splits=None, repeat=DEFAULT_REPEAT, baseline_path=BASELINE_PATH, update=False, kb_path=None):
+    """
+    Args:
+        splits (dict): split 名 -> 路径，默认是 SPLITS 中存在的文件
+        repeat (int): 每个 program 执行的遍数，延迟取最小值
+        kb_path (str): 不用 KQA 的 KB，而是用这个 KB 执行所有 split
+        baseline_path (str): baseline 文件
+        update (bool): 用本次结果覆盖 baseline
+
+    Returns:
+        tuple: (本次结果, 相对 baseline 的退化列表)
+    """
+    splits = splits or {name: path for name, path in SPLITS.items() if os.path.exists(path)}
+    result = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "splits": {},
+    }
+    ctx = mp.get_context("spawn")
+    for name, path in splits.items():
+        # 每个 split 一个新进程，加载时间和峰值内存互不影响
+        with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+            metrics = pool.submit(run_split, path, repeat, kb_path).result()
+        result["splits"][name] = metrics
+        print(name, json.dumps(metrics))
+
+    regressions = []
+    if os.path.exists(baseline_path) and not update:
+        with open(baseline_path, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f))
+        for line in regressions:
+            print("regression:", line)
+        if not regressions:
+            print(f"no regressions against {baseline_path}")
+    else:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"baseline written to {baseline_path}")
+    return result, regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--split", action="append", choices=list(SPLITS), help="默认跑所有存在的 split")
+    parser.add_argument("--data", action="append", default=[], help="额外的 program 文件，格式为 name=path")
+    parser.add_argument("--kb", default=None, help="例如 synthetic_kb.py 生成的 kb_{size}.json，配合 --data 使用")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update", action="store_true", help="用本次结果覆盖 baseline")
+    args = parser.parse_args()
+
+    splits = {name: SPLITS[name] for name in args.split or []}
+    splits.update(item.split("=", 1) for item in args.data)
+    run_benchmark(splits or None, args.repeat, args.baseline, args.update, args.kb)
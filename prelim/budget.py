@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# @File    :   budget.py
+# @Time    :   2026/10/18 20:24:17
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+ProgramExecutor 的资源预算：每个 program 的墙钟时间和中间结果大小
+
+从中心实体出发的 Relate 可能一下子展开几十万个实体，后面再接 SelectAmong / QueryName，
+一个这样的 program 就能拖住整个验证或者 agent 的一轮调用。
+设置 budget 之后，ProgramExecutor 在每一步执行完、下一步开始之前检查：
+    从 program 开始到现在的耗时是否超过 max_seconds
+    这一步的结果（实体集合、名字列表、三元组）是否超过 max_set_size
+超出时不再执行后面的步骤，run 返回 BudgetExceeded，记录是哪一步、哪个条件超出。
+引擎的单次调用无法中途打断，所以实际耗时可能超过 max_seconds 一个步骤；
+最后一步的结果已经算出来了，直接返回，不再检查。
+'''
+from collections import namedtuple
+from entity_sets import Bitmap
+
+# reason: "time" 或 "size"；step: 超出预算的步骤在 program 中的下标（run_batch 中是去重之后的步骤下标）；
+# value: 当时的耗时（秒）或集合大小；limit: 对应的上限
+BudgetExceeded = namedtuple("BudgetExceeded", ["reason", "step", "function", "inputs", "value", "limit"])
+
+
+def result_size(result):
+    """ 中间结果占用的规模：实体二元组取实体数，列表和位图取长度；惰性的全集（FindAll）不占空间，记为 0 """
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], list):
+        return len(result[0])
+    if isinstance(result, (list, Bitmap)):
+        return len(result)
+    return 0
+
+
+class Budget:
+    """
+    Args:
+        max_seconds (float): 每个 program 的墙钟时间上限（秒），None 表示不限制
+        max_set_size (int): 每个中间结果的大小上限，None 表示不限制
+    """
+
+    def __init__(self, max_seconds=None, max_set_size=None):
+        self.max_seconds = max_seconds
+        self.max_set_size = max_set_size
+        self.exceeded = 0
+
+    def check(self, step, result, elapsed):
+        """
+        Args:
+            step (PlanStep): 刚执行完的步骤
+            result: 这一步的结果
+            elapsed (float): program 到目前为止的耗时
+
+        Returns:
+            BudgetExceeded: 超出预算时返回，否则 None
+        """
+        if self.max_seconds is not None and elapsed > self.max_seconds:
+            self.exceeded += 1
+            return BudgetExceeded("time", step.index, step.function, step.inputs, elapsed, self.max_seconds)
+        if self.max_set_size is not None:
+            size = result_size(result)
+            if size > self.max_set_size:
+                self.exceeded += 1
+                return BudgetExceeded("size", step.index, step.function, step.inputs, size, self.max_set_size)
+        return None
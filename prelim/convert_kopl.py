@@ -10,9 +10,6 @@
 '''
 ######################### docstring ########################
 
-import os
-import json
-import pandas as pd
 from qdls.data import load_json, save_json
 
 def merge_sampled_data():
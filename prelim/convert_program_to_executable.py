@@ -7,40 +7,64 @@
 '''
 将 KQA 的 program 标注转为可执行的 python 代码
 '''
-from qdls.data import load_json
 import os 
-import pickle
+import json
+import csv
+import time
+import heapq
+import hashlib
+import marshal
+import sqlite3
+import importlib.util
+from collections import defaultdict, namedtuple, OrderedDict
 from loguru import logger
-from kopl.kopl import KoPLEngine, ValueClass
+from kopl.kopl import ValueClass
+from engine_snapshot import load_engine, KB_PATH
+from entity_sets import Bitmap, Universe, push_down, has_unit_tie
+from kb_index import LazyFacts
+from split_store import load_split
+from top_k import LIMITED_FUNCTIONS, query_names, select_among, select_between, truncate
+from kopl_string import parse_steps, parse_kopl
+from budget import Budget, BudgetExceeded
 
-def load_engine():
-    if os.path.exists("/home/qing/raid/paperwork/kgtool/data/kqa/engine.pkl"):
-        with open("/home/qing/raid/paperwork/kgtool/data/kqa/engine.pkl", "rb") as f:
-            engine = pickle.load(f)
-    else:   
-        engine = KoPLEngine(load_json("/home/qing/raid/paperwork/kgtool/data/kqa/kb_fixed.json"))
-        with open("/home/qing/raid/paperwork/kgtool/data/kqa/engine.pkl", "wb") as f:
-            pickle.dump(engine, f)   
-            print("engine saved")
-    return engine
+# KQA 的 engine 在第一次用到时才加载（c.engine、from convert_program_to_executable import engine 或 get_engine()），
+# 只用 ProgramExecutor 的脚本（例如 benchmark 指定 --kb 时）不为它付出加载时间和内存；
+# 没有 KQA 的 KB 时模块仍然可以导入，此时 engine 为 None
+_engine = None
+_engine_loaded = False
 
-# engine = load_engine()
-engine = KoPLEngine(load_json("/home/qing/raid/paperwork/kgtool/data/kqa/kb_fixed.json"))
 
-def convert_to_python(program):
+def get_engine():
+    global _engine, _engine_loaded
+    if not _engine_loaded:
+        _engine = load_engine() if os.path.exists(KB_PATH) else None
+        _engine_loaded = True
+    return _engine
+
+
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def convert_to_python(program, ssa=False):
     """
     Converts the program stack into the equivalent Python code.
 
     Args:
         program (list): A list of dictionaries representing the program.
+        ssa (bool): If True, emit one assignment per step (like `test2` in demo.py)
+            so that shared steps are computed once; the answer is bound to `ans`
+            and the code has to be run with `exec` instead of `eval`.
 
     Returns:
         str: The final Python code as a string.
     """
     def escape_string(s: str) -> str:
         """Escape special characters in string."""
-        # Replace single quotes with escaped single quotes
-        return s.replace("'", "\\'")
+        # 先转义反斜杠，再转义单引号和换行，否则带反斜杠的输入会生成非法代码
+        return s.replace("\\", "\\\\").replace("'", "\\'").replace("\n", "\\n").replace("\r", "\\r")
 
     # Map function names in the program to their corresponding Python function calls
     def find_function_mapping(func_name):
@@ -94,8 +118,10 @@ def convert_to_python(program):
         return function_map[func_name]
 
     results = []
+    lines = []
+    live = {step.index for step in compile_plan(program)} if ssa else None
 
-    for step in program:
+    for i, step in enumerate(program):
         func_name = step["function"]
         dependencies = step.get("dependencies", [])
         inputs = step.get("inputs", [])
@@ -106,12 +132,769 @@ def convert_to_python(program):
             result = func_mapper(dependencies, inputs)
         else:
             result = func_mapper(inputs)
+
+        if ssa:
+            # 每一步赋值给一个变量，后面的步骤只引用变量名
+            if i in live:
+                var = f"{SSA_VAR_PREFIX.get(func_name, 'result')}_{i}"
+                lines.append(f"{var} = {result}")
+                result = var
         results.append(result)
 
+    if ssa:
+        lines.append(f"ans = {results[-1]}")
+        return "\n".join(lines)
     # The last item in `results` is the complete Python code for the program
     return results[-1]
 
 
+# ssa 模式下变量名的前缀
+SSA_VAR_PREFIX = {
+    "FindAll": "entities",
+    "Find": "entities",
+    "FilterConcept": "filtered_entities",
+    "FilterStr": "filtered_entities",
+    "FilterNum": "filtered_entities",
+    "FilterYear": "filtered_entities",
+    "FilterDate": "filtered_entities",
+    "QFilterStr": "filtered_entities",
+    "QFilterNum": "filtered_entities",
+    "QFilterYear": "filtered_entities",
+    "QFilterDate": "filtered_entities",
+    "Relate": "related_entities",
+    "And": "intersection",
+    "Or": "union",
+    "Count": "count",
+}
+
+
+# program 中的函数名 -> KoPLEngine 的方法名，What 在引擎中对应 QueryName
+FUNCTION_TABLE = {
+    "FindAll": "FindAll",
+    "Find": "Find",
+    "FilterConcept": "FilterConcept",
+    "FilterStr": "FilterStr",
+    "FilterNum": "FilterNum",
+    "FilterYear": "FilterYear",
+    "FilterDate": "FilterDate",
+    "QFilterStr": "QFilterStr",
+    "QFilterNum": "QFilterNum",
+    "QFilterYear": "QFilterYear",
+    "QFilterDate": "QFilterDate",
+    "Relate": "Relate",
+    "And": "And",
+    "Or": "Or",
+    "Count": "Count",
+    "What": "QueryName",
+    "QueryName": "QueryName",
+    "QueryAttr": "QueryAttr",
+    "QueryAttrUnderCondition": "QueryAttrUnderCondition",
+    "SelectBetween": "SelectBetween",
+    "SelectAmong": "SelectAmong",
+    "VerifyStr": "VerifyStr",
+    "VerifyNum": "VerifyNum",
+    "VerifyYear": "VerifyYear",
+    "VerifyDate": "VerifyDate",
+    "QueryRelation": "QueryRelation",
+    "QueryAttrQualifier": "QueryAttrQualifier",
+    "QueryRelationQualifier": "QueryRelationQualifier",
+}
+
+
+PlanStep = namedtuple("PlanStep", ["index", "function", "dependencies", "inputs", "release"])
+
+
+def compile_plan(program):
+    """
+    将 program 编译成 SSA 形式的执行计划
+
+    只保留最后一步可达的步骤，每个步骤只执行一次；
+    release 记录在该步执行完之后就不再被用到的中间结果，执行时可以提前释放。
+
+    Returns:
+        list: PlanStep 列表，按执行顺序排列，最后一个是输出
+    """
+    return _build_plan([
+        (step["function"], tuple(step.get("dependencies", [])), tuple(step.get("inputs", [])))
+        for step in program
+    ])
+
+
+def compile_kopl(text):
+    """ 点号形式的 kopl 字符串直接编译成执行计划，见 kopl_string.parse_steps """
+    steps = parse_steps(text)
+    # 栈上每个结果最多被弹出一次；除最后一步外都被弹出过时，所有步骤都可达，
+    # 并且每一步执行完就可以释放它的依赖，不需要再做一遍活跃分析
+    if sum(len(deps) for _, deps, _ in steps) == len(steps) - 1:
+        return [PlanStep(i, function, deps, inputs, deps) for i, (function, deps, inputs) in enumerate(steps)]
+    return _build_plan(steps)
+
+
+def _build_plan(steps):
+    """ steps: [(function, dependencies, inputs)] """
+    n = len(steps)
+    live = [False] * n
+    live[n - 1] = True
+    # 倒序扫描时第一次遇到的使用者就是最后一次使用，该步执行完之后可以释放
+    release = [()] * n
+    used = [False] * n
+    for i in range(n - 1, -1, -1):
+        if live[i]:
+            freed = []
+            for d in steps[i][1]:
+                live[d] = True
+                if not used[d]:
+                    used[d] = True
+                    freed.append(d)
+            if freed:
+                release[i] = tuple(freed)
+
+    return [
+        PlanStep(i, function, deps, inputs, release[i])
+        for i, (function, deps, inputs) in enumerate(steps)
+        if live[i]
+    ]
+
+
+def count_engine_calls(program):
+    """
+    比较两种执行方式调用引擎的次数
+
+    Returns:
+        tuple: (嵌套表达式 eval 的调用次数, SSA 执行的调用次数)
+    """
+    calls = []
+    for step in program:
+        calls.append(1 + sum(calls[d] for d in step.get("dependencies", [])))
+    return calls[-1], len(compile_plan(program))
+
+
+def program_hash(program):
+    """ program 的规范化哈希，只看 function / dependencies / inputs，与字典键顺序和多余字段无关 """
+    canonical = [
+        [step["function"], list(step.get("dependencies", [])), list(step.get("inputs", []))]
+        for step in program
+    ]
+    text = json.dumps(canonical, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class ProgramCache:
+    """
+    program -> 编译结果 的缓存，避免重复翻译同一个 program
+
+    两种编译结果：
+        plan: compile_plan 的执行计划，给 ProgramExecutor 用
+        code: convert_to_python 生成并 compile 好的 code object，给 eval 用
+
+    内存中是一个 LRU，指定 path 时再加一层 sqlite 磁盘缓存，重启后仍然有效。
+    code object 用 marshal 序列化，所以磁盘上的 code 按 python 的 MAGIC_NUMBER 区分。
+    """
+
+    def __init__(self, maxsize=100000, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._conn = None
+        self._conn_pid = None
+
+    def _db(self):
+        # sqlite 连接不能跨 fork 使用，每个进程各自打开
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS compiled (key TEXT PRIMARY KEY, payload BLOB)"
+            )
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _get(self, key, build, dumps, loads):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        value = None
+        if self.path is not None:
+            row = self._db().execute("SELECT payload FROM compiled WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                value = loads(row[0])
+                self.disk_hits += 1
+        if value is None:
+            value = build()
+            self.misses += 1
+            if self.path is not None:
+                db = self._db()
+                db.execute("INSERT OR REPLACE INTO compiled VALUES (?, ?)", (key, dumps(value)))
+                db.commit()
+
+        self.memory[key] = value
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+        return value
+
+    def get_plan(self, program):
+        return self._get(
+            "plan:" + program_hash(program),
+            lambda: compile_plan(program),
+            lambda plan: json.dumps(plan, ensure_ascii=False).encode("utf-8"),
+            lambda payload: [PlanStep(*map(_as_tuple, step)) for step in json.loads(payload)],
+        )
+
+    def get_kopl_plan(self, text):
+        return self._get(
+            "kopl:" + text,
+            lambda: compile_kopl(text),
+            lambda plan: json.dumps(plan, ensure_ascii=False).encode("utf-8"),
+            lambda payload: [PlanStep(*map(_as_tuple, step)) for step in json.loads(payload)],
+        )
+
+    def get_code(self, program):
+        return self._get(
+            f"code:{importlib.util.MAGIC_NUMBER.hex()}:" + program_hash(program),
+            lambda: compile(convert_to_python(program), "<kopl>", "eval"),
+            marshal.dumps,
+            marshal.loads,
+        )
+
+    def stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / total if total else 0.0,
+            "size": len(self.memory),
+        }
+
+
+def _as_tuple(x):
+    return tuple(x) if isinstance(x, list) else x
+
+
+# 结果只取决于输入实体列表和 inputs 的算子才能跨问题缓存，
+# QFilter* 还依赖输入的三元组，Verify* 的输入是属性值列表，它们都很便宜，不缓存
+CACHEABLE_FUNCTIONS = {
+    "FindAll", "Find", "FilterConcept", "FilterStr", "FilterNum", "FilterYear", "FilterDate",
+    "Relate", "And", "Or", "Count", "What", "QueryName", "QueryAttr", "QueryAttrUnderCondition",
+    "SelectBetween", "SelectAmong", "QueryRelation", "QueryAttrQualifier", "QueryRelationQualifier",
+}
+
+
+def _result_size(result):
+    if isinstance(result, tuple):
+        return len(result[0]) + 1
+    if isinstance(result, list):
+        return len(result) + 1
+    return 1
+
+
+class OperatorCache:
+    """
+    跨问题的算子结果缓存，key 是 (算子, inputs, 输入实体列表, KB 指纹)
+
+    容量按缓存结果中实体/元素的总数计算，超出 max_size 时按 LRU 淘汰；
+    KB 指纹在每个 key 里，不同 KB 上的 executor 可以共享一个缓存，各自只会命中自己 KB 的结果，
+    换了 KB 之后旧的条目不再被访问，随 LRU 淘汰。
+    缓存的结果会被多个问题共享，调用方不要原地修改。
+    """
+
+    def __init__(self, max_size=10_000_000):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses[key[0]] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits[key[0]] += 1
+        return entry
+
+    def put(self, key, result):
+        size = _result_size(result)
+        if size > self.max_size:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (result, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def stats(self):
+        """ 每个算子的命中次数、未命中次数和命中率 """
+        report = {}
+        for func in sorted(set(self.hits) | set(self.misses)):
+            hit, miss = self.hits[func], self.misses[func]
+            report[func] = {"hits": hit, "misses": miss, "hit_rate": hit / (hit + miss)}
+        return report
+
+
+def _entities_key(result):
+    """
+    实体二元组作为缓存 key 的一部分，其他类型的结果返回 None
+
+    只用 hash(ids) 时长度和 hash 都相同的两个集合会碰撞，缓存就会静默地返回另一个集合的结果，
+    这里改用实体列表内容的 blake2b 摘要（实体 id 中不会出现 NUL 字符，可以用它分隔）
+    """
+    if isinstance(result, Universe):
+        return ("FindAll",)
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], list):
+        ids = result[0]
+        digest = hashlib.blake2b("\0".join(ids).encode("utf-8"), digest_size=16).digest()
+        return (len(ids), digest)
+    return None
+
+
+def _cardinality(result):
+    """ 实体二元组取实体数，列表和位图取长度，标量返回 None """
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], list):
+        return len(result[0])
+    if isinstance(result, (list, Bitmap, Universe)):
+        return len(result)
+    return None
+
+
+# 每个算子的统计量，名字里带 max 的字段汇总时取最大值，其余求和
+PROFILE_FIELDS = ["calls", "time", "max_time", "in_total", "in_max", "out_total", "out_max"]
+
+
+class OperatorProfiler:
+    """
+    按算子统计调用次数、耗时和输入/输出集合的大小，并记录最慢的 top_k 个 program
+
+    耗时包含 OperatorCache 和 KBIndex 的查找，命中缓存的调用也会计数。
+    run_batch 中的步骤是多个 program 共享的，只计入算子统计，不计入 program 耗时。
+    """
+
+    def __init__(self, top_k=20, path=None):
+        """
+        Args:
+            top_k (int): 保留最慢的 program 个数
+            path (str): 报告的输出路径，validate_all_program 结束时写出 JSON，同名的 .csv 是算子表
+        """
+        self.top_k = top_k
+        self.path = path
+        self.reset()
+
+    def reset(self):
+        self.operators = {}
+        self.slowest = []   # 小顶堆 (time, seq, label, program)
+        self.programs = 0
+        self.program_time = 0.0
+
+    def record(self, function, args, result, elapsed):
+        stat = self.operators.get(function)
+        if stat is None:
+            stat = self.operators[function] = [0] * len(PROFILE_FIELDS)
+        n_in = sum(_cardinality(a) or 0 for a in args)
+        n_out = _cardinality(result) or 0
+        stat[0] += 1
+        stat[1] += elapsed
+        stat[2] = max(stat[2], elapsed)
+        stat[3] += n_in
+        stat[4] = max(stat[4], n_in)
+        stat[5] += n_out
+        stat[6] = max(stat[6], n_out)
+
+    def record_program(self, label, program, elapsed):
+        self.programs += 1
+        self.program_time += elapsed
+        item = (elapsed, self.programs, label, program)
+        if len(self.slowest) < self.top_k:
+            heapq.heappush(self.slowest, item)
+        elif elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def state(self):
+        """ 可以 pickle 的原始统计，用于把子进程的结果汇总到父进程 """
+        return self.operators, self.slowest, self.programs, self.program_time
+
+    def merge(self, state):
+        operators, slowest, programs, program_time = state
+        for function, other in operators.items():
+            stat = self.operators.setdefault(function, [0] * len(PROFILE_FIELDS))
+            for i, field in enumerate(PROFILE_FIELDS):
+                stat[i] = max(stat[i], other[i]) if "max" in field else stat[i] + other[i]
+        for elapsed, _, label, program in slowest:
+            self.record_program(label, program, elapsed)
+        # 上面的 record_program 已经把 slowest 中的计过一次
+        self.programs += programs - len(slowest)
+        self.program_time += program_time - sum(item[0] for item in slowest)
+
+    def report(self):
+        operators = {}
+        total = sum(stat[1] for stat in self.operators.values()) or 1.0
+        for function, stat in sorted(self.operators.items(), key=lambda kv: -kv[1][1]):
+            calls, spent, max_time, in_total, in_max, out_total, out_max = stat
+            operators[function] = {
+                "calls": calls,
+                "time": spent,
+                "time_share": spent / total,
+                "mean_time": spent / calls,
+                "max_time": max_time,
+                "mean_in": in_total / calls,
+                "max_in": in_max,
+                "mean_out": out_total / calls,
+                "max_out": out_max,
+            }
+        return {
+            "programs": self.programs,
+            "program_time": self.program_time,
+            "operators": operators,
+            "slowest_programs": [
+                {"label": label, "time": elapsed, "program": program}
+                for elapsed, _, label, program in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+    def save(self, path=None):
+        """ 写出 JSON 报告，以及同名 .csv 的算子表 """
+        path = path or self.path
+        report = self.report()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        csv_path = os.path.splitext(path)[0] + ".csv"
+        columns = ["calls", "time", "time_share", "mean_time", "max_time", "mean_in", "max_in", "mean_out", "max_out"]
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["function"] + columns)
+            for function, row in report["operators"].items():
+                writer.writerow([function] + [row[c] for c in columns])
+        logger.info(f"profile written to {path} and {csv_path}")
+        return report
+
+
+class ProgramExecutor:
+    """
+    直接解释执行 program 列表，不生成 python 代码也不 eval
+
+    按 compile_plan 得到的 SSA 计划执行，根据 dependencies 取出前面步骤的结果，
+    连同 inputs 一起传给预先绑定好的 KoPLEngine 方法；被多个步骤依赖的步骤只执行一次。
+    """
+
+    def __init__(self, engine, program_cache=None, op_cache=None, index=None, optimizer=None, profiler=None, bitmaps=None, lazy_universe=True, name_index=None, budget=None):
+        """
+        Args:
+            engine (KoPLEngine): 执行用的引擎
+            program_cache (ProgramCache): 复用 program 的执行计划
+            op_cache (OperatorCache): 跨问题复用算子结果
+            index (KBIndex): 能用索引回答的步骤不再调用引擎
+            optimizer (ProgramOptimizer): 执行前按选择度重排过滤链
+            profiler (OperatorProfiler): 统计每个算子和每个 program 的耗时
+            bitmaps (EntityBitmaps): 中间的实体集合用位图表示，And / Or / Count 等直接做位运算
+            lazy_universe (bool): FindAll 返回惰性的 Universe，由下一个算子下推处理，
+                只有需要完整列表时才展开
+            name_index (NameIndex): Find 的名字不存在时退回到模糊匹配，取最相似的名字
+            budget (Budget): 每个 program 的耗时和中间结果大小上限，超出时 run 返回 BudgetExceeded
+        """
+        self.engine = engine
+        self.program_cache = program_cache
+        self.op_cache = op_cache
+        self.index = index
+        self.optimizer = optimizer
+        self.profiler = profiler
+        self.bitmaps = bitmaps
+        self.universe = Universe(engine.kb) if lazy_universe else None
+        self.name_index = name_index
+        self.budget = budget
+        # OperatorCache 的 key 带上 KB 指纹；没有指纹时退化为只在同一个 engine 对象内共享
+        self.kb_key = getattr(engine, "kb_fingerprint", None) or ("engine", id(engine))
+        self.dispatch = {
+            func_name: getattr(engine, method_name)
+            for func_name, method_name in FUNCTION_TABLE.items()
+        }
+        if name_index is not None:
+            self.dispatch["Find"] = name_index.find
+
+    def run(self, program, label=None, limit=None):
+        """
+        Args:
+            program (list): A list of dictionaries representing the program.
+            label: 开启 profiler 时用来标识 program（例如样本下标）
+            limit (int): 只需要前 limit 个答案，SelectAmong / SelectBetween / QueryName 等最后一步提前结束，
+                返回列表的结果截断到 limit 个
+
+        Returns:
+            The result of the last step, same as `eval(convert_to_python(program))`;
+            设置了 budget 并且超出时返回 BudgetExceeded
+        """
+        if self.profiler is not None:
+            start = time.perf_counter()
+            result = self._run(program, limit)
+            self.profiler.record_program(label, program, time.perf_counter() - start)
+            return result
+        return self._run(program, limit)
+
+    def run_kopl(self, text, label=None, limit=None):
+        """
+        直接执行点号形式的 kopl 字符串，例如 Find(LeBron James).QueryAttr(height)，写法见 kopl_string；
+        不经过 convert_to_python / eval，结果与 run(parse_kopl(text)) 相同
+
+        Raises:
+            ValueError: 字符串无法解析
+        """
+        if self.optimizer is not None:
+            # optimizer 作用在 program 上，先还原成 program
+            return self.run(parse_kopl(text), label, limit)
+        start = time.perf_counter() if self.profiler is not None else None
+        if self.program_cache is not None:
+            plan = self.program_cache.get_kopl_plan(text)
+        else:
+            plan = compile_kopl(text)
+        result = self.run_plan(plan, limit)
+        if start is not None:
+            self.profiler.record_program(label, text, time.perf_counter() - start)
+        return result
+
+    def _run(self, program, limit=None):
+        if self.optimizer is not None:
+            program = self.optimizer.optimize(program)
+        if self.program_cache is not None:
+            return self.run_plan(self.program_cache.get_plan(program), limit)
+        return self.run_plan(compile_plan(program), limit)
+
+    def run_plan(self, plan, limit=None):
+        functions = {step.index: step.function for step in plan}
+        results = {}
+        last = plan[-1].index
+        budget = self.budget
+        if budget is not None:
+            start = time.perf_counter()
+        for step in plan:
+            args = [results[i] for i in step.dependencies]
+            results[step.index] = res = self._call(step, args, functions, limit if step.index == last else None)
+            if budget is not None and step.index != last:
+                exceeded = budget.check(step, res, time.perf_counter() - start)
+                if exceeded is not None:
+                    return exceeded
+            for i in step.release:
+                del results[i]
+        return truncate(self._output(results[last]), limit)
+
+    def _output(self, result):
+        # 惰性的全集和位图在输出前转换回引擎的 (entity_ids, None)，
+        # 索引 Relate 的惰性三元组转换成 list，与引擎的结果类型一致，pickle 时也不会带上整个 kb.entities
+        if isinstance(result, Universe):
+            return result.entities()
+        if self.bitmaps is not None:
+            result = self.bitmaps.to_entities(result)
+        if isinstance(result, tuple) and len(result) == 2 and isinstance(result[1], LazyFacts):
+            return (result[0], list(result[1]))
+        return result
+
+    def run_batch(self, programs, limits=None):
+        """
+        批量执行多个 program，不同 program 中相同的子 DAG 只执行一次
+
+        每个步骤规范化为 (function, inputs, 依赖步骤的规范 id)，在整批 program 中去重，
+        唯一步骤按拓扑序执行，结果再分发回各个 program；中间结果按剩余引用计数提前释放。
+        返回的结果对象可能被多个 program 共享。
+
+        Args:
+            programs (list): program 列表
+            limits (list): 每个 program 的 limit（见 run），None 表示不限制；
+                多个 program 共享同一个输出步骤时按其中最大的 limit 执行
+
+        设置了 budget 时，每个被其他步骤依赖的唯一步骤执行完之后检查：耗时按依赖链累加
+        （这一步加上它所有依赖步骤各自的耗时，不扣除与其他 program 共享的部分），
+        超出时依赖它的步骤都不再执行，用到它们的 program 的结果是 BudgetExceeded，其他 program 不受影响。
+
+        Returns:
+            tuple: (每个 program 的结果列表, 统计信息 dict)
+
+        Raises:
+            ValueError: limits 与 programs 的长度不同
+        """
+        if limits is None:
+            limits = [None] * len(programs)
+        elif len(limits) != len(programs):
+            raise ValueError(f"got {len(limits)} limits for {len(programs)} programs")
+        canonical = {}
+        nodes = []         # 唯一步骤，PlanStep 的 index 就是它在 nodes 中的下标
+        outputs = []       # 每个 program 输出对应的唯一步骤
+        per_program = 0    # 逐个用 run 执行时的引擎调用次数
+        nested = 0         # 逐个 eval 嵌套表达式时的引擎调用次数
+        for program in programs:
+            if self.optimizer is not None:
+                program = self.optimizer.optimize(program)
+            plan = self.program_cache.get_plan(program) if self.program_cache is not None else compile_plan(program)
+            per_program += len(plan)
+            nested += count_engine_calls(program)[0]
+            local = {}
+            for step in plan:
+                deps = tuple(local[i] for i in step.dependencies)
+                key = (step.function, step.inputs, deps)
+                node = canonical.get(key)
+                if node is None:
+                    node = canonical[key] = len(nodes)
+                    nodes.append(PlanStep(node, step.function, deps, step.inputs, ()))
+                local[step.index] = node
+            outputs.append(local[plan[-1].index])
+
+        # 剩余引用数：被后续步骤依赖的次数，program 的输出要一直保留
+        refs = [0] * len(nodes)
+        for node in nodes:
+            for d in node.dependencies:
+                refs[d] += 1
+        keep = set(outputs)
+
+        # 只被带 limit 的 program 当作输出、不被其他步骤依赖的步骤才能提前结束
+        node_limit = {}
+        for i, limit in zip(outputs, limits):
+            if refs[i] > 0 or limit is None or node_limit.get(i, 0) is None:
+                node_limit[i] = None
+            else:
+                node_limit[i] = max(node_limit.get(i, 0), limit)
+
+        functions = {node.index: node.function for node in nodes}
+        results = {}
+        budget = self.budget
+        consumers = list(refs)
+        cost = [0.0] * len(nodes)
+        blocked = {}       # 唯一步骤 -> BudgetExceeded，依赖它的步骤不再执行
+        for node in nodes:
+            exceeded = next((blocked[i] for i in node.dependencies if i in blocked), None)
+            if exceeded is not None:
+                results[node.index] = blocked[node.index] = exceeded
+            else:
+                args = [results[i] for i in node.dependencies]
+                if budget is not None:
+                    start = time.perf_counter()
+                results[node.index] = res = self._call(node, args, functions, node_limit.get(node.index))
+                if budget is not None and consumers[node.index]:
+                    cost[node.index] = time.perf_counter() - start + sum(cost[i] for i in node.dependencies)
+                    exceeded = budget.check(node, res, cost[node.index])
+                    if exceeded is not None:
+                        blocked[node.index] = exceeded
+            for i in node.dependencies:
+                refs[i] -= 1
+                if refs[i] == 0 and i not in keep:
+                    del results[i]
+
+        report = {
+            "programs": len(programs),
+            "engine_calls": len(nodes),
+            "sequential_calls": per_program,
+            "nested_calls": nested,
+            "saved_calls": per_program - len(nodes),
+        }
+        if budget is not None:
+            report["budget_exceeded"] = sum(isinstance(results[i], BudgetExceeded) for i in outputs)
+        return [
+            results[i] if isinstance(results[i], BudgetExceeded) else truncate(self._output(results[i]), limit)
+            for i, limit in zip(outputs, limits)
+        ], report
+
+    def _call(self, step, args, functions, limit=None):
+        if self.profiler is None:
+            return self._lookup(step, args, functions, limit)
+        start = time.perf_counter()
+        res = self._lookup(step, args, functions, limit)
+        self.profiler.record(step.function, args, res, time.perf_counter() - start)
+        return res
+
+    def _lookup(self, step, args, functions, limit=None):
+        op_cache = self.op_cache
+        if op_cache is None:
+            return self._execute(step, args, functions, limit)
+
+        key = None
+        # 模糊的 Find 与引擎的 Find 结果不同，不能共用缓存
+        if step.function in CACHEABLE_FUNCTIONS and not (step.function == "Find" and self.name_index is not None):
+            arg_keys = tuple(_entities_key(a) for a in args)
+            if None not in arg_keys:
+                key = (FUNCTION_TABLE[step.function], step.inputs, arg_keys, self.kb_key)
+        entry = op_cache.get(key) if key is not None else None
+        if entry is not None:
+            return entry[0]
+        res = self._execute(step, args, functions, limit)
+        # 提前结束的结果不完整，不放进缓存
+        if key is not None and (limit is None or step.function not in LIMITED_FUNCTIONS):
+            op_cache.put(key, res)
+        return res
+
+    def _execute(self, step, args, functions, limit=None):
+        if limit is not None and step.function in LIMITED_FUNCTIONS:
+            res = self._execute_limited(step, args, functions, limit)
+            if res is not None:
+                return res
+        if self.bitmaps is not None:
+            res = self.bitmaps.execute(step.function, args, step.inputs)
+            if res is not None:
+                return res
+            args = [self.bitmaps.to_entities(a) for a in args]
+        if self.universe is not None:
+            if step.function == "FindAll":
+                return self.universe
+            if any(isinstance(a, Universe) for a in args):
+                res = self._push_universe(step, args, functions)
+                if res is not None:
+                    return res
+                args = [a.entities() if isinstance(a, Universe) else a for a in args]
+        if self.index is not None:
+            res = self.index.execute(
+                step.function, args, step.inputs, [functions[i] for i in step.dependencies]
+            )
+            if res is not None:
+                return res
+        return self.dispatch[step.function](*args, *step.inputs)
+
+    def _entity_ids(self, x, key=None):
+        """ 实体集合的实体列表，Bitmap 按位展开，全集只取有属性 key 的实体 """
+        if isinstance(x, Bitmap):
+            return self.bitmaps.to_entities(x)[0]
+        if isinstance(x, Universe):
+            return self.engine.kb.attribute_inv_index.get(key, {}) if key is not None else x.kb.entities
+        return x[0]
+
+    def _execute_limited(self, step, args, functions, limit):
+        kb = self.engine.kb
+        function, inputs = step.function, step.inputs
+        if function in ("QueryName", "What"):
+            if isinstance(args[0], Bitmap):
+                return query_names(kb, self.bitmaps.to_ids(args[0], limit), limit)
+            return query_names(kb, self._entity_ids(args[0]), limit)
+        key = inputs[0]
+        if function == "SelectAmong":
+            # 输入是整个 KB 时 KBIndex 用排好序的属性值直接取最值，比扫描更快
+            if self.index is not None and functions[step.dependencies[0]] == "FindAll":
+                return None
+            entity_ids = set(self._entity_ids(args[0], key))
+            # 全集只遍历有该属性的实体，顺序与引擎不同，单位并列时交给引擎
+            if isinstance(args[0], Universe) and has_unit_tie(kb, entity_ids, key):
+                return None
+            return select_among(kb, entity_ids, *inputs, limit)
+        return select_between(kb, self._entity_ids(args[0], key), self._entity_ids(args[1], key), *inputs)
+
+    def _push_universe(self, step, args, functions):
+        # 索引处理 FindAll 输入时不读取实体列表，优先用索引，其次在引擎上下推
+        if self.index is not None and step.function in UNIVERSE_INDEXED:
+            res = self.index.execute(
+                step.function, args, step.inputs, [functions[i] for i in step.dependencies]
+            )
+            if res is not None:
+                return res
+        return push_down(self.engine, step.function, args, step.inputs)
+
+
+# KBIndex.execute 在输入是 FindAll 时不读取实体列表的算子
+UNIVERSE_INDEXED = {"FilterConcept", "FilterStr", "FilterNum", "FilterYear", "FilterDate", "SelectAmong"}
+
+
 def test():
     program = [
         {"function": "FindAll", "dependencies": [], "inputs": []},
@@ -123,11 +906,33 @@ def test():
         {"function": "Or", "dependencies": [2, 5], "inputs": []},
         {"function": "Count", "dependencies": [6], "inputs": []}
     ]
+    engine = get_engine()
 
     # Convert the program to Python code
     python_code = convert_to_python(program)
     print(python_code)
     print(eval(python_code))
+    print(ProgramExecutor(engine).run(program))
+
+    python_code = convert_to_python(program, ssa=True)
+    print(python_code)
+    namespace = {"engine": engine}
+    exec(python_code, namespace)
+    print(namespace["ans"])
+    print("engine calls (nested, ssa):", count_engine_calls(program))
+
+    related = [
+        {"function": "Find", "dependencies": [], "inputs": ["Charles Mingus Jr."]},
+        {"function": "Relate", "dependencies": [0], "inputs": ["famous people", "backward"]},
+        {"function": "Count", "dependencies": [1], "inputs": []},
+    ]
+    results, report = ProgramExecutor(engine).run_batch([program, program[:3], related])
+    print(results, report)
+
+    # 中间结果超过 1 个实体时停止：Or 的结果有 2 个实体，Count 不再执行
+    governed = ProgramExecutor(engine, budget=Budget(max_seconds=1.0, max_set_size=1))
+    print(governed.run_kopl("Find(LeBron James).Find(LeBron James Jr.).Or().Count()"))
+    print(governed.run_batch([program, parse_kopl("Find(LeBron James).Find(LeBron James Jr.).Or().Count()")]))
 
 
 def compare_result(ans, exec_result):
@@ -184,27 +989,225 @@ def compare_result(ans, exec_result):
         return False
 
 
-def validate_all_program(file):
+# 执行器的语义版本，改变执行结果的修改（而不是纯粹的优化）需要加一，让 ResultStore 中的旧结论失效
+EXECUTOR_VERSION = 1
+
+
+def engine_version():
+    from importlib.metadata import version
+    return f"kopl-{version('kopl')}+executor-{EXECUTOR_VERSION}"
+
+
+class ResultStore:
+    """
+    持久化的验证结论，key 是 (program 哈希, answer, KB 指纹, 引擎版本)
+
+    validate_all_program 重跑时只执行新增或受影响的样本（program / answer 改了，KB 或引擎变了），
+    其余的直接复用之前的结论，统计出来的准确率与完整重跑一致。
+    """
+
+    def __init__(self, path="/home/qing/raid/paperwork/kgtool/data/kqa/validate_results.sqlite"):
+        self.path = path
+        self.reused = 0
+        self.executed = 0
+        self._conn = None
+        self._conn_pid = None
+
+    def _db(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                "program TEXT, answer TEXT, kb TEXT, engine TEXT, ok INTEGER, "
+                "PRIMARY KEY (program, answer, kb, engine))"
+            )
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def load(self, kb, engine):
+        """ Returns: {(program 哈希, answer): 是否正确}，只包含这个 KB 和引擎版本下的结论 """
+        rows = self._db().execute(
+            "SELECT program, answer, ok FROM verdicts WHERE kb = ? AND engine = ?", (kb, engine)
+        )
+        return {(program, answer): bool(ok) for program, answer, ok in rows}
+
+    def save(self, kb, engine, verdicts):
+        """ verdicts: [((program 哈希, answer), 是否正确)] """
+        db = self._db()
+        db.executemany(
+            "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)",
+            [(program, answer, kb, engine, int(ok)) for (program, answer), ok in verdicts],
+        )
+        db.commit()
+
+    def stats(self):
+        return {"reused": self.reused, "executed": self.executed}
+
+
+def _check_item(executor, item, use_eval, label=None):
+    program = item["program"]
+    ans = item["answer"]
+    if use_eval:
+        if executor.program_cache is not None:
+            python_code = executor.program_cache.get_code(program)
+        else:
+            python_code = convert_to_python(program)
+        exec_result = eval(python_code, {"engine": executor.engine})
+    else:
+        exec_result = executor.run(program, label)
+        if isinstance(exec_result, BudgetExceeded):
+            return None
+    return compare_result(ans, exec_result)
+
+
+# 多进程验证时由父进程在 fork 之前设置，子进程通过写时复制共享 engine 和数据，不需要 pickle
+_fork_data = None
+_fork_executor = None
+
+
+def _init_fork_worker(program_cache, op_cache, index, optimizer, profiler, bitmaps, budget):
+    global _fork_executor
+    # fork 出来的副本带着父进程已有的统计，清零之后只把子进程自己的计数交回去汇总
+    if profiler is not None:
+        profiler.reset()
+    if budget is not None:
+        budget.exceeded = 0
+    _fork_executor = ProgramExecutor(get_engine(), program_cache, op_cache, index, optimizer, profiler, bitmaps, budget=budget)
+
+
+def _check_batch(executor, items):
+    """ 整批用 run_batch 执行，返回每个样本是否正确（超出预算为 None）以及统计信息 """
+    results, report = executor.run_batch([item["program"] for item in items])
+    return [
+        None if isinstance(r, BudgetExceeded) else compare_result(item["answer"], r)
+        for item, r in zip(items, results)
+    ], report
+
+
+def _check_chunk(args):
+    """ Returns: (每个样本是否正确, 这个 chunk 的 profiler 统计或 None, 这个 chunk 超出预算的次数) """
+    indices, use_eval, batch = args
+    if batch:
+        flags = _check_batch(_fork_executor, [_fork_data[i] for i in indices])[0]
+    else:
+        flags = [_check_item(_fork_executor, _fork_data[i], use_eval, i) for i in indices]
+    exceeded = 0
+    budget = _fork_executor.budget
+    if budget is not None:
+        exceeded, budget.exceeded = budget.exceeded, 0
+    profiler = _fork_executor.profiler
+    if profiler is None:
+        return flags, None, exceeded
+    state = profiler.state()
+    profiler.reset()
+    return flags, state, exceeded
+
+
+def validate_all_program(file, use_eval=False, num_workers=1, chunk_size=256, program_cache=None, op_cache=None, index=None, optimizer=None, batch=False, profiler=None, bitmaps=None, result_store=None, budget=None):
+    """ 
+    use_eval=True 时走原来的 convert_to_python + eval，否则直接用 ProgramExecutor 解释执行
+
+    batch=True 时每 chunk_size 个样本作为一批，用 ProgramExecutor.run_batch 共享相同的步骤
+
+    profiler 不为空时统计每个算子的耗时和集合大小，program 以样本下标标识，
+    各个子进程的统计汇总到 profiler 中；profiler.path 不为空时结束后写出报告
+
+    program_cache / op_cache / index / optimizer / bitmaps 原样传给 ProgramExecutor
+
+    num_workers > 1 时用 fork 出来的多个进程并行验证，子进程直接继承已经加载好的 engine，
+    结果按样本顺序汇总，与单进程的结果完全一致
+
+    result_store 不为空时复用 (program, answer, KB 指纹, 引擎版本) 都没变的样本的结论，只执行其余的样本
+
+    budget 不为空时（只对 ProgramExecutor 有效）超出预算的样本记为错误，不写入 result_store，下次重新执行
+
+    Returns:
+        tuple: (正确的数量, 错误样本的下标列表)
+    """
+    global _fork_data
     from tqdm import tqdm
-    data = load_json(file)
+    # 列式存储，只解码 program 和 answer 两列
+    data = load_split(file, ["program", "answer"])
     n = len(data)
-    cnt = 0 
-    for item in tqdm(data):
-        program = item["program"]
-        ans = item["answer"]
-        python_code = convert_to_python(program)
-
-        exec_result = eval(python_code)
-        if compare_result(ans, exec_result):
-            cnt += 1
+    flags = [None] * n
+
+    engine = get_engine()
+    kb = getattr(engine, "kb_fingerprint", None)
+    if result_store is not None and kb is None:
+        logger.warning("engine has no KB fingerprint, result store disabled")
+        result_store = None
+    if result_store is not None:
+        version = engine_version()
+        keys = [
+            (program_hash(program), json.dumps(answer, ensure_ascii=False))
+            for program, answer in zip(data.column("program"), data.column("answer"))
+        ]
+        known = result_store.load(kb, version)
+        for i, key in enumerate(keys):
+            flags[i] = known.get(key)
+    todo = [i for i in range(n) if flags[i] is None]
+
+    if num_workers > 1 and todo:
+        import multiprocessing as mp
+        _fork_data = data
+        chunks = [(todo[i:i + chunk_size], use_eval, batch) for i in range(0, len(todo), chunk_size)]
+        try:
+            with mp.get_context("fork").Pool(
+                num_workers, initializer=_init_fork_worker, initargs=(program_cache, op_cache, index, optimizer, profiler, bitmaps, budget)
+            ) as pool:
+                done = []
+                with tqdm(total=len(todo)) as pbar:
+                    for chunk_flags, state, exceeded in pool.imap(_check_chunk, chunks):
+                        if state is not None:
+                            profiler.merge(state)
+                        if budget is not None:
+                            budget.exceeded += exceeded
+                        done.extend(chunk_flags)
+                        pbar.update(len(chunk_flags))
+        finally:
+            _fork_data = None
+    else:
+        executor = ProgramExecutor(engine, program_cache, op_cache, index, optimizer, profiler, bitmaps, budget=budget)
+        if batch:
+            done, saved, total = [], 0, 0
+            for i in tqdm(range(0, len(todo), chunk_size)):
+                chunk_flags, report = _check_batch(executor, [data[j] for j in todo[i:i + chunk_size]])
+                done.extend(chunk_flags)
+                saved += report["saved_calls"]
+                total += report["sequential_calls"]
+            logger.info(f"batch execution saved {saved}/{total} engine calls")
         else:
-            print()
-            # print(item)
+            done = [_check_item(executor, data[i], use_eval, i) for i in tqdm(todo)]
+        if program_cache is not None:
+            logger.info(f"program cache: {program_cache.stats()}")
+        if op_cache is not None:
+            logger.info(f"operator cache: {op_cache.stats()}")
+
+    for i, ok in zip(todo, done if todo else []):
+        flags[i] = ok
+    if result_store is not None:
+        result_store.reused += n - len(todo)
+        result_store.executed += len(todo)
+        result_store.save(kb, version, [(keys[i], flags[i]) for i in todo if flags[i] is not None])
+        logger.info(f"result store: reused {n - len(todo)}, executed {len(todo)}")
+
+    if profiler is not None and profiler.path is not None:
+        profiler.save()
 
+    if budget is not None:
+        logger.info(f"budget exceeded: {sum(ok is None for ok in flags)} programs")
+    mismatches = [i for i, ok in enumerate(flags) if not ok]
+    cnt = n - len(mismatches)
     print(f"validate {cnt}/{n} programs, accuracy: {cnt/n}")
+    return cnt, mismatches
 
 if __name__ == "__main__":
-    validate_all_program("/home/qing/raid/paperwork/kgtool/data/kqa/split/val_3k.json")   # validate 2988/3000 programs, accuracy: 0.996
-    validate_all_program("/home/qing/raid/paperwork/kgtool/data/kqa/split/test_8k.json")  # validate 8773/8797 programs, accuracy: 0.9972717972035922
-    validate_all_program("/home/qing/raid/paperwork/kgtool/data/kqa/full/train.json")     # validate 94029/94376 programs, accuracy: 0.996323217767229
+    num_workers = os.cpu_count()
+    # 第二次运行起只重新执行 program / answer / KB / 引擎有变化的样本
+    result_store = ResultStore()
+    # 个别 program 卡住时不拖住整个验证，超出的样本记为错误、下次重新执行
+    budget = Budget(max_seconds=30)
+    validate_all_program("/home/qing/raid/paperwork/kgtool/data/kqa/split/val_3k.json", num_workers=num_workers, result_store=result_store, budget=budget)   # validate 2988/3000 programs, accuracy: 0.996
+    validate_all_program("/home/qing/raid/paperwork/kgtool/data/kqa/split/test_8k.json", num_workers=num_workers, result_store=result_store, budget=budget)  # validate 8773/8797 programs, accuracy: 0.9972717972035922
+    validate_all_program("/home/qing/raid/paperwork/kgtool/data/kqa/full/train.json", num_workers=num_workers, result_store=result_store, budget=budget)     # validate 94029/94376 programs, accuracy: 0.996323217767229
 
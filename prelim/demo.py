@@ -7,27 +7,14 @@
 '''
 LLM 调用 KoPL 的 API 进行推理
 '''
-import os 
-import pickle
-from qdls.data import load_json, save_json
+from qdls.data import save_json
 # import chattool 
 # API_URL = "https://api.chatanywhere.tech/v1"
 # API_KEY = os.environ.get('CHATANY_API_KEY', None) # local vllm set to "" 
 # chattool.api_base = API_URL
 # chattool.api_key = API_KEY
 
-from kopl.kopl import KoPLEngine
-
-def load_engine():
-    if os.path.exists("/home/qing/raid/paperwork/kgtool/data/kqa/engine.pkl"):
-        with open("/home/qing/raid/paperwork/kgtool/data/kqa/engine.pkl", "rb") as f:
-            engine = pickle.load(f)
-    else:   
-        engine = KoPLEngine(load_json("/home/qing/raid/paperwork/kgtool/data/kqa/kb_fixed.json"))
-        with open("/home/qing/raid/paperwork/kgtool/data/kqa/engine.pkl", "wb") as f:
-            pickle.dump(engine, f)   
-            print("engine saved")
-    return engine
+from engine_snapshot import load_engine
 
 engine = load_engine()
 print(type(engine))
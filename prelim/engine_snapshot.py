@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# @File    :   engine_snapshot.py
+# @Time    :   2026/10/18 10:12:40
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+KoPLEngine 的快照格式，替代原来整个 pickle 的 engine.pkl
+
+文件布局（整个文件 mmap 打开）:
+    MAGIC | 8 字节 header 长度 | header(json) | 各个 section
+
+header 记录源 KB 的 sha1 / 大小 / 修改时间，以及每个 section 的 (offset, length)。
+KB 对象上除 entities 以外的每个成员单独 pickle 成一个 section，第一次访问时才反序列化；
+每个实体单独 pickle，entity_offsets 是一个 uint64 数组，直接在 mmap 上 cast 使用，
+实体 id 列表和 id 到下标的映射在第一次用到时才构建，实体记录在第一次被访问时才反序列化。
+源 KB 变了（fix_kqa_kb.py 重新生成等）会自动重建快照。
+'''
+import os
+import gc
+import json
+import mmap
+import pickle
+import hashlib
+from array import array
+from collections.abc import Mapping
+from loguru import logger
+from kopl.kopl import KoPLEngine
+from kopl.data import KB
+
+KB_PATH = "/home/qing/raid/paperwork/kgtool/data/kqa/kb_fixed.json"
+SNAPSHOT_PATH = "/home/qing/raid/paperwork/kgtool/data/kqa/engine.snapshot"
+
+MAGIC = b"KOPLSNAP"
+FORMAT_VERSION = 1
+
+
+def kb_fingerprint(path):
+    """ KB 文件内容的 sha1，KB 改动之后依赖它的缓存都要失效 """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _loads(payload):
+    # 反序列化大量小对象时关掉 gc 能快很多
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.loads(payload)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class LazyEntities(Mapping):
+    """
+    kb.entities 的替代品，实体记录在第一次访问时才从 mmap 中反序列化
+
+    id 列表从 kb.entity_ids 取（同样是惰性的 section），id 到下标的映射在第一次按 id 查找时才构建
+    """
+
+    def __init__(self, buf, kb, offsets, base):
+        self._buf = buf
+        self._kb = kb
+        self._pos = None
+        self._offsets = offsets
+        self._base = base
+        self._records = {}
+
+    @property
+    def _ids(self):
+        return self._kb.entity_ids
+
+    def _position(self):
+        if self._pos is None:
+            self._pos = {eid: i for i, eid in enumerate(self._ids)}
+        return self._pos
+
+    def __getitem__(self, ent_id):
+        record = self._records.get(ent_id)
+        if record is None:
+            i = self._position()[ent_id]
+            start, end = self._base + self._offsets[i], self._base + self._offsets[i + 1]
+            record = self._records[ent_id] = _loads(self._buf[start:end])
+        return record
+
+    def __contains__(self, ent_id):
+        return ent_id in self._position()
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def keys(self):
+        # FindAll 会调用 list(kb.entities.keys())，直接返回 id 列表避免触发反序列化
+        return self._ids
+
+
+class SnapshotKB(KB):
+    """ 从快照加载的 KB，各个索引在第一次访问时才反序列化 """
+
+    def __init__(self, buf, sections):
+        self._buf = buf
+        self._sections = sections
+
+    def __getattr__(self, name):
+        # 只有实例上还没有这个属性时才会进来
+        sections = self.__dict__.get("_sections", {})
+        if name not in sections:
+            raise AttributeError(name)
+        offset, length = sections[name]
+        value = _loads(self._buf[offset:offset + length])
+        setattr(self, name, value)
+        return value
+
+
+def save_snapshot(engine, path, kb_path):
+    """ 把已经构建好的 engine 写成快照，先写临时文件再替换，避免留下写了一半的快照 """
+    kb = engine.kb
+    stat = os.stat(kb_path)
+    header = {
+        "format_version": FORMAT_VERSION,
+        "kb_path": os.path.abspath(kb_path),
+        "kb_fingerprint": kb_fingerprint(kb_path),
+        "kb_size": stat.st_size,
+        "kb_mtime": stat.st_mtime,
+        "sections": {},
+    }
+
+    payloads = []
+    for name, value in vars(kb).items():
+        if name != "entities":
+            payloads.append((name, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    entity_ids = list(kb.entities.keys())
+    offsets = array("Q", [0])
+    records = []
+    for ent_id in entity_ids:
+        record = pickle.dumps(kb.entities[ent_id], protocol=pickle.HIGHEST_PROTOCOL)
+        records.append(record)
+        offsets.append(offsets[-1] + len(record))
+    payloads.append(("entity_ids", pickle.dumps(entity_ids, protocol=pickle.HIGHEST_PROTOCOL)))
+    payloads.append(("entity_offsets", offsets.tobytes()))
+    payloads.append(("entity_records", b"".join(records)))
+
+    # 先按相对位置排布，header 长度确定之后再统一加上偏移
+    relative = {}
+    pos = 0
+    for name, payload in payloads:
+        relative[name] = pos
+        pos += len(payload)
+        # uint64 数组需要 8 字节对齐才能直接 cast
+        pos += -pos % 8
+    # 偏移写进 header 之后 header 会变长，反复计算直到数据起点不再变化
+    data_start = 0
+    while True:
+        header["sections"] = {
+            name: [data_start + relative[name], len(payload)] for name, payload in payloads
+        }
+        header_bytes = json.dumps(header).encode("utf-8")
+        need = len(MAGIC) + 8 + len(header_bytes)
+        need += -need % 8
+        if need <= data_start:
+            break
+        data_start = need
+    header_bytes += b" " * (data_start - len(MAGIC) - 8 - len(header_bytes))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for name, payload in payloads:
+            f.seek(header["sections"][name][0])
+            f.write(payload)
+    os.replace(tmp_path, path)
+    return header
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        n = int.from_bytes(f.read(8), "little")
+        return json.loads(f.read(n))
+
+
+def is_stale(header, kb_path):
+    """ 大小和修改时间都没变就认为 KB 没变，否则再比较内容的 sha1 """
+    if header is None or header.get("format_version") != FORMAT_VERSION:
+        return True
+    stat = os.stat(kb_path)
+    if stat.st_size == header["kb_size"] and stat.st_mtime == header["kb_mtime"]:
+        return False
+    return kb_fingerprint(kb_path) != header["kb_fingerprint"]
+
+
+def open_snapshot(path):
+    """ mmap 打开快照并构造 engine，此时只读了 header """
+    header = read_header(path)
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    sections = {name: tuple(v) for name, v in header["sections"].items()}
+
+    kb = SnapshotKB(buf, sections)
+    offset, length = sections["entity_offsets"]
+    offsets = memoryview(buf)[offset:offset + length].cast("Q")
+    kb.entities = LazyEntities(buf, kb, offsets, sections["entity_records"][0])
+
+    engine = KoPLEngine.__new__(KoPLEngine)
+    engine.kb = kb
+    engine.kb_fingerprint = header["kb_fingerprint"]
+    return engine
+
+
+def load_engine(kb_path=KB_PATH, snapshot_path=SNAPSHOT_PATH):
+    """ 优先从快照加载 engine；快照不存在、格式过期或者源 KB 变了就重新构建 """
+    if os.path.exists(snapshot_path) and not is_stale(read_header(snapshot_path), kb_path):
+        return open_snapshot(snapshot_path)
+
+    from qdls.data import load_json
+    logger.info(f"building engine snapshot from {kb_path}")
+    engine = KoPLEngine(load_json(kb_path))
+    save_snapshot(engine, snapshot_path, kb_path)
+    print("engine saved")
+    return open_snapshot(snapshot_path)
+
+
+if __name__ == "__main__":
+    import time
+    t = time.time()
+    engine = load_engine()
+    print(f"engine loaded in {time.time() - t:.3f}s")
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# @File    :   entity_sets.py
+# @Time    :   2026/10/18 16:05:12
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+ProgramExecutor 中实体集合的两种替代表示
+
+1. Universe：FindAll() 的惰性结果，不构造整个 KB 大小的实体列表，
+   由后面的算子下推处理（FilterConcept 直接取概念成员，属性过滤只看有该属性的实体等），
+   只有真正需要完整列表的算子才展开
+
+2. 位图执行模式：实体集合用整数位图表示
+
+KB 中的每个实体按 kb.entities 的顺序分配一个位，实体集合就是一个 Python 大整数，
+And / Or 是按字（word）并行的 & / |，Count 是 bit_count，FindAll 是全 1，
+FilterConcept 与预先算好的概念位图求交。只有 QueryName / What 和 program 的输出
+（以及位图不支持的算子的输入）才把位图转换回 'Q...' 字符串列表。
+结果与引擎一致（实体列表的顺序除外，这里按 kb.entities 的顺序）。
+'''
+import sys
+from array import array
+
+
+class Universe:
+    """ FindAll() 的惰性结果 """
+
+    __slots__ = ("kb",)
+
+    def __init__(self, kb):
+        self.kb = kb
+
+    def __len__(self):
+        return len(self.kb.entities)
+
+    def entities(self):
+        """ 展开成与 FindAll() 相同的 (entity_ids, None) """
+        return (list(self.kb.entities.keys()), None)
+
+
+# 输入是全集时，只需要看有该属性的实体。
+# 过滤算子内部遍历的都是 set(有该属性的实体)，结果（包括顺序）与在完整列表上执行相同；
+# SelectAmong 直接遍历输入的 set，顺序与完整列表不同：出现次数最多的单位并列时交给引擎，
+# 否则名字的集合相同，但名字列表的顺序不保证相同
+ATTRIBUTE_CONSUMERS = {"FilterStr", "FilterNum", "FilterYear", "FilterDate", "SelectAmong"}
+
+
+def has_unit_tie(kb, entity_ids, key):
+    """ quantity 属性值中出现次数最多的单位是否不止一个；并列时引擎按 set 的遍历顺序选单位 """
+    inv = kb.attribute_inv_index.get(key, {})
+    entities = kb.entities
+    counts = {}
+    for ent_id in entity_ids:
+        for idx in inv.get(ent_id, ()):
+            v = entities[ent_id]["attributes"][idx]["value"]
+            if v.type == "quantity":
+                counts[v.unit] = counts.get(v.unit, 0) + 1
+    top = sorted(counts.values(), reverse=True)[:2]
+    return len(top) == 2 and top[0] == top[1]
+
+
+def push_down(engine, function, args, inputs):
+    """
+    参数中有 Universe 时，尽量不展开整个实体列表
+
+    Returns:
+        能下推时返回与引擎相同的结果，否则返回 None，由调用方展开之后交给引擎
+    """
+    kb = engine.kb
+    if function == "Count":
+        return len(args[0])
+    if function == "FilterConcept":
+        members = set()
+        for i in kb.name_to_id.get(inputs[0], []):
+            members.update(kb.concept_to_entity.get(i, []))
+        return (list(members), None)
+    if function in ATTRIBUTE_CONSUMERS:
+        holders = kb.attribute_inv_index.get(inputs[0], {})
+        if function == "SelectAmong" and has_unit_tie(kb, holders, inputs[0]):
+            return None
+        return getattr(engine, function)((list(holders), None), *inputs)
+    if function == "And":
+        other = args[1] if isinstance(args[0], Universe) else args[0]
+        if isinstance(other, Universe):
+            return None
+        entities = kb.entities
+        return ([ent_id for ent_id in set(other[0]) if ent_id in entities], None)
+    return None
+
+
+class Bitmap:
+    """ 位图表示的实体集合，对应引擎中三元组为 None 的 (entity_ids, None) """
+
+    __slots__ = ("bits", "_entities")
+
+    def __init__(self, bits):
+        self.bits = bits
+        self._entities = None
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+
+class EntityBitmaps:
+    """
+    ProgramExecutor 在执行每一步之前先调用 execute，能用位图回答的直接返回（可能是 Bitmap），
+    否则返回 None；交给引擎或 KBIndex 之前用 to_entities 把 Bitmap 参数转换回二元组
+    """
+
+    def __init__(self, engine, min_size=1024):
+        """
+        Args:
+            engine (KoPLEngine): 执行用的引擎
+            min_size (int): 输入都是普通列表时，至少有这么多实体才转换成位图，
+                小集合直接用引擎的 set 运算更快
+        """
+        self.kb = engine.kb
+        self.min_size = min_size
+        self.ids = list(self.kb.entities.keys())
+        self.pos = {ent_id: i for i, ent_id in enumerate(self.ids)}
+        self.nwords = (len(self.ids) + 63) // 64
+        self.universe = Bitmap((1 << len(self.ids)) - 1)
+        # concept name -> Bitmap，包含子概念的实体
+        self.concepts = {}
+
+    def from_ids(self, entity_ids):
+        """ 实体列表 -> Bitmap，有 KB 之外的实体（悬空的关系目标等）时返回 None """
+        buf = bytearray(self.nwords * 8)
+        pos = self.pos
+        for ent_id in entity_ids:
+            i = pos.get(ent_id)
+            if i is None:
+                return None
+            buf[i >> 3] |= 1 << (i & 7)
+        return Bitmap(int.from_bytes(buf, "little"))
+
+    def to_ids(self, bitmap, limit=None):
+        """ Bitmap -> 实体列表，按 64 位的字跳过空白部分；limit 不为空时只取前 limit 个 """
+        if bitmap.bits == self.universe.bits:
+            return self.ids[:limit]
+        words = array("Q", bitmap.bits.to_bytes(self.nwords * 8, "little"))
+        if sys.byteorder == "big":
+            words.byteswap()
+        ids = self.ids
+        out = []
+        for w_i, w in enumerate(words):
+            base = w_i << 6
+            while w:
+                low = w & -w
+                out.append(ids[base + low.bit_length() - 1])
+                w ^= low
+            if limit is not None and len(out) >= limit:
+                return out[:limit]
+        return out
+
+    def to_entities(self, x):
+        """ Bitmap 转换回引擎使用的 (entity_ids, None)，其他结果原样返回 """
+        if not isinstance(x, Bitmap):
+            return x
+        if x._entities is None:
+            x._entities = (self.to_ids(x), None)
+        return x._entities
+
+    def _as_bitmap(self, x):
+        if isinstance(x, Universe):
+            return self.universe
+        return x if isinstance(x, Bitmap) else self.from_ids(x[0])
+
+    def concept(self, concept_name):
+        bitmap = self.concepts.get(concept_name)
+        if bitmap is None:
+            ids = []
+            for i in self.kb.name_to_id.get(concept_name, []):
+                ids.extend(self.kb.concept_to_entity.get(i, []))
+            bitmap = self.concepts[concept_name] = self.from_ids(ids)
+        return bitmap
+
+    def _worth(self, args):
+        """ 有位图参数，或者列表足够大时才走位图 """
+        return any(isinstance(a, (Bitmap, Universe)) for a in args) or sum(len(a[0]) for a in args) >= self.min_size
+
+    def execute(self, function, args, inputs):
+        """
+        Returns:
+            位图能处理时返回结果（实体集合为 Bitmap），否则返回 None
+        """
+        if function == "FindAll":
+            return self.universe
+        if function == "Count":
+            return len(args[0]) if isinstance(args[0], Bitmap) else None
+        if function in ("QueryName", "What"):
+            if not isinstance(args[0], Bitmap):
+                return None
+            entities = self.kb.entities
+            return [entities[ent_id]["name"] for ent_id in self.to_entities(args[0])[0]]
+        if function not in ("FilterConcept", "And", "Or") or not self._worth(args):
+            return None
+
+        bitmaps = [self._as_bitmap(a) for a in args]
+        if function == "FilterConcept":
+            bitmaps.append(self.concept(*inputs))
+        if None in bitmaps:
+            return None
+        if function == "Or":
+            return Bitmap(bitmaps[0].bits | bitmaps[1].bits)
+        return Bitmap(bitmaps[0].bits & bitmaps[1].bits)
@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 # @File    :   fix_kqa_kb.py
 # @Time    :   2024/12/27 14:05:29
-# @Author  :   Qing 
+# @Author  :   Qing
 # @Email   :   aqsz2526@outlook.com
 ######################### docstring ########################
 '''
 1.
-example kb 中 concept 对应的是subclassOf 
+example kb 中 concept 对应的是subclassOf
 但是 kqa 的 kb.json 中 concept 对应的是 instanceOf
 
 2.
@@ -16,44 +16,203 @@ example kb 中 concept 对应的是subclassOf
                 ~~~~~~~~^^^^^^^^^^^^
 KeyError: 'relation'
 
+流式处理：逐个实体读入 kb.json、修正之后立即写出，内存占用只和单个实体的大小有关，
+同时一遍统计 schema 异常（relation 缺少 predicate、concept 缺少 instanceOf 等）。
 '''
+import json
+from collections import Counter, defaultdict
 
-from qdls.data import load_json, save_json
+KB_PATH = "/home/qing/raid/paperwork/kgtool/data/kqa/kb.json"
+FIXED_KB_PATH = "/home/qing/raid/paperwork/kgtool/data/kqa/kb_fixed_v122.json"
 
-kb = load_json("/home/qing/raid/paperwork/kgtool/data/kqa/kb.json")
 
+class _StreamReader:
+    """ 在一个有限大小的缓冲区上逐个解析 json 值 """
 
-def inspect_concept():
-    from collections import defaultdict
-    concept_to_entity = defaultdict(list)
-    for eid, e in kb['entities'].items():
-        print(e)
-        input()
-        for cid in e['instanceOf']:
-            concept_to_entity[cid].append(eid)
-      
-    print(len(concept_to_entity['Q1132631']))
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, need=0):
+        """ 读入至少一块，并且让未消费的部分至少有 need 个字符；文件结束时返回 False """
+        rest = self.buf[self.pos:]
+        data = self.f.read(max(self.chunk_size, need - len(rest)))
+        if not data:
+            self.eof = True
+            return False
+        self.buf = rest + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ 跳过空白，返回下一个字符，文件结束时返回空串 """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, ch):
+        got = self.peek()
+        if got != ch:
+            raise ValueError(f"expected {ch!r} but got {got!r} at offset {self.pos}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # 数字在缓冲区末尾可能被截断，后面必须还有分隔符才算完整
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # 值跨越多个块时，未消费的部分每次读到原来的两倍再从值的开头重新解析，
+            # 总的解析量与值的大小成线性关系，而不是每读一块就重新解析一次
+            self._fill(2 * (len(self.buf) - self.pos))
+
+
+def iter_kb(path, chunk_size=1 << 20):
+    """
+    流式遍历 kb.json，顶层是 {section: {id: record}} 的形式
+
+    Yields:
+        tuple: (section, id, record)，例如 ("entities", "Q36159", {...})
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        reader = _StreamReader(f, chunk_size)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            section = reader.value()
+            reader.expect(":")
+            reader.expect("{")
+            if reader.peek() != "}":
+                while True:
+                    key = reader.value()
+                    reader.expect(":")
+                    yield section, key, reader.value()
+                    if reader.peek() != ",":
+                        break
+                    reader.expect(",")
+            reader.expect("}")
+            if reader.peek() != ",":
+                break
+            reader.expect(",")
+        reader.expect("}")
 
 
-inspect_concept()
-exit() 
+class SchemaReport:
+    """ 统计 schema 异常，每类保留前几个例子 """
 
-# for qid, v in kb['entities'].items():
-#     save_json(v, f"./{qid}.json")
-#     exit()
+    def __init__(self, max_examples=5):
+        self.max_examples = max_examples
+        self.counts = Counter()
+        self.examples = defaultdict(list)
 
-# 将 predicate 换成 relation
-for qid, v in kb['entities'].items():
-    for i, rel_info in enumerate(v['relations']):
-        kb['entities'][qid]['relations'][i]['relation'] = rel_info['predicate']
-        kb['entities'][qid]['relations'][i].pop('predicate')
+    def add(self, kind, example):
+        self.counts[kind] += 1
+        if len(self.examples[kind]) < self.max_examples:
+            self.examples[kind].append(example)
 
-# 将 instanceOf 换成 subclassOf
-for qid, v in kb['concepts'].items():
-    kb['concepts'][qid]['subclassOf'] = v['instanceOf']
-    kb['concepts'][qid].pop('instanceOf')
+    def print(self):
+        if not self.counts:
+            print("no schema anomalies")
+        for kind, n in self.counts.most_common():
+            print(f"{kind}: {n}, e.g. {self.examples[kind]}")
 
 
+def fix_concept(cid, concept, report):
+    """ 将 instanceOf 换成 subclassOf """
+    if "instanceOf" in concept:
+        concept["subclassOf"] = concept.pop("instanceOf")
+    elif "subclassOf" not in concept:
+        report.add("concept_missing_instanceOf", cid)
+        concept["subclassOf"] = []
+    if "name" not in concept:
+        report.add("concept_missing_name", cid)
+    return concept
+
+
+def fix_entity(eid, entity, report):
+    """ 将 predicate 换成 relation """
+    if "instanceOf" not in entity:
+        report.add("entity_missing_instanceOf", eid)
+        entity["instanceOf"] = []
+    if "name" not in entity:
+        report.add("entity_missing_name", eid)
+    for field in ("attributes", "relations"):
+        if field not in entity:
+            report.add(f"entity_missing_{field}", eid)
+            entity[field] = []
+    for i, rel_info in enumerate(entity["relations"]):
+        if "predicate" in rel_info:
+            rel_info["relation"] = rel_info.pop("predicate")
+        elif "relation" not in rel_info:
+            report.add("relation_missing_predicate", (eid, i))
+        if "object" not in rel_info:
+            report.add("relation_missing_object", (eid, i))
+        if rel_info.get("direction") not in ("forward", "backward"):
+            report.add("relation_bad_direction", (eid, i))
+    for i, attr_info in enumerate(entity["attributes"]):
+        if "type" not in attr_info.get("value", {}):
+            report.add("attribute_missing_value_type", (eid, i))
+    return entity
+
+
+def normalize_kb(src=KB_PATH, dst=FIXED_KB_PATH, chunk_size=1 << 20):
+    """ 流式修正 kb.json 并增量写出，返回 SchemaReport """
+    from tqdm import tqdm
+    fixers = {"concepts": fix_concept, "entities": fix_entity}
+    report = SchemaReport()
+    current = None
+    seen = set()
+    with open(dst, "w", encoding="utf-8") as out:
+        out.write("{")
+        for section, key, record in tqdm(iter_kb(src, chunk_size)):
+            if section != current:
+                out.write("}, " if current is not None else "")
+                out.write(f"{json.dumps(section)}: {{")
+                current = section
+                seen.add(section)
+            else:
+                out.write(", ")
+            if section in fixers:
+                record = fixers[section](key, record, report)
+            out.write(f"{json.dumps(key, ensure_ascii=False)}: {json.dumps(record, ensure_ascii=False)}")
+        if current is not None:
+            out.write("}")
+        # 空的 concepts / entities 不会被遍历到，但 KB 要求这两个字段存在
+        for section in fixers:
+            if section not in seen:
+                out.write(f"{', ' if seen else ''}{json.dumps(section)}: {{}}")
+                seen.add(section)
+        out.write("}")
+    report.print()
+    return report
+
+
+def inspect_concept(path=KB_PATH):
+    concept_to_entity = defaultdict(list)
+    for section, eid, e in iter_kb(path):
+        if section != "entities":
+            continue
+        for cid in e['instanceOf']:
+            concept_to_entity[cid].append(eid)
+
+    print(len(concept_to_entity['Q1132631']))
 
 
-save_json(kb, "/home/qing/raid/paperwork/kgtool/data/kqa/kb_fixed_v122.json")
\ No newline at end of file
+if __name__ == "__main__":
+    # inspect_concept()
+    normalize_kb()
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+# @File    :   kb_index.py
+# @Time    :   2026/10/18 11:03:27
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+给 KoPLEngine 的 KB 建额外的索引，供 ProgramExecutor 使用
+
+KoPLEngine 的 FilterStr / FilterConcept 等算子会逐个比较输入实体的属性，
+输入是 FindAll() 时就等于扫描整个 KB。这里的索引按需构建（第一次用到某个属性键时才建），
+结果与引擎一致（实体列表的顺序除外，引擎本身的顺序来自 set 的遍历顺序）。
+'''
+import os
+import json
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+from collections import defaultdict
+from datetime import date, MINYEAR, MAXYEAR
+
+RELATION_INDEX_PATH = "/home/qing/raid/paperwork/kgtool/data/kqa/relation2index.json"
+
+DIRECTIONS = {"forward": 0, "backward": 1}
+
+
+def relation_key(relation):
+    """ KB 中的关系名 -> relation2index.json 中的写法，如 famous people -> famous_people，含特殊字符的加反引号 """
+    key = relation.replace(" ", "_")
+    if not key.replace("_", "").isalnum():
+        key = f"`{key}`"
+    return key
+
+
+class LazyFacts(Sequence):
+    """
+    Relate 返回的三元组列表，只记录 (头实体, 下标)，被访问时才去实体记录里取
+
+    只在 ProgramExecutor 内部传递（后面的算子多数只用实体列表），
+    program 的结果在离开 ProgramExecutor 之前转换成普通的 list
+    """
+
+    def __init__(self, entities, sources, fact_idx):
+        self._entities = entities
+        self._sources = sources
+        self._fact_idx = fact_idx
+
+    def __len__(self):
+        return len(self._fact_idx)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self._entities[self._sources[i]]['relations'][self._fact_idx[i]]
+
+    def __iter__(self):
+        entities = self._entities
+        for s, idx in zip(self._sources, self._fact_idx):
+            yield entities[s]['relations'][idx]
+
+
+class RelationGraph:
+    """
+    整数编码的 CSR 邻接表，替代 kb.relation_inv_index 的嵌套字典
+
+    实体 id 映射为整数；所有边按 (头实体, 关系 id * 2 + 方向) 排序存放在 array 里，
+    indptr[i]:indptr[i+1] 是第 i 个实体的所有边，其中同一关系同一方向的边是连续的一段，
+    用二分查找定位。关系 id 来自 relation2index.json，文件里没有的关系往后追加。
+    """
+
+    def __init__(self, kb, relation_index_path=RELATION_INDEX_PATH):
+        self.kb = kb
+        self.relation_ids = {}
+        if relation_index_path is not None and os.path.exists(relation_index_path):
+            with open(relation_index_path) as f:
+                key_to_id = json.load(f)
+        else:
+            key_to_id = {}
+        next_id = max(key_to_id.values(), default=-1) + 1
+
+        self.ent_ids = list(kb.entities.keys())
+        self.ent_pos = {ent_id: i for i, ent_id in enumerate(self.ent_ids)}
+        self.indptr = array("q", [0])
+        self.codes = array("l")
+        self.targets = array("l")
+        self.fact_idx = array("l")
+        for ent_id in list(self.ent_ids):
+            edges = []
+            for idx, rel_info in enumerate(kb.entities[ent_id]['relations']):
+                relation = rel_info['relation']
+                rid = self.relation_ids.get(relation)
+                if rid is None:
+                    rid = key_to_id.get(relation_key(relation))
+                    if rid is None:
+                        rid, next_id = next_id, next_id + 1
+                    self.relation_ids[relation] = rid
+                direction = DIRECTIONS.get(rel_info['direction'])
+                if direction is None:
+                    continue
+                edges.append((rid * 2 + direction, self._intern(rel_info['object']), idx))
+            edges.sort(key=lambda x: x[0])
+            for code, target, idx in edges:
+                self.codes.append(code)
+                self.targets.append(target)
+                self.fact_idx.append(idx)
+            self.indptr.append(len(self.codes))
+
+    def _intern(self, ent_id):
+        # 关系的宾语可能不在 entities 里，也分配一个整数
+        pos = self.ent_pos.get(ent_id)
+        if pos is None:
+            pos = self.ent_pos[ent_id] = len(self.ent_ids)
+            self.ent_ids.append(ent_id)
+        return pos
+
+    def relate(self, entity_ids, relation, direction):
+        """ 等价于 Relate，结果中的实体可以重复，与引擎一致 """
+        rid = self.relation_ids.get(relation)
+        d = DIRECTIONS.get(direction)
+        if rid is None or d is None:
+            return ([], [])
+        code = rid * 2 + d
+        indptr, codes, ent_pos = self.indptr, self.codes, self.ent_pos
+        n = len(indptr) - 1
+        targets, sources, fact_idx = array("l"), [], array("l")
+        for ent_id in set(entity_ids):
+            p = ent_pos.get(ent_id)
+            if p is None or p >= n:
+                continue
+            lo, hi = indptr[p], indptr[p + 1]
+            a = bisect_left(codes, code, lo, hi)
+            b = bisect_right(codes, code, a, hi)
+            if a < b:
+                targets.extend(self.targets[a:b])
+                fact_idx.extend(self.fact_idx[a:b])
+                sources.extend([ent_id] * (b - a))
+        ent_ids = self.ent_ids
+        return ([ent_ids[t] for t in targets], LazyFacts(self.kb.entities, sources, fact_idx))
+
+
+class KBIndex:
+    """
+    ProgramExecutor 在执行每一步之前先调用 execute，能用索引回答的直接返回结果，
+    否则返回 None，由引擎原来的实现处理
+    """
+
+    def __init__(self, engine, min_scan_size=1000, relation_index_path=RELATION_INDEX_PATH):
+        """
+        Args:
+            engine (KoPLEngine): 要建索引的引擎
+            min_scan_size (int): 输入不是 FindAll 时，实体数至少这么多才走范围索引，
+                小集合直接逐个比较更快
+            relation_index_path (str): relation2index.json，给关系分配整数 id
+        """
+        self.engine = engine
+        self.kb = engine.kb
+        self.min_scan_size = min_scan_size
+        self.relation_index_path = relation_index_path
+        self._graph = None
+        # attribute key -> {string value: [(entity id, attribute fact), ...]}
+        self.str_index = {}
+        # attribute key -> {unit: (sorted values, [(entity id, attribute fact), ...])}
+        self.quantity_index = {}
+        # attribute key -> ((sorted years, items), (sorted dates, items))
+        self.time_index = {}
+        # concept name -> frozenset(entity ids)，包含子概念的实体
+        self.concept_members = {}
+
+    def _str_values(self, key):
+        index = self.str_index.get(key)
+        if index is None:
+            index = defaultdict(list)
+            entities = self.kb.entities
+            for ent_id, idxs in self.kb.attribute_inv_index.get(key, {}).items():
+                attributes = entities[ent_id]['attributes']
+                for idx in idxs:
+                    attr_info = attributes[idx]
+                    v = attr_info['value']
+                    # 与引擎一致：只有 string 类型、值完全相同才算匹配
+                    if attr_info['key'] == key and v.type == 'string':
+                        index[v.value].append((ent_id, attr_info))
+            self.str_index[key] = index = dict(index)
+        return index
+
+    def filter_str_all(self, key, value):
+        """ 等价于 FilterStr(FindAll(), key, value) """
+        matches = self._str_values(key).get(value, [])
+        return ([ent_id for ent_id, _ in matches], [fact for _, fact in matches])
+
+    def _build_numeric(self, key):
+        quantities = defaultdict(list)
+        years, dates = [], []
+        entities = self.kb.entities
+        for ent_id, idxs in self.kb.attribute_inv_index.get(key, {}).items():
+            attributes = entities[ent_id]['attributes']
+            for idx in idxs:
+                attr_info = attributes[idx]
+                v = attr_info['value']
+                if attr_info['key'] != key:
+                    continue
+                if v.type == 'quantity':
+                    quantities[v.unit].append((v.value, ent_id, attr_info))
+                elif v.type == 'year':
+                    years.append((v.value, ent_id, attr_info))
+                elif v.type == 'date':
+                    dates.append((v.value, ent_id, attr_info))
+
+        def columns(entries):
+            entries.sort(key=lambda x: x[0])
+            return [x[0] for x in entries], [(x[1], x[2]) for x in entries]
+
+        self.quantity_index[key] = {unit: columns(entries) for unit, entries in quantities.items()}
+        self.time_index[key] = (columns(years), columns(dates))
+
+    def _quantities(self, key):
+        if key not in self.quantity_index:
+            self._build_numeric(key)
+        return self.quantity_index[key]
+
+    def _times(self, key):
+        if key not in self.time_index:
+            self._build_numeric(key)
+        return self.time_index[key]
+
+    @staticmethod
+    def _range(values, items, lo_value, hi_value, op):
+        """ values 有序，返回满足 op 的 items；'=' 取 [lo_value, hi_value]，'<' 小于 lo_value，'>' 大于 hi_value """
+        if op == '<':
+            return items[:bisect_left(values, lo_value)]
+        if op == '>':
+            return items[bisect_right(values, hi_value):]
+        lo, hi = bisect_left(values, lo_value), bisect_right(values, hi_value)
+        if op == '=':
+            return items[lo:hi]
+        return items[:lo] + items[hi:]
+
+    def _match_quantity(self, key, tgt, op):
+        # ValueClass.can_compare: 数值只有单位相同才能比较
+        values, items = self._quantities(key).get(tgt.unit, ([], []))
+        return self._range(values, items, tgt.value, tgt.value, op)
+
+    def _match_time(self, key, tgt, op):
+        # 与 comp / ValueClass.contains 的语义一致：
+        # 目标是年份时，年份和日期都按年比较；目标是日期时，年份按年比较，'=' 只匹配相同的日期
+        (years, year_items), (dates, date_items) = self._times(key)
+        if tgt.type == 'year':
+            y = tgt.value
+            res = self._range(years, year_items, y, y, op)
+            if y < MINYEAR:
+                res = res + (date_items if op in ('>', '!=') else [])
+            elif y > MAXYEAR:
+                res = res + (date_items if op in ('<', '!=') else [])
+            else:
+                res = res + self._range(dates, date_items, date(y, 1, 1), date(y, 12, 31), op)
+            return res
+        d = tgt.value
+        if op == '=':
+            res = []
+        elif op == '!=':
+            res = list(year_items)
+        else:
+            res = self._range(years, year_items, d.year, d.year, op)
+        return res + self._range(dates, date_items, d, d, op)
+
+    def filter_numeric(self, entity_ids, key, value, op, typ):
+        """
+        等价于 FilterNum / FilterYear / FilterDate，entity_ids 为 None 表示 FindAll()
+
+        Returns:
+            op 不支持时返回 None，交给引擎处理
+        """
+        if op not in ('=', '!=', '<', '>'):
+            return None
+        tgt = self.engine._parse_key_value(key, value, typ)
+        if tgt.type == 'quantity':
+            matches = self._match_quantity(key, tgt, op)
+        else:
+            matches = self._match_time(key, tgt, op)
+        if entity_ids is not None:
+            entity_ids = set(entity_ids)
+            matches = [m for m in matches if m[0] in entity_ids]
+        return ([ent_id for ent_id, _ in matches], [fact for _, fact in matches])
+
+    def select_among(self, entity_ids, key, op):
+        """
+        等价于 SelectAmong，entity_ids 为 None 表示 FindAll()
+
+        先取出现次数最多的单位，再在该单位下取最大/最小值，不做全量排序。
+        没有候选（引擎会报错）时返回 None，交给引擎处理
+        """
+        kb = self.kb
+        if entity_ids is None:
+            by_unit = self._quantities(key)
+            counts = sorted(((len(items), unit) for unit, (_, items) in by_unit.items()), reverse=True)
+            # 数量并列时引擎按遍历顺序选单位，这里无法复现，交给引擎
+            if not counts or (len(counts) > 1 and counts[0][0] == counts[1][0]):
+                return None
+            values, items = by_unit[counts[0][1]]
+            value = values[0] if op == 'smallest' else values[-1]
+            lo, hi = bisect_left(values, value), bisect_right(values, value)
+            return list(set(kb.entities[ent_id]['name'] for ent_id, _ in items[lo:hi]))
+
+        inv = kb.attribute_inv_index.get(key, {})
+        entities = kb.entities
+        counts = {}
+        best = {}
+        for ent_id in set(entity_ids):
+            for idx in inv.get(ent_id, ()):
+                v = entities[ent_id]['attributes'][idx]['value']
+                if v.type != 'quantity':
+                    continue
+                counts[v.unit] = counts.get(v.unit, 0) + 1
+                cur = best.get(v.unit)
+                if cur is None or (v.value < cur[0] if op == 'smallest' else v.value > cur[0]):
+                    best[v.unit] = (v.value, [ent_id])
+                elif v.value == cur[0]:
+                    cur[1].append(ent_id)
+        if not counts:
+            return None
+        # max 在并列时返回第一个，与 Counter.most_common 的顺序一致
+        unit = max(counts, key=counts.get)
+        return list(set(entities[ent_id]['name'] for ent_id in best[unit][1]))
+
+    def _members(self, concept_name):
+        # kb.concept_to_entity 在 KB 加载时已经沿 instanceOf / subclassOf 做了传递闭包，
+        # 这里再把同名的多个概念合并成一个集合，之后每次过滤只需查表或求交
+        members = self.concept_members.get(concept_name)
+        if members is None:
+            ids = set()
+            for i in self.kb.name_to_id.get(concept_name, []):
+                ids.update(self.kb.concept_to_entity.get(i, []))
+            self.concept_members[concept_name] = members = frozenset(ids)
+        return members
+
+    def filter_concept(self, entity_ids, concept_name):
+        """ 等价于 FilterConcept，entity_ids 为 None 表示 FindAll() """
+        members = self._members(concept_name)
+        if entity_ids is None:
+            return (list(members), None)
+        return ([ent_id for ent_id in set(entity_ids) if ent_id in members], None)
+
+    @property
+    def graph(self):
+        if self._graph is None:
+            self._graph = RelationGraph(self.kb, self.relation_index_path)
+        return self._graph
+
+    def execute(self, function, args, inputs, dep_functions):
+        """
+        Args:
+            function (str): program 中的函数名
+            args (list): 依赖步骤的结果
+            inputs (tuple): 该步骤的 inputs
+            dep_functions (list): 依赖步骤的函数名
+
+        Returns:
+            索引能处理时返回与引擎相同的结果，否则返回 None
+        """
+        from_all = dep_functions == ["FindAll"]
+        if function == "Relate":
+            return self.graph.relate(args[0][0], *inputs)
+        if function == "FilterConcept":
+            return self.filter_concept(None if from_all else args[0][0], *inputs)
+        if from_all and function == "FilterStr":
+            return self.filter_str_all(*inputs)
+
+        if function in NUMERIC_FILTERS or function == "SelectAmong":
+            if from_all:
+                entity_ids = None
+            elif len(args[0][0]) >= self.min_scan_size:
+                entity_ids = args[0][0]
+            else:
+                return None
+            if function == "SelectAmong":
+                return self.select_among(entity_ids, *inputs)
+            return self.filter_numeric(entity_ids, *inputs, NUMERIC_FILTERS[function])
+        return None
+
+
+# 数值/时间过滤 -> 目标值的解析类型，与 KoPLEngine 中的一致
+NUMERIC_FILTERS = {
+    "FilterNum": "quantity",
+    "FilterYear": "year",
+    "FilterDate": "date",
+}
@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+# @File    :   kopl_server.py
+# @Time    :   2026/10/18 14:02:37
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+常驻的 KoPL 工具调用服务，多个 agent rollout 共用一个已经加载好的 engine
+
+asyncio 实现的极简 HTTP/1.1（JSON），可以监听 TCP 端口或者 Unix socket:
+    GET  /health            服务状态
+    GET  /tools             可用的 KoPL 函数及其参数
+    POST /tool/<Function>   单步调用，body: {"dependencies": [handle, ...], "inputs": [...]}
+    POST /program           整个 program，body: {"program": [...], "limit": 可选，只需要的答案个数}；
+                            program 也可以是点号形式的 kopl 字符串，例如 "Find(LeBron James).QueryAttr(height)"
+    POST /batch             多个 program，body: {"programs": [...], "limits": 可选}，返回 run_batch 的统计
+
+每个结果都保存在服务端并返回一个 handle，后续的单步调用用 handle 引用它，
+这样 agent 不需要来回传输实体列表和三元组，响应里只带一个可读的预览。
+同一时间窗口内到达的 /program 请求合并成一批用 run_batch 执行；
+正在处理的请求数超过 max_pending 时直接返回 503，由客户端稍后重试。
+
+引擎调用默认放在有界的线程池里执行，线程池只是让引擎调用不阻塞事件循环：
+KoPL 引擎是纯 python 的，受 GIL 限制，workers > 1 并不能多用 CPU。
+设置 processes 之后，/program 和 /batch 改为在 fork 出来的进程池中执行，
+子进程通过写时复制共享已经加载好的 engine，可以真正并行；
+/tool 的单步调用要用到服务端保存的 handle，仍然在主进程的线程池里执行。
+'''
+import json
+import asyncio
+import inspect
+import functools
+import multiprocessing as mp
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from loguru import logger
+
+from convert_program_to_executable import FUNCTION_TABLE, ProgramExecutor
+from kopl_string import parse_kopl
+from budget import Budget, BudgetExceeded
+
+# 实体结果在响应中最多展示的个数，完整结果通过 handle 留在服务端
+PREVIEW_SIZE = 10
+
+# 引擎对非法输入（不存在的函数、依赖下标越界、参数个数或者取值不对）抛出的异常，
+# 作为 400 报告给 agent；其他异常（进程池损坏、服务已关闭等）是服务端的问题，返回 500
+ENGINE_INPUT_ERRORS = (LookupError, ValueError, TypeError, AttributeError)
+
+
+class HandleStore:
+    """ handle -> 执行结果，超过容量时淘汰最久没用的 """
+
+    def __init__(self, max_handles=100000):
+        self.max_handles = max_handles
+        self.results = OrderedDict()
+        self.counter = 0
+
+    def put(self, result):
+        self.counter += 1
+        handle = f"h{self.counter}"
+        self.results[handle] = result
+        if len(self.results) > self.max_handles:
+            self.results.popitem(last=False)
+        return handle
+
+    def get(self, handle):
+        result = self.results[handle]
+        self.results.move_to_end(handle)
+        return result
+
+
+def execute_batch(executor, programs, limits):
+    """ 执行一批 program；整批失败时逐个重跑，只让出错的那个 program 返回错误 """
+    try:
+        results, _ = executor.run_batch(programs, limits)
+        return [(True, r) for r in results]
+    except Exception:
+        outcomes = []
+        for program, limit in zip(programs, limits):
+            try:
+                outcomes.append((True, executor.run(program, limit=limit)))
+            except Exception as e:
+                outcomes.append((False, e))
+        return outcomes
+
+
+# 进程池的子进程在 fork 时继承主进程的 executor（以及其中的 engine），不需要 pickle
+_fork_executor = None
+
+
+def _init_fork_worker(executor):
+    global _fork_executor
+    _fork_executor = executor
+
+
+def _fork_execute_batch(programs, limits):
+    return execute_batch(_fork_executor, programs, limits)
+
+
+def _fork_run_batch(programs, limits):
+    return _fork_executor.run_batch(programs, limits)
+
+
+class RequestError(Exception):
+    """ 客户端请求有误，对应 4xx 响应 """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _check_limit(limit, name="limit"):
+    # bool 是 int 的子类，true 不能当作 1
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+        raise RequestError(400, f"{name} must be a positive integer")
+    return limit
+
+
+class KoPLServer:
+    """
+    Args:
+        engine (KoPLEngine): 常驻的引擎
+        executor (ProgramExecutor): 执行 program 用，默认不带缓存；
+            OperatorCache / ProgramCache 不是线程安全的，共享它们时 workers 要设为 1
+        workers (int): 执行引擎调用的线程数，只用来不阻塞事件循环，受 GIL 限制不增加 CPU 吞吐
+        processes (int): 大于 0 时 /program 和 /batch 在这么多个 fork 出来的进程中并行执行，
+            每个子进程有自己的一份缓存和统计
+        max_pending (int): 同时在处理的请求数上限，超过时返回 503
+        batch_window (float): /program 请求合并成一批的等待时间（秒）
+        max_batch (int): 一批最多的 program 数
+        max_handles (int): 服务端最多保留的中间结果数
+    """
+
+    def __init__(self, engine, executor=None, workers=4, processes=0, max_pending=256,
+                 batch_window=0.005, max_batch=64, max_handles=100000):
+        self.engine = engine
+        self.executor = executor or ProgramExecutor(engine)
+        self.pool = ThreadPoolExecutor(workers)
+        self.workers = asyncio.Semaphore(workers)
+        if processes:
+            self.program_pool = ProcessPoolExecutor(
+                processes, mp_context=mp.get_context("fork"),
+                initializer=_init_fork_worker, initargs=(self.executor,)
+            )
+            # fork 在第一次提交时发生，趁还没有其他线程在跑的时候把子进程都起好
+            self.program_pool.submit(int).result()
+            self.program_slots = asyncio.Semaphore(processes)
+            self.execute_batch = _fork_execute_batch
+            self.run_batch_func = _fork_run_batch
+        else:
+            self.program_pool = self.pool
+            self.program_slots = self.workers
+            self.execute_batch = functools.partial(execute_batch, self.executor)
+            self.run_batch_func = self.executor.run_batch
+        self.max_pending = max_pending
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.handles = HandleStore(max_handles)
+        self.pending = 0
+        self.rejected = 0
+        self.queue = None
+        self.batcher = None
+        self.server = None
+
+    ######################### 结果序列化 #########################
+
+    def to_json(self, result):
+        """ 与 KoPLEngine.forward 的输出约定一致，实体集合只给出数量和前几个实体 """
+        if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], list):
+            ids = result[0]
+            entities = self.engine.kb.entities
+            return {
+                "type": "entities",
+                "count": len(ids),
+                "preview": [
+                    {"id": i, "name": entities[i]["name"] if i in entities else None}
+                    for i in ids[:PREVIEW_SIZE]
+                ],
+            }
+        if isinstance(result, list):
+            return [str(r) for r in result]
+        if result is None or isinstance(result, (bool, int, float)):
+            return result
+        return str(result)
+
+    def respond(self, result):
+        # 超出预算的 program 没有结果可以保存，告诉 agent 是哪一步、哪个条件
+        if isinstance(result, BudgetExceeded):
+            return {"budget_exceeded": result._asdict()}
+        return {"handle": self.handles.put(result), "result": self.to_json(result)}
+
+    ######################### 请求处理 #########################
+
+    def tools(self):
+        """ 每个 KoPL 函数除实体参数外需要的 inputs """
+        spec = {}
+        for func_name, method_name in FUNCTION_TABLE.items():
+            params = list(inspect.signature(getattr(self.engine, method_name)).parameters)
+            n_deps = sum(p.endswith("entities") for p in params)
+            if method_name.startswith("Verify"):
+                n_deps = 1
+            spec[func_name] = {"dependencies": n_deps, "inputs": params[n_deps:]}
+        return spec
+
+    async def _run(self, func, *args):
+        async with self.workers:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+    async def _run_program(self, func, *args):
+        async with self.program_slots:
+            return await asyncio.get_running_loop().run_in_executor(self.program_pool, func, *args)
+
+    async def call_tool(self, function, body):
+        if function not in FUNCTION_TABLE:
+            raise RequestError(404, f"unknown function {function}")
+        try:
+            args = [self.handles.get(h) for h in body.get("dependencies", [])]
+        except KeyError as e:
+            raise RequestError(410, f"handle {e.args[0]} expired or unknown")
+        inputs = body.get("inputs", [])
+        result = await self._run(self.executor.dispatch[function], *args, *inputs)
+        return self.respond(result)
+
+    async def run_program(self, body):
+        program = body.get("program")
+        if not program:
+            raise RequestError(400, "missing program")
+        if isinstance(program, str):
+            try:
+                program = parse_kopl(program)
+            except ValueError as e:
+                raise RequestError(400, str(e))
+        limit = _check_limit(body.get("limit"))
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((program, limit, future))
+        ok, result = await future
+        if not ok:
+            raise result
+        return self.respond(result)
+
+    async def run_batch(self, body):
+        programs = body.get("programs")
+        if not programs:
+            raise RequestError(400, "missing programs")
+        if not isinstance(programs, list):
+            raise RequestError(400, "programs must be a list")
+        limits = body.get("limits")
+        if limits is not None:
+            if not isinstance(limits, list) or len(limits) != len(programs):
+                raise RequestError(400, "limits must be a list with one entry per program")
+            for i, limit in enumerate(limits):
+                _check_limit(limit, f"limits[{i}]")
+        results, report = await self._run_program(self.run_batch_func, programs, limits)
+        return {"results": [self.respond(r) for r in results], "report": report}
+
+    async def _batch_loop(self):
+        """ 把 batch_window 内到达的 /program 请求合并，最多 workers（或 processes）批同时执行 """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self.program_slots.acquire()
+            asyncio.create_task(self._dispatch_batch(batch))
+
+    async def _dispatch_batch(self, batch):
+        try:
+            outcomes = await asyncio.get_running_loop().run_in_executor(
+                self.program_pool, self.execute_batch,
+                [program for program, _, _ in batch], [limit for _, limit, _ in batch]
+            )
+        except Exception as e:
+            outcomes = [(False, e)] * len(batch)
+        finally:
+            self.program_slots.release()
+        for (_, _, future), outcome in zip(batch, outcomes):
+            if not future.done():
+                future.set_result(outcome)
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return {
+                "status": "ok",
+                "pending": self.pending,
+                "rejected": self.rejected,
+                "handles": len(self.handles.results),
+                "kb_fingerprint": getattr(self.engine, "kb_fingerprint", None),
+            }
+        if method == "GET" and path == "/tools":
+            return self.tools()
+        if method == "POST" and path.startswith("/tool/"):
+            return await self.call_tool(path[len("/tool/"):], body)
+        if method == "POST" and path == "/program":
+            return await self.run_program(body)
+        if method == "POST" and path == "/batch":
+            return await self.run_batch(body)
+        raise RequestError(404, f"no route for {method} {path}")
+
+    async def handle_request(self, method, path, body):
+        """ Returns: (status, payload) """
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            return 503, {"error": "server busy, retry later"}
+        self.pending += 1
+        try:
+            return 200, await self.route(method, path, body)
+        except RequestError as e:
+            return e.status, {"error": str(e)}
+        except ENGINE_INPUT_ERRORS as e:
+            # 引擎对非法输入会抛出各种异常，原样报告给 agent
+            return 400, {"error": f"{type(e).__name__}: {e}"}
+        except Exception as e:
+            logger.exception(f"{method} {path} failed")
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+        finally:
+            self.pending -= 1
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, headers, length = await _read_head(request_line, reader)
+                except ValueError as e:
+                    # 不知道请求体有多长，也就找不到下一个请求的开头，回复 400 之后关闭连接
+                    writer.write(_http_response(400, {"error": str(e)}, keep_alive=False))
+                    await writer.drain()
+                    break
+                raw = await reader.readexactly(length) if length else b""
+                try:
+                    body = json.loads(raw) if raw else {}
+                except json.JSONDecodeError as e:
+                    status, payload = 400, {"error": f"invalid json: {e}"}
+                else:
+                    status, payload = await self.handle_request(method, path, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(_http_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    ######################### 启停 #########################
+
+    async def start(self, host="127.0.0.1", port=8765, path=None):
+        """ path 不为空时监听 Unix socket，否则监听 host:port """
+        self.queue = asyncio.Queue(self.max_pending)
+        self.batcher = asyncio.create_task(self._batch_loop())
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self._handle_connection, path=path)
+        else:
+            self.server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"kopl server listening on {path or f'{host}:{port}'}")
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        self.pool.shutdown(wait=False)
+        self.program_pool.shutdown(wait=False)
+
+    async def serve_forever(self, host="127.0.0.1", port=8765, path=None):
+        await self.start(host, port, path)
+        async with self.server:
+            await self.server.serve_forever()
+
+
+STATUS_TEXT = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 410: "Gone",
+    500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+
+async def _read_head(request_line, reader):
+    """
+    解析请求行和请求头
+
+    Returns:
+        tuple: (method, path, headers, 请求体长度)
+
+    Raises:
+        ValueError: 请求行格式不对，或者 POST 请求缺少 / 带了非法的 Content-Length
+    """
+    parts = request_line.decode("latin-1").split()
+    if len(parts) != 3:
+        raise ValueError("malformed request line")
+    method, path, _ = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        k, _, v = line.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    length = headers.get("content-length")
+    if length is None:
+        if method == "POST":
+            raise ValueError("missing Content-Length")
+        return method, path, headers, 0
+    if not (length.isascii() and length.isdigit()):
+        raise ValueError(f"invalid Content-Length {length!r}")
+    return method, path, headers, int(length)
+
+
+def _http_response(status, payload, keep_alive=True):
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = [
+        f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}",
+        "Content-Type: application/json",
+        f"Content-Length: {len(data)}",
+        "Connection: " + ("keep-alive" if keep_alive else "close"),
+    ]
+    if status == 503:
+        headers.append("Retry-After: 1")
+    return ("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + data
+
+
+class KoPLClient:
+    """ 服务的异步客户端，每个请求一个短连接；收到 503 时退避重试 """
+
+    def __init__(self, host="127.0.0.1", port=8765, path=None, retries=5):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.retries = retries
+
+    async def request(self, method, url, payload=None):
+        for attempt in range(self.retries + 1):
+            if self.path is not None:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+            writer.write(
+                f"{method} {url} HTTP/1.1\r\nHost: kopl\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data
+            )
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            head, _, body = response.partition(b"\r\n\r\n")
+            status = int(head.split(b" ", 2)[1])
+            if status == 503 and attempt < self.retries:
+                await asyncio.sleep(0.01 * 2 ** attempt)
+                continue
+            return status, json.loads(body)
+
+    async def call(self, function, dependencies=(), inputs=()):
+        return await self.request("POST", f"/tool/{function}",
+                                  {"dependencies": list(dependencies), "inputs": list(inputs)})
+
+    async def run_program(self, program, limit=None):
+        payload = {"program": program}
+        if limit is not None:
+            payload["limit"] = limit
+        return await self.request("POST", "/program", payload)
+
+    async def run_batch(self, programs, limits=None):
+        payload = {"programs": programs}
+        if limits is not None:
+            payload["limits"] = limits
+        return await self.request("POST", "/batch", payload)
+
+    async def health(self):
+        return await self.request("GET", "/health")
+
+
+class MockLLM:
+    """
+    按 KQA 标注的 program 逐步给出工具调用的假 LLM，用来在没有真实模型的情况下测试 agent 循环
+
+    每一轮根据上一步的观察返回 {"name", "dependencies", "inputs"}，dependencies 中是步骤下标，
+    program 结束之后返回 {"answer": ...}
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self.step = 0
+
+    def chat(self, observation=None):
+        if self.step == len(self.program):
+            return {"answer": observation}
+        step = self.program[self.step]
+        self.step += 1
+        return {"name": step["function"], "dependencies": step.get("dependencies", []), "inputs": step.get("inputs", [])}
+
+
+async def run_agent(llm, client):
+    """ agent 循环：LLM 给出工具调用 -> 服务执行 -> 把结果作为观察返回给 LLM，直到给出答案 """
+    observations = []
+    observation = None
+    while True:
+        action = llm.chat(observation)
+        if "answer" in action:
+            return action["answer"]
+        handles = [observations[d]["handle"] for d in action["dependencies"]]
+        status, response = await client.call(action["name"], handles, action["inputs"])
+        if status != 200:
+            return {"error": response["error"]}
+        observations.append(response)
+        observation = response["result"]
+
+
+def test():
+    import os
+    import tempfile
+    from basic_kopl import engine
+
+    program = [
+        {"function": "FindAll", "dependencies": [], "inputs": []},
+        {"function": "FilterConcept", "dependencies": [0], "inputs": ["athlete"]},
+        {"function": "FilterNum", "dependencies": [1], "inputs": ["height", "200 centimetre", ">"]},
+        {"function": "Find", "dependencies": [], "inputs": ["LeBron James Jr."]},
+        {"function": "Relate", "dependencies": [3], "inputs": ["father", "forward"]},
+        {"function": "FilterConcept", "dependencies": [4], "inputs": ["athlete"]},
+        {"function": "Or", "dependencies": [2, 5], "inputs": []},
+        {"function": "Count", "dependencies": [6], "inputs": []}
+    ]
+    programs = [program, program[:3], program[:5]] * 10
+
+    async def main():
+        path = os.path.join(tempfile.mkdtemp(), "kopl.sock")
+        server = KoPLServer(engine, workers=2, max_pending=16)
+        await server.start(path=path)
+        client = KoPLClient(path=path)
+        print(await client.health())
+        answers = await asyncio.gather(*(run_agent(MockLLM(p), client) for p in programs))
+        results = await asyncio.gather(*(client.run_program(p) for p in programs))
+        print(answers[:3])
+        print([r for _, r in results[:3]])
+        print(await client.run_batch(programs[:3]))
+        # 只需要第一个名字时，What 只转换一个实体
+        print(await client.run_program(program[:3] + [{"function": "What", "dependencies": [2], "inputs": []}], limit=1))
+        # 点号形式的 kopl 字符串
+        print(await client.run_program("Find(LeBron James).QueryAttr(height)"))
+        print(await client.run_program("Find(LeBron James).Bogus()"))
+        print(await client.health())
+        await server.close()
+
+        # 带预算的服务：超出时返回 budget_exceeded，说明是哪一步
+        path = os.path.join(tempfile.mkdtemp(), "kopl.sock")
+        server = KoPLServer(engine, ProgramExecutor(engine, budget=Budget(max_seconds=1.0, max_set_size=1)), workers=2)
+        await server.start(path=path)
+        client = KoPLClient(path=path)
+        print(await client.run_program("Find(LeBron James).Find(LeBron James Jr.).Or().Count()"))
+        print(await client.run_program("Find(LeBron James).QueryAttr(height)"))
+        await server.close()
+
+        # fork 出来的进程池执行 /program 和 /batch，结果与线程池一致，单步调用仍然在主进程
+        path = os.path.join(tempfile.mkdtemp(), "kopl.sock")
+        server = KoPLServer(engine, workers=2, processes=2)
+        await server.start(path=path)
+        client = KoPLClient(path=path)
+        forked = await asyncio.gather(*(client.run_program(p) for p in programs))
+        print([r["result"] for _, r in forked] == [r["result"] for _, r in results])
+        print((await client.run_batch(programs[:3]))[1]["report"])
+        print(await run_agent(MockLLM(program), client))
+        await server.close()
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", default=None, help="监听 Unix socket 而不是 TCP 端口")
+    parser.add_argument("--workers", type=int, default=4, help="线程数，只用来不阻塞事件循环")
+    parser.add_argument("--processes", type=int, default=0, help="/program 和 /batch 并行执行的进程数")
+    parser.add_argument("--max-pending", type=int, default=256)
+    parser.add_argument("--fuzzy-find", action="store_true", help="Find 的名字不存在时退回到模糊匹配")
+    parser.add_argument("--max-seconds", type=float, default=None, help="每个 program 的耗时上限")
+    parser.add_argument("--max-set-size", type=int, default=None, help="每个中间结果的大小上限")
+    args = parser.parse_args()
+
+    from convert_program_to_executable import engine
+    executor = None
+    if args.fuzzy_find or args.max_seconds is not None or args.max_set_size is not None:
+        name_index = None
+        if args.fuzzy_find:
+            from name_index import NameIndex
+            name_index = NameIndex(engine)
+        budget = None
+        if args.max_seconds is not None or args.max_set_size is not None:
+            budget = Budget(args.max_seconds, args.max_set_size)
+        executor = ProgramExecutor(engine, name_index=name_index, budget=budget)
+    server = KoPLServer(engine, executor, workers=args.workers, processes=args.processes, max_pending=args.max_pending)
+    asyncio.run(server.serve_forever(args.host, args.port, args.unix))
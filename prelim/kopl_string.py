@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# @File    :   kopl_string.py
+# @Time    :   2026/10/18 19:36:52
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+KQA 数据中 kopl 字段（以及模型常输出的）点号串联形式的解析，例如
+    Find(DeKalb County).FilterStr(PermID,5037043580).Find(Boulder County).Or().Select(area,smallest,1,0).What()
+
+一趟扫描，用栈确定依赖：每个函数从栈顶弹出它需要的实体集合个数（Find / FindAll 为 0，
+And / Or / QueryRelation / QueryRelationQualifier 为 2，其余为 1），结果压栈。
+Select(key, op, 1, 0) 在 KQA 中有两种含义：
+    紧跟在 Or() 之后   ->  SelectBetween(Or 的两个输入, key, greater/less)，Or 本身被吸收
+    其他情况           ->  SelectAmong(栈顶, key, largest/smallest)
+二者的结果已经是名字，后面的 What() 被吸收。得到的步骤与 program 字段完全一致，
+交给 compile_kopl 就是 ProgramExecutor 的执行计划，不生成 Python 代码也不 eval。
+'''
+import re
+from functools import lru_cache
+
+# 函数名 -> (inputs 个数, 逗号多出来时并入哪个 input, 从栈上取的依赖个数)
+# 名字、属性值中可能有逗号，而 key / op / direction 没有，多出来的逗号都归到值所在的位置
+KOPL_SIGNATURES = {
+    "FindAll": (0, 0, 0),
+    "Find": (1, 0, 0),
+    "FilterConcept": (1, 0, 1),
+    "FilterStr": (2, 1, 1),
+    "FilterNum": (3, 1, 1),
+    "FilterYear": (3, 1, 1),
+    "FilterDate": (3, 1, 1),
+    "QFilterStr": (2, 1, 1),
+    "QFilterNum": (3, 1, 1),
+    "QFilterYear": (3, 1, 1),
+    "QFilterDate": (3, 1, 1),
+    "Relate": (2, 0, 1),
+    "And": (0, 0, 2),
+    "Or": (0, 0, 2),
+    "Count": (0, 0, 1),
+    "What": (0, 0, 1),
+    "QueryName": (0, 0, 1),
+    "QueryAttr": (1, 0, 1),
+    "QueryAttrUnderCondition": (3, 2, 1),
+    "QueryAttrQualifier": (3, 1, 1),
+    "QueryRelation": (0, 0, 2),
+    "QueryRelationQualifier": (2, 0, 2),
+    "VerifyStr": (1, 0, 1),
+    "VerifyNum": (2, 0, 1),
+    "VerifyYear": (2, 0, 1),
+    "VerifyDate": (2, 0, 1),
+    "Select": (4, 0, 1),
+    # program 中的写法，模型有时直接输出
+    "SelectBetween": (2, 0, 2),
+    "SelectAmong": (2, 0, 1),
+}
+
+# Select 的 op 在 SelectBetween 中的写法
+BETWEEN_OPS = {"largest": "greater", "smallest": "less"}
+
+# 相邻两步之间的 ")."，后面必须是一个函数名和左括号，名字里的 "(Mo.)." 之类不会被切开
+_STEP_SPLIT = re.compile(r"\)\.(?=[A-Z][A-Za-z]*\()")
+
+
+@lru_cache(maxsize=65536)
+def _parse_step(part):
+    """
+    解析一步，例如 "FilterStr(PermID,5037043580"（右括号已经去掉）；
+    FilterConcept(human)、What() 之类在不同 program 中大量重复，所以缓存
+
+    Returns:
+        tuple: (function, inputs, 依赖个数)，Select 的 inputs 只保留 (key, op)
+    """
+    function, paren, args = part.partition("(")
+    sig = KOPL_SIGNATURES.get(function)
+    if sig is None or not paren:
+        raise ValueError(f"unknown function {function!r}: {part!r}")
+    n_inputs, absorb, n_deps = sig
+
+    if n_inputs == 0:
+        if args.strip():
+            raise ValueError(f"{function} takes no inputs: {part!r}")
+        inputs = ()
+    elif n_inputs == 1:
+        inputs = (args.strip(),)
+    else:
+        items = args.split(",")
+        extra = len(items) - n_inputs
+        if extra < 0:
+            raise ValueError(f"{function} takes {n_inputs} inputs: {part!r}")
+        if extra:
+            items[absorb:absorb + extra + 1] = [",".join(items[absorb:absorb + extra + 1])]
+        inputs = tuple(map(str.strip, items))
+
+    if function == "Select":
+        key, op, top_k, start = inputs
+        if op not in BETWEEN_OPS or top_k != "1" or start != "0":
+            raise ValueError(f"only Select(key,largest|smallest,1,0) is supported: {part!r}")
+        inputs = (key, op)
+    return function, inputs, n_deps
+
+
+def parse_steps(text):
+    """
+    Returns:
+        list: [(function, dependencies, inputs)]，dependencies 和 inputs 都是 tuple
+
+    Raises:
+        ValueError: 未知的函数、参数个数不对、栈上的实体集合不够等
+    """
+    parts = _STEP_SPLIT.split(text.strip())
+    last = parts[-1]
+    if not last.endswith(")"):
+        raise ValueError(f"kopl should end with ')': {text!r}")
+    parts[-1] = last[:-1]
+
+    steps = []
+    stack = []
+    for part in parts:
+        function, inputs, n_deps = _parse_step(part)
+        top = len(steps) - 1
+        if function == "What" and steps and stack[-1] == top and steps[top][0] in ("SelectBetween", "SelectAmong"):
+            continue
+        if function == "Select":
+            if stack and stack[-1] == top and steps[top][0] == "Or":
+                # 取代刚才的 Or，沿用它的两个输入和下标
+                deps = steps.pop()[1]
+                steps.append(("SelectBetween", deps, (inputs[0], BETWEEN_OPS[inputs[1]])))
+                continue
+            function = "SelectAmong"
+
+        if n_deps == 1:
+            if not stack:
+                raise ValueError(f"{function} needs an entity set on the stack: {text!r}")
+            deps = (stack.pop(),)
+        elif n_deps:
+            if len(stack) < n_deps:
+                raise ValueError(f"{function} needs {n_deps} entity sets on the stack: {text!r}")
+            deps = tuple(stack[-n_deps:])
+            del stack[-n_deps:]
+        else:
+            deps = ()
+        stack.append(len(steps))
+        steps.append((function, deps, inputs))
+    return steps
+
+
+def parse_kopl(text):
+    """ 点号形式 -> 与 KQA 的 program 字段相同的 [{"function", "dependencies", "inputs"}] """
+    return [
+        {"function": function, "dependencies": list(deps), "inputs": list(inputs)}
+        for function, deps, inputs in parse_steps(text)
+    ]
+
+
+def test():
+    for text in [
+        "Find(DeKalb County).FilterStr(PermID,5037043580).Find(Boulder County).Or().Select(area,smallest,1,0).What()",
+        "FindAll().FilterConcept(human).Select(height,largest,1,0).What()",
+        "Find(LeBron James).QueryAttrQualifier(member of sports team,Cleveland Cavaliers,start time)",
+    ]:
+        print(text)
+        for i, step in enumerate(parse_kopl(text)):
+            print(f"  {i}: {step}")
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# @File    :   name_index.py
+# @Time    :   2026/10/18 18:20:44
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+实体名字的模糊索引，给 LLM 生成的 Find 兜底
+
+LLM 写出的名字经常和 KB 中的标签只差大小写、标点、重音符号或者 "Jr." 之类的后缀，
+引擎的 Find 只做精确匹配，于是返回空集合。这里对所有名字（与 Find 一样来自 kb.name_to_id）
+先做规范化（NFKD 去重音、casefold、标点换成空格），再建字符 3-gram 的倒排表。
+
+查询时按 Dice 系数 2|A∩B| / (|A|+|B|) 排序。相似度至少为 t 的名字与查询至少共享
+m = ceil(t * |A| / (2 - t)) 个 3-gram，所以只需要从倒排表最短的 |A| - m + 1 个
+3-gram 中取候选（prefix filtering），再按 3-gram 个数过滤长度不可能达到阈值的名字，
+剩下的少量候选才逐个计算相似度，不需要扫描所有名字。
+倒排表从短到长处理，找到 top_k 个结果之后 t 提高到第 top_k 高的相似度，需要的倒排表随之变少，
+一般只需要看几个很短的倒排表。
+'''
+import re
+import math
+import heapq
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, Counter
+
+
+def normalize(name):
+    """ 去掉重音符号，casefold，标点和连续空白换成一个空格 """
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(ch for ch in name if not unicodedata.combining(ch)).casefold()
+    return " ".join(re.sub(r"[\W_]+", " ", name).split())
+
+
+def ngrams(text, n=3):
+    """ 首尾补空格之后的字符 n-gram 集合 """
+    if not text:
+        return set()
+    padded = f" {text} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+class NameIndex:
+    """
+    Args:
+        engine (KoPLEngine): 要建索引的引擎
+        n (int): n-gram 的长度
+        min_score (float): 默认的最低相似度
+    """
+
+    # 还需要验证的倒排表元素超过这个数时改用 _scan_count
+    SCAN_COUNT_SIZE = 2000
+
+    def __init__(self, engine, n=3, min_score=0.5):
+        self.kb = engine.kb
+        self.n = n
+        self.min_score = min_score
+        entries = []
+        for name, ids in self.kb.name_to_id.items():
+            if ids:
+                norm = normalize(name)
+                entries.append((len(ngrams(norm, n)), name, norm))
+        # 名字按 n-gram 个数排序编号，倒排表中同样按个数有序，长度过滤就是二分出来的一段
+        entries.sort(key=lambda x: x[0])
+        self.names = [name for _, name, _ in entries]    # 名字下标 -> KB 中的原名
+        self.norms = [norm for _, _, norm in entries]    # 名字下标 -> 规范化之后的名字
+        self.by_norm = defaultdict(list)                 # 规范化之后的名字 -> 名字下标
+        self.gram_ids = {}                               # n-gram -> 整数 id
+        # 每个名字的 n-gram id 首尾相接存放，name_ptr[i]:name_ptr[i+1] 是第 i 个名字的
+        self.name_grams = array("I")
+        self.name_ptr = array("L", [0])
+        # size_start[s]: 第一个 n-gram 个数不小于 s 的名字下标
+        self.size_start = array("L")
+        postings = []                                    # n-gram id -> 名字下标
+        for i, (size, _, norm) in enumerate(entries):
+            while len(self.size_start) <= size:
+                self.size_start.append(i)
+            self.by_norm[norm].append(i)
+            for gram in ngrams(norm, n):
+                g = self.gram_ids.get(gram)
+                if g is None:
+                    g = self.gram_ids[gram] = len(postings)
+                    postings.append([])
+                postings[g].append(i)
+                self.name_grams.append(g)
+            self.name_ptr.append(len(self.name_grams))
+        self.size_start.append(len(entries))
+        self.postings = [array("I", items) for items in postings]
+
+    @staticmethod
+    def _min_overlap(t, q):
+        """ Dice >= t 要求与查询至少共享 ceil(t*|A|/(2-t)) 个 n-gram，减去 1e-9 避免浮点误差把恰好等于 t 的排除 """
+        return max(1, math.ceil(t * q / (2 - t) - 1e-9))
+
+    def _size_range(self, t, q):
+        """ Dice >= t 要求 t/(2-t) * |A| <= |B| <= (2-t)/t * |A|，返回满足的名字下标区间 """
+        last = len(self.size_start) - 1
+        lo = min(math.ceil(t / (2 - t) * q - 1e-9), last)
+        hi = min(math.floor((2 - t) / t * q + 1e-9) + 1, last)
+        return self.size_start[lo], self.size_start[hi]
+
+    def _scan_count(self, lists, q, t, start, end):
+        """ Returns: {名字下标: 相似度}，名字下标在 [start, end) 中、相似度不低于 t 的所有名字 """
+        counts = Counter()
+        for items in lists:
+            counts.update(items[bisect_left(items, start):bisect_left(items, end)])
+        ptr = self.name_ptr
+        m = self._min_overlap(t, q)
+        scored = {}
+        for i, c in counts.items():
+            if c >= m:
+                score = 2 * c / (q + ptr[i + 1] - ptr[i])
+                if score >= t:
+                    scored[i] = score
+        return scored
+
+    def _top(self, query, top_k, min_score):
+        """
+        Returns:
+            dict: {名字下标: 相似度}，一定包含相似度最高的 top_k 个名字（以及与第 top_k 个并列的），
+                可能还有一些更低的
+        """
+        norm = normalize(query)
+        grams = ngrams(norm, self.n)
+        scored = {i: 1.0 for i in self.by_norm.get(norm, ())}
+        if not grams:
+            return scored
+        q = len(grams)
+        qids = {self.gram_ids[g] for g in grams if g in self.gram_ids}
+        lists = sorted((self.postings[g] for g in qids), key=len)
+        ptr, name_grams = self.name_ptr, self.name_grams
+        # 当前第 top_k 高的相似度，凑够 top_k 个之后阈值 t 随之升高
+        heap = [1.0] * min(len(scored), top_k)
+        t = heap[0] if len(heap) == top_k else min_score
+        seen = set(scored)
+        j = 0
+        # prefix filtering：相似度至少为 t 的名字与查询至少共享 m = ceil(t*|A|/(2-t)) 个 n-gram，
+        # 所以一定出现在最短的 len(qids) - m + 1 个倒排表中（KB 中没有的 n-gram 不会被共享）
+        while True:
+            prefix = len(qids) - self._min_overlap(t, q) + 1
+            if j >= prefix:
+                break
+            start, end = self._size_range(t, q)
+            # 还差不止一个结果、阈值短期内升不上去，而剩下的候选又很多时，逐个验证太慢，
+            # 改成用 Counter 数出每个名字与查询共享的 n-gram 个数（需要遍历所有倒排表）；
+            # 只差一个时（例如 find），下一个达到阈值的候选就会让 t 升高、需要的倒排表变少
+            if top_k - len(heap) > 1 and sum(map(len, lists[j:prefix])) > self.SCAN_COUNT_SIZE:
+                scored.update(self._scan_count(lists, q, t, start, end))
+                break
+            items = lists[j]
+            new = set(items[bisect_left(items, start):bisect_left(items, end)])
+            new.difference_update(seen)
+            seen.update(new)
+            for i in new:
+                a, b = ptr[i], ptr[i + 1]
+                score = 2 * len(qids.intersection(name_grams[a:b])) / (q + b - a)
+                if score < t:
+                    continue
+                scored[i] = score
+                if len(heap) < top_k:
+                    heapq.heappush(heap, score)
+                elif score > heap[0]:
+                    heapq.heapreplace(heap, score)
+                if len(heap) == top_k and heap[0] > t:
+                    t = heap[0]
+            j += 1
+        return scored
+
+    def search(self, query, top_k=10, min_score=None):
+        """
+        Args:
+            query (str): 要找的名字
+            top_k (int): 最多返回的实体个数
+            min_score (float): 最低相似度，默认用构造时的 min_score
+
+        Returns:
+            list: [(entity id, KB 中的名字, 相似度)]，按相似度从高到低排列；
+                规范化之后完全相同的名字相似度为 1.0
+        """
+        min_score = self.min_score if min_score is None else min_score
+        scored = self._top(query, top_k, min_score)
+        # 相似度相同时，长度更接近查询的名字优先
+        length = len(normalize(query))
+        best = heapq.nsmallest(
+            top_k, scored.items(), key=lambda x: (-x[1], abs(len(self.norms[x[0]]) - length), x[0])
+        )
+        results = []
+        for i, score in best:
+            name = self.names[i]
+            for ent_id in self.kb.name_to_id[name]:
+                results.append((ent_id, name, score))
+        return results[:top_k]
+
+    def find(self, name):
+        """
+        Find 的替代：名字精确存在时与 Find 相同，否则返回相似度最高的名字（并列时全部）对应的实体
+
+        Returns:
+            tuple: (entity_ids, None)，没有足够相似的名字时实体列表为空
+        """
+        # name_to_id 是 defaultdict，用 get 避免插入空的 key
+        name_to_id = self.kb.name_to_id
+        entity_ids = name_to_id.get(name)
+        if entity_ids:
+            return (entity_ids, None)
+        scored = self._top(name, 1, self.min_score)
+        if not scored:
+            return ([], None)
+        top = max(scored.values())
+        return ([ent_id for i in sorted(scored) if scored[i] == top for ent_id in name_to_id[self.names[i]]], None)
+
+
+def test():
+    import time
+    from basic_kopl import engine
+    index = NameIndex(engine)
+    for query in ["LeBron James", "lebron james jr", "LeBron James, Jr.", "Lebron Jmes", "Cleveland Cavs", "nothing like it"]:
+        start = time.perf_counter()
+        hits = index.search(query, top_k=3)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{query!r}: {hits} ({elapsed:.3f} ms)")
+        print("  find:", index.find(query))
+
+
+if __name__ == "__main__":
+    test()
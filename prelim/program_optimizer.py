@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# @File    :   program_optimizer.py
+# @Time    :   2026/10/18 13:20:05
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+基于代价的 program 优化：按选择度重排连续的过滤步骤，以及嵌套的 And
+
+FilterConcept / FilterStr / FilterNum / FilterYear / FilterDate 都先对输入实体去重，
+再判断每个实体是否满足条件，所以一条过滤链最终留下的实体集合与过滤顺序无关。
+但最后一个过滤决定了输出的三元组和实体的重复次数（一个实体有多个满足条件的属性时会出现多次），
+因此只有当链的消费者本身会去重且不看三元组（And / Or / Relate / 另一个过滤 ...）时，
+整条链才能任意重排；否则最后一个过滤保持不动，只重排它前面的。
+
+And 是集合交集，满足交换律和结合律，输出的三元组总是 None。由 And 组成的树（内部的 And 只被上一层 And 使用）
+有三个以上输入时，重新组织成左深树，在步骤顺序允许的范围内（每个 And 只能使用排在它前面的输入）
+让估计基数最小的输入先求交，中间结果尽量小；
+只有两个输入的 And 交换顺序没有收益（两边都要建 set），不做改动。
+输出实体列表的顺序来自 set 的遍历，可能改变，所以与过滤链一样，只在消费者不关心顺序时重排。
+'''
+from collections import defaultdict
+
+FILTERS = {"FilterConcept", "FilterStr", "FilterNum", "FilterYear", "FilterDate"}
+
+# 这些算子对输入实体先去重、并且不使用输入的三元组
+SET_CONSUMERS = FILTERS | {"And", "Or", "Relate", "SelectAmong"}
+
+# And 树的输出只被这些算子使用时才重排（And 的结果已经去重，Count 不受顺序影响）
+AND_CONSUMERS = SET_CONSUMERS | {"Count"}
+
+# 没有统计信息可用时，范围比较默认保留三分之一
+RANGE_SELECTIVITY = 1 / 3
+
+
+class ProgramOptimizer:
+    """
+    从 KB 收集每个属性键、每个概念的基数统计，用来估计过滤的选择度
+    """
+
+    def __init__(self, engine):
+        kb = engine.kb
+        self.num_entities = max(len(kb.entities), 1)
+        # attribute key -> 拥有该属性的实体数
+        self.key_entities = {k: len(v) for k, v in kb.attribute_inv_index.items()}
+        # attribute key -> 不同取值的个数（含修饰值，作为估计足够）
+        self.key_distinct = {k: len(v) for k, v in kb.key_values.items()}
+        # concept name -> 实体数（含子概念）
+        self.concept_entities = defaultdict(int)
+        for cid, members in kb.concept_to_entity.items():
+            name = kb.entities[cid]['name'] if cid in kb.entities else cid
+            self.concept_entities[name] += len(members)
+
+    def estimate(self, function, inputs):
+        """ 估计一个过滤作用在 FindAll() 上时留下的实体数 """
+        if function == "FilterConcept":
+            return self.concept_entities.get(inputs[0], 0)
+        key = inputs[0]
+        holders = self.key_entities.get(key, 0)
+        distinct = max(self.key_distinct.get(key, 1), 1)
+        op = "=" if function == "FilterStr" else inputs[2]
+        if op == "=":
+            return holders / distinct
+        if op == "!=":
+            return holders
+        return holders * RANGE_SELECTIVITY
+
+    def cardinality(self, program, i, memo=None):
+        """ 粗略估计步骤 i 输出的实体数，用来给 And 的输入排序；无法估计的算子按整个 KB 计 """
+        memo = {} if memo is None else memo
+        if i in memo:
+            return memo[i]
+        step = program[i]
+        function, deps = step["function"], step.get("dependencies", [])
+        if function == "Find":
+            est = 1
+        elif function in FILTERS:
+            est = min(self.cardinality(program, deps[0], memo), self.estimate(function, step["inputs"]))
+        elif function == "And":
+            est = min(self.cardinality(program, d, memo) for d in deps)
+        elif function == "Or":
+            est = min(sum(self.cardinality(program, d, memo) for d in deps), self.num_entities)
+        else:
+            est = self.num_entities
+        memo[i] = est
+        return est
+
+    def find_and_trees(self, program):
+        """
+        找出所有可以重排的 And 树
+
+        Returns:
+            list: [(and_slots, leaves)]，and_slots 是树中 And 步骤的下标（升序），leaves 是输入步骤的下标
+        """
+        consumers = defaultdict(list)
+        for i, step in enumerate(program):
+            for d in step.get("dependencies", []):
+                consumers[d].append(i)
+
+        def inner(i):
+            # And 步骤 i 只被一个 And 使用，是那个 And 所在树的一部分
+            return (program[i]["function"] == "And" and len(consumers[i]) == 1
+                    and program[consumers[i][0]]["function"] == "And")
+
+        trees = []
+        for root, step in enumerate(program):
+            if step["function"] != "And" or inner(root):
+                continue
+            if not consumers[root] or any(program[c]["function"] not in AND_CONSUMERS for c in consumers[root]):
+                continue
+            slots, leaves, stack = [], [], [root]
+            while stack:
+                i = stack.pop()
+                if i != root and not inner(i):
+                    leaves.append(i)
+                    continue
+                slots.append(i)
+                stack.extend(program[i]["dependencies"])
+            if len(leaves) >= 3:
+                trees.append((sorted(slots), sorted(leaves)))
+        return trees
+
+    def _and_order(self, program, slots, leaves):
+        """
+        Returns:
+            list: 每个 And 位置上的 (左输入, 右输入)；左深树，估计基数小的输入先求交，
+                每个位置只使用下标比它小的输入，保证仍是拓扑序
+        """
+        memo = {}
+        size = {i: self.cardinality(program, i, memo) for i in leaves}
+        pending = sorted(leaves)
+        available = []
+        deps = []
+        prev = None
+        for slot in slots:
+            while pending and pending[0] < slot:
+                available.append(pending.pop(0))
+            # 原来的树里前 k 个 And 位置之前至少有 k + 1 个输入，这里总能取到
+            available.sort(key=lambda i: (size[i], i))
+            if prev is None:
+                left, right = available.pop(0), available.pop(0)
+            else:
+                left, right = prev, available.pop(0)
+            deps.append((left, right))
+            prev = slot
+        return deps
+
+    def find_chains(self, program):
+        """
+        找出所有过滤链，每条链是按依赖顺序排列的步骤下标列表；
+        链内除最后一步外，每一步只被下一步使用
+
+        Returns:
+            list: [(chain, pinned)]，pinned 表示最后一步必须保持在最后
+        """
+        consumers = defaultdict(list)
+        for i, step in enumerate(program):
+            for d in step.get("dependencies", []):
+                consumers[d].append(i)
+
+        def continues(i):
+            # 步骤 i 是过滤，且它唯一的消费者也是过滤
+            if program[i]["function"] not in FILTERS or len(consumers[i]) != 1:
+                return False
+            return program[consumers[i][0]]["function"] in FILTERS
+
+        chains = []
+        for i, step in enumerate(program):
+            if step["function"] not in FILTERS:
+                continue
+            deps = step.get("dependencies", [])
+            if deps and continues(deps[0]):
+                continue  # 不是链的开头
+            chain = [i]
+            while continues(chain[-1]):
+                chain.append(consumers[chain[-1]][0])
+            if len(chain) < 2:
+                continue
+            tail_consumers = consumers[chain[-1]]
+            pinned = not tail_consumers or any(
+                program[c]["function"] not in SET_CONSUMERS for c in tail_consumers
+            )
+            chains.append((chain, pinned))
+        return chains
+
+    def _order(self, program, chain, pinned):
+        movable = chain[:-1] if pinned else chain
+        order = sorted(movable, key=lambda i: self.estimate(program[i]["function"], program[i]["inputs"]))
+        return order + [chain[-1]] if pinned else order
+
+    def optimize(self, program):
+        """
+        Returns:
+            list: 重排之后的新 program，步骤数和下标不变，每条链的最后一个位置仍是链的输出
+        """
+        chains = self.find_chains(program)
+        trees = self.find_and_trees(program)
+        if not chains and not trees:
+            return program
+        new_program = [dict(step) for step in program]
+        for chain, pinned in chains:
+            order = self._order(program, chain, pinned)
+            base = program[chain[0]].get("dependencies", [])
+            prev = None
+            # 链上的位置不变，只是把过滤条件按新顺序重新放到这些位置上
+            for slot, src in zip(chain, order):
+                new_program[slot] = {
+                    "function": program[src]["function"],
+                    "dependencies": list(base) if prev is None else [prev],
+                    "inputs": list(program[src]["inputs"]),
+                }
+                prev = slot
+        # And 树的输入步骤不变，只改 And 步骤的依赖；基数按过滤链重排之后的 program 估计
+        for slots, leaves in trees:
+            for slot, (left, right) in zip(slots, self._and_order(new_program, slots, leaves)):
+                new_program[slot] = {"function": "And", "dependencies": [left, right], "inputs": []}
+        return new_program
+
+    def explain(self, program):
+        """ 每条过滤链的原顺序、估计的基数和选中的顺序 """
+        lines = []
+        for chain, pinned in self.find_chains(program):
+            order = self._order(program, chain, pinned)
+
+            def describe(i):
+                step = program[i]
+                est = self.estimate(step["function"], step["inputs"])
+                return f"  [{i}] {step['function']}{tuple(step['inputs'])}  est={est:.1f}"
+
+            lines.append(f"filter chain {chain}" + (" (last step pinned)" if pinned else ""))
+            lines.append(" original:")
+            lines.extend(describe(i) for i in chain)
+            lines.append(" chosen:")
+            lines.extend(describe(i) for i in order)
+        memo = {}
+        for slots, leaves in self.find_and_trees(program):
+            lines.append(f"and tree {slots}")
+            lines.append(" inputs:")
+            lines.extend(
+                f"  [{i}] {program[i]['function']}{tuple(program[i].get('inputs', []))}  est={self.cardinality(program, i, memo):.1f}"
+                for i in leaves
+            )
+            lines.append(" chosen:")
+            lines.extend(f"  [{slot}] And{pair}" for slot, pair in zip(slots, self._and_order(program, slots, leaves)))
+        if not lines:
+            lines.append("no reorderable filter chains or and trees")
+        return "\n".join(lines)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# @File    :   split_store.py
+# @Time    :   2026/10/18 16:52:30
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+KQA 数据集（train.json / val_3k.json / test_8k.json ...）的列式存储
+
+train.json 有 9 万多条，每条都带 program / sparql / cypher / graphq_ir / lambda-dcs 等字段，
+而大部分脚本只用到 program 和 answer。这里把一个 split 一次性转换成一个目录（<split>.cols），
+每个字段一列，每列两个文件：
+    colK.bin  每行的值 json 编码之后首尾相接，这一行没有该字段时长度为 0
+    colK.idx  uint64 的偏移数组，共 n + 1 个
+meta.json 记录行数、字段名到文件的映射，以及源文件的大小 / 修改时间 / sha1。
+打开时只读 meta.json，每列在第一次访问时才 mmap，每个值在被访问时才 json 解码，
+所以加载一个 split 只需要几毫秒，脚本只为用到的列付出代价。
+'''
+import os
+import json
+import mmap
+from array import array
+from collections.abc import Sequence
+from engine_snapshot import kb_fingerprint
+
+FORMAT_VERSION = 1
+
+
+def store_path(json_path):
+    return os.path.splitext(json_path)[0] + ".cols"
+
+
+def convert_split(json_path, out_dir=None):
+    """
+    把一个 json 格式的 split 转换成列式存储（只需要运行一次）
+
+    Returns:
+        str: 输出目录
+    """
+    out_dir = out_dir or store_path(json_path)
+    with open(json_path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    fields = []
+    for item in data:
+        for k in item:
+            if k not in fields:
+                fields.append(k)
+
+    tmp_dir = out_dir + ".tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    files = {}
+    for k, name in enumerate(fields):
+        files[name] = f"col{k}"
+        offsets = array("Q", [0])
+        with open(os.path.join(tmp_dir, f"col{k}.bin"), "wb") as f:
+            for item in data:
+                if name in item:
+                    payload = json.dumps(item[name], ensure_ascii=False).encode("utf-8")
+                    f.write(payload)
+                    offsets.append(offsets[-1] + len(payload))
+                else:
+                    offsets.append(offsets[-1])
+        with open(os.path.join(tmp_dir, f"col{k}.idx"), "wb") as f:
+            offsets.tofile(f)
+
+    stat = os.stat(json_path)
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "rows": len(data),
+        "fields": files,
+        "source": os.path.abspath(json_path),
+        "source_size": stat.st_size,
+        "source_mtime": stat.st_mtime,
+        "source_sha1": kb_fingerprint(json_path),
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    # 整个目录写完再替换，避免留下写了一半的列
+    if os.path.exists(out_dir):
+        import shutil
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def _mmap(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Column(Sequence):
+    """ 一列数据，值在被访问时才解码；没有该字段的行返回 default """
+
+    def __init__(self, base, rows, default=None):
+        self._base = base
+        self._rows = rows
+        self.default = default
+        self._buf = None
+        self._offsets = None
+
+    def _open(self):
+        self._buf = _mmap(self._base + ".bin")
+        self._offsets = memoryview(_mmap(self._base + ".idx")).cast("Q")
+
+    def has(self, i):
+        if self._buf is None:
+            self._open()
+        return self._offsets[i + 1] > self._offsets[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._rows))]
+        if i < 0:
+            i += self._rows
+        if self._buf is None:
+            self._open()
+        start, end = self._offsets[i], self._offsets[i + 1]
+        if start == end:
+            return self.default
+        return json.loads(self._buf[start:end])
+
+    def __len__(self):
+        return self._rows
+
+
+class SplitStore(Sequence):
+    """
+    按行访问时返回只包含 fields 的 dict，与 load_json 得到的 list 用法一样；
+    也可以用 store.column(name) 直接按列访问
+    """
+
+    def __init__(self, path, fields=None):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.rows = self.meta["rows"]
+        self.fields = list(fields) if fields is not None else list(self.meta["fields"])
+        missing = [name for name in self.fields if name not in self.meta["fields"]]
+        if missing:
+            raise KeyError(f"fields {missing} not in {path}")
+        self._columns = {}
+
+    def column(self, name):
+        col = self._columns.get(name)
+        if col is None:
+            col = self._columns[name] = Column(os.path.join(self.path, self.meta["fields"][name]), self.rows)
+        return col
+
+    def select(self, fields):
+        """ 换一组字段，共享已经打开的列 """
+        view = SplitStore.__new__(SplitStore)
+        view.__dict__.update(self.__dict__)
+        view.fields = list(fields)
+        return view
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.rows))]
+        if i < 0:
+            i += self.rows
+        row = {}
+        for name in self.fields:
+            col = self.column(name)
+            if col.has(i):
+                row[name] = col[i]
+        return row
+
+    def __len__(self):
+        return self.rows
+
+
+def is_stale(path, json_path):
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return True
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format_version") != FORMAT_VERSION:
+        return True
+    stat = os.stat(json_path)
+    if stat.st_size == meta["source_size"] and stat.st_mtime == meta["source_mtime"]:
+        return False
+    return kb_fingerprint(json_path) != meta["source_sha1"]
+
+
+def load_split(json_path, fields=None):
+    """
+    load_json 的替代：第一次调用时转换成列式存储，之后直接打开；源文件变了会重新转换
+
+    列式存储写在源文件旁边（<split>.cols），只用于本项目自己的、会反复读取的 split；
+    只运行一次的转换脚本和其他项目目录下的文件直接用 load_json
+
+    Args:
+        json_path (str): 原来的 json 文件
+        fields (list): 只需要的字段，例如 ["program", "answer"]，默认全部
+
+    Returns:
+        SplitStore
+    """
+    path = store_path(json_path)
+    if is_stale(path, json_path):
+        convert_split(json_path, path)
+    return SplitStore(path, fields)
+
+
+if __name__ == "__main__":
+    import time
+    for file in [
+        "/home/qing/raid/paperwork/kgtool/data/kqa/split/val_3k.json",
+        "/home/qing/raid/paperwork/kgtool/data/kqa/split/test_8k.json",
+        "/home/qing/raid/paperwork/kgtool/data/kqa/full/train.json",
+    ]:
+        convert_split(file)
+        t = time.time()
+        data = load_split(file, ["program", "answer"])
+        print(f"{file}: {len(data)} rows opened in {time.time() - t:.4f}s")
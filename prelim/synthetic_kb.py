@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+# @File    :   synthetic_kb.py
+# @Time    :   2026/10/18 15:21:44
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+按给定规模生成与 kb.json 相同 schema 的合成 KB（concepts / entities / attributes / relations / qualifiers），
+以及在这个 KB 上可以执行的随机 program，用来测量不同规模（10^3 ~ 10^7 个实体）下的吞吐量
+
+- 确定性：每个实体的内容只由 (seed, 实体下标) 决定，可以随时单独重新生成，不需要把整个 KB 放在内存里
+- 度分布有偏：出度服从 Pareto 分布，关系的目标实体、概念、属性键都偏向下标小的那些
+- 四种值类型 string / quantity / year / date 都有，属性和关系上会随机带 qualifier
+- 流式写出：正向关系在生成实体时直接写出；反向关系（backward）先按目标实体分块排序写到临时文件，
+  写实体时再归并读回，内存只和 chunk_edges 有关
+'''
+import os
+import json
+import heapq
+import random
+import struct
+import datetime
+import tempfile
+
+TYPES = ["string", "quantity", "year", "date"]
+UNITS = ["1", "metre", "kilogram", "second", "square kilometre", "year"]
+QUALIFIER_KEYS = [("point in time", "date"), ("start time", "year"), ("rank", "quantity"), ("role", "string")]
+
+# 反向关系在临时文件中的记录：目标实体、源实体、关系、qualifier 种子
+EDGE = struct.Struct("<qqiq")
+
+DATE_START = datetime.date(1800, 1, 1).toordinal()
+DATE_END = datetime.date(2025, 12, 31).toordinal()
+
+
+def _skewed(rng, n, skew):
+    """ [0, n) 中的下标，skew 越大越偏向小下标 """
+    return min(n - 1, int(n * rng.random() ** skew))
+
+
+class SyntheticKB:
+    """
+    Args:
+        num_entities (int): 实体数
+        seed (int): 随机种子
+        num_concepts (int): 概念数，默认约为 sqrt(num_entities)
+        num_relations (int): 关系种类数
+        num_keys (int): 属性键的个数，类型按 TYPES 轮流分配
+        mean_attributes (float): 每个实体平均的属性数
+        mean_relations (float): 每个实体平均的正向关系数
+        degree_alpha (float): 出度 Pareto 分布的形状参数，越小越偏
+        target_skew (float): 关系目标实体的偏斜程度
+        max_degree (int): 单个实体的最大出度
+    """
+
+    def __init__(self, num_entities, seed=0, num_concepts=None, num_relations=50, num_keys=40,
+                 mean_attributes=4, mean_relations=3, degree_alpha=1.5, target_skew=2.0, max_degree=10000):
+        self.num_entities = num_entities
+        self.seed = seed
+        self.num_concepts = num_concepts or max(10, min(10000, int(num_entities ** 0.5)))
+        self.num_relations = num_relations
+        self.num_keys = num_keys
+        self.mean_attributes = mean_attributes
+        self.mean_relations = mean_relations
+        self.degree_alpha = degree_alpha
+        self.target_skew = target_skew
+        self.max_degree = max_degree
+
+    ######################### 确定性的各个部分 #########################
+
+    def _rng(self, i, stream):
+        return random.Random((self.seed * 1_000_003 + i) * 8 + stream)
+
+    def concept_id(self, k):
+        return f"Q{k}"
+
+    def entity_id(self, i):
+        return f"Q{self.num_concepts + i}"
+
+    def concept_name(self, k):
+        return f"concept {k}"
+
+    def entity_name(self, i):
+        return f"entity {i}"
+
+    def relation_name(self, r):
+        return f"relation {r}"
+
+    def key(self, j):
+        """ Returns: (属性键名, 类型, 单位) """
+        typ = TYPES[j % len(TYPES)]
+        unit = UNITS[j // len(TYPES) % len(UNITS)] if typ == "quantity" else None
+        return f"{typ} attribute {j}", typ, unit
+
+    def value(self, rng, typ, unit=None, cardinality=1000):
+        if typ == "string":
+            return {"type": "string", "value": f"value {rng.randrange(cardinality)}"}
+        if typ == "quantity":
+            v = rng.lognormvariate(3, 1.5)
+            return {"type": "quantity", "value": int(v) if rng.random() < 0.5 else round(v, 2), "unit": unit}
+        if typ == "year":
+            return {"type": "year", "value": rng.randint(1000, 2025)}
+        return {"type": "date", "value": datetime.date.fromordinal(rng.randint(DATE_START, DATE_END)).isoformat()}
+
+    def qualifiers(self, qseed):
+        """ qseed 为 0 表示没有 qualifier """
+        if not qseed:
+            return {}
+        rng = random.Random(qseed)
+        qkey, typ = QUALIFIER_KEYS[rng.randrange(len(QUALIFIER_KEYS))]
+        return {qkey: [self.value(rng, typ, "1", 100)]}
+
+    def concept(self, k):
+        rng = self._rng(k, 0)
+        # 前 5% 的概念是根，其余概念挂在更早的某个概念下面
+        roots = max(1, self.num_concepts // 20)
+        parents = [] if k < roots else [self.concept_id(_skewed(rng, k, 1.5))]
+        return {"name": self.concept_name(k), "subclassOf": parents}
+
+    def attributes(self, i):
+        rng = self._rng(i, 1)
+        attrs = []
+        for _ in range(rng.randint(0, int(2 * self.mean_attributes))):
+            j = _skewed(rng, self.num_keys, 1.5)
+            key, typ, unit = self.key(j)
+            # 不同键的字符串取值个数从 10 到 10^4 不等
+            value = self.value(rng, typ, unit, 10 ** (1 + j % 4))
+            qseed = rng.getrandbits(62) + 1 if rng.random() < 0.2 else 0
+            attrs.append({"key": key, "value": value, "qualifiers": self.qualifiers(qseed)})
+        return attrs
+
+    def forward_edges(self, i):
+        """ Returns: [(关系下标, 目标实体下标, qualifier 种子)] """
+        rng = self._rng(i, 2)
+        x = rng.paretovariate(self.degree_alpha) - 1
+        degree = int(x * (self.degree_alpha - 1) * self.mean_relations + 0.5)
+        degree = min(degree, self.max_degree, self.num_entities - 1)
+        edges = []
+        for _ in range(degree):
+            j = _skewed(rng, self.num_entities, self.target_skew)
+            if j == i:
+                continue
+            r = _skewed(rng, self.num_relations, 1.5)
+            qseed = rng.getrandbits(62) + 1 if rng.random() < 0.1 else 0
+            edges.append((r, j, qseed))
+        return edges
+
+    def instance_of(self, i):
+        rng = self._rng(i, 3)
+        return _skewed(rng, self.num_concepts, 1.5)
+
+    def entity(self, i, backward=()):
+        """ backward: [(源实体下标, 关系下标, qualifier 种子)] """
+        relations = [
+            {"relation": self.relation_name(r), "direction": "forward",
+             "object": self.entity_id(j), "qualifiers": self.qualifiers(qseed)}
+            for r, j, qseed in self.forward_edges(i)
+        ]
+        relations.extend(
+            {"relation": self.relation_name(r), "direction": "backward",
+             "object": self.entity_id(src), "qualifiers": self.qualifiers(qseed)}
+            for src, r, qseed in backward
+        )
+        return {
+            "name": self.entity_name(i),
+            "instanceOf": [self.concept_id(self.instance_of(i))],
+            "attributes": self.attributes(i),
+            "relations": relations,
+        }
+
+    ######################### 流式写出 #########################
+
+    def _spill(self, buf, tmp_dir, files):
+        buf.sort()
+        path = os.path.join(tmp_dir, f"edges_{len(files)}.bin")
+        with open(path, "wb") as f:
+            for edge in buf:
+                f.write(EDGE.pack(*edge))
+        files.append(path)
+        buf.clear()
+
+    @staticmethod
+    def _read_edges(path, block=4096):
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(EDGE.size * block)
+                if not data:
+                    return
+                yield from EDGE.iter_unpack(data)
+
+    def write(self, path, chunk_edges=1 << 22):
+        """
+        流式写出 kb.json
+
+        Args:
+            path (str): 输出路径
+            chunk_edges (int): 内存中最多缓存的反向关系条数，超过之后排序写到临时文件
+        """
+        from tqdm import tqdm
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp_dir:
+            # 第一遍只生成关系，把反向关系按目标实体外部排序
+            files, buf = [], []
+            for i in tqdm(range(self.num_entities), desc="edges"):
+                for r, j, qseed in self.forward_edges(i):
+                    buf.append((j, i, r, qseed))
+                if len(buf) >= chunk_edges:
+                    self._spill(buf, tmp_dir, files)
+            buf.sort()
+            incoming = heapq.merge(buf, *(self._read_edges(p) for p in files))
+            head = next(incoming, None)
+
+            with open(path, "w", encoding="utf-8") as out:
+                out.write('{"concepts": {')
+                for k in range(self.num_concepts):
+                    out.write(", " if k else "")
+                    out.write(f"{json.dumps(self.concept_id(k))}: {json.dumps(self.concept(k))}")
+                out.write('}, "entities": {')
+                for i in tqdm(range(self.num_entities), desc="entities"):
+                    backward = []
+                    while head is not None and head[0] == i:
+                        backward.append(head[1:])
+                        head = next(incoming, None)
+                    out.write(", " if i else "")
+                    out.write(f"{json.dumps(self.entity_id(i))}: {json.dumps(self.entity(i, backward))}")
+                out.write("}}")
+
+    ######################### 随机 program #########################
+
+    def _attribute_of(self, rng, i, types=TYPES):
+        candidates = [a for a in self.attributes(i) if a["value"]["type"] in types]
+        return rng.choice(candidates) if candidates else None
+
+    def _find_all_filter(self, rng, attr):
+        """ FindAll -> Filter*，过滤条件取自某个实体的真实属性 """
+        key, value = attr["key"], attr["value"]
+        steps = [{"function": "FindAll", "dependencies": [], "inputs": []}]
+        if value["type"] == "string":
+            steps.append({"function": "FilterStr", "dependencies": [0], "inputs": [key, value["value"]]})
+        else:
+            function = {"quantity": "FilterNum", "year": "FilterYear", "date": "FilterDate"}[value["type"]]
+            text = str(value["value"])
+            if value["type"] == "quantity" and value["unit"] != "1":
+                text = f"{text} {value['unit']}"
+            steps.append({"function": function, "dependencies": [0], "inputs": [key, text, rng.choice(["=", "<", ">", "!="])]})
+        return steps
+
+    def program(self, rng):
+        """ 随机生成一个在这个 KB 上可以执行的 program，失败（实体没有合适的属性或关系）时返回 None """
+        i = rng.randrange(self.num_entities)
+        name = self.entity_name(i)
+        concept = self.concept_name(self.instance_of(i))
+        template = rng.randrange(7)
+
+        if template == 0:
+            attr = self._attribute_of(rng, i)
+            if attr is None:
+                return None
+            return [
+                {"function": "Find", "dependencies": [], "inputs": [name]},
+                {"function": "QueryAttr", "dependencies": [0], "inputs": [attr["key"]]},
+            ]
+        if template == 1:
+            attr = self._attribute_of(rng, i)
+            if attr is None:
+                return None
+            steps = self._find_all_filter(rng, attr)
+            steps.append({"function": "FilterConcept", "dependencies": [1], "inputs": [concept]})
+            steps.append({"function": "Count", "dependencies": [2], "inputs": []})
+            return steps
+        if template in (2, 3):
+            edges = self.forward_edges(i)
+            if not edges:
+                return None
+            r, j, _ = rng.choice(edges)
+            # 正向从 i 出发，或者反向从目标实体 j 出发
+            start, direction = (name, "forward") if template == 2 else (self.entity_name(j), "backward")
+            return [
+                {"function": "Find", "dependencies": [], "inputs": [start]},
+                {"function": "Relate", "dependencies": [0], "inputs": [self.relation_name(r), direction]},
+                {"function": "FilterConcept", "dependencies": [1], "inputs": [
+                    self.concept_name(self.instance_of(j if template == 2 else i))]},
+                {"function": "What", "dependencies": [2], "inputs": []},
+            ]
+        if template == 4:
+            # SelectAmong / SelectBetween 只比较 quantity，实体 i 自己保证候选集合不为空
+            attr = self._attribute_of(rng, i, ("quantity",))
+            if attr is None:
+                return None
+            return [
+                {"function": "FindAll", "dependencies": [], "inputs": []},
+                {"function": "FilterConcept", "dependencies": [0], "inputs": [concept]},
+                {"function": "SelectAmong", "dependencies": [1], "inputs": [attr["key"], rng.choice(["largest", "smallest"])]},
+            ]
+        if template == 5:
+            attr = self._attribute_of(rng, i, ("quantity",))
+            if attr is None:
+                return None
+            j = rng.randrange(self.num_entities)
+            return [
+                {"function": "Find", "dependencies": [], "inputs": [name]},
+                {"function": "Find", "dependencies": [], "inputs": [self.entity_name(j)]},
+                {"function": "SelectBetween", "dependencies": [0, 1], "inputs": [attr["key"], rng.choice(["greater", "less"])]},
+            ]
+        a, b = self._attribute_of(rng, i), self._attribute_of(rng, rng.randrange(self.num_entities))
+        if a is None or b is None:
+            return None
+        left = self._find_all_filter(rng, a)
+        right = self._find_all_filter(rng, b)
+        for step in right:
+            step["dependencies"] = [d + len(left) for d in step["dependencies"]]
+        steps = left + right
+        steps.append({"function": rng.choice(["And", "Or"]), "dependencies": [len(left) - 1, len(steps) - 1], "inputs": []})
+        steps.append({"function": "Count", "dependencies": [len(steps) - 1], "inputs": []})
+        return steps
+
+    def programs(self, n, seed=None):
+        """ Returns: list，与数据集相同的格式 [{"sample_id", "program"}]，没有 answer """
+        rng = random.Random(self.seed if seed is None else seed)
+        samples = []
+        while len(samples) < n:
+            program = self.program(rng)
+            if program is not None:
+                samples.append({"sample_id": len(samples), "program": program})
+        return samples
+
+
+def generate(out_dir, num_entities, seed=0, num_programs=1000, **kwargs):
+    """
+    生成 kb_{num_entities}.json 和对应的 programs_{num_entities}.json
+
+    Returns:
+        tuple: (kb 路径, programs 路径)
+    """
+    kb = SyntheticKB(num_entities, seed, **kwargs)
+    kb_path = os.path.join(out_dir, f"kb_{num_entities}.json")
+    programs_path = os.path.join(out_dir, f"programs_{num_entities}.json")
+    kb.write(kb_path)
+    with open(programs_path, "w", encoding="utf-8") as f:
+        json.dump(kb.programs(num_programs), f)
+    return kb_path, programs_path
+
+
+def test():
+    from kopl.kopl import KoPLEngine
+    from convert_program_to_executable import ProgramExecutor
+    out_dir = tempfile.mkdtemp()
+    kb_path, programs_path = generate(out_dir, 2000, seed=1, num_programs=200)
+    with open(kb_path, encoding="utf-8") as f:
+        engine = KoPLEngine(json.load(f))
+    executor = ProgramExecutor(engine)
+    with open(programs_path, encoding="utf-8") as f:
+        for item in json.load(f)[:10]:
+            print(item["program"][-1]["function"], executor.run(item["program"]))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default="/home/qing/raid/paperwork/kgtool/data/synthetic")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--programs", type=int, default=1000)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    for size in args.sizes:
+        print(generate(args.out, size, args.seed, args.programs))
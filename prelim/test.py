@@ -1,17 +1,18 @@
-from qdls.data import load_json, save_json
+from qdls.data import save_json
+from split_store import load_split
 
-data = load_json("/home/qing/raid/paperwork/kgtool/data/kqa/full/train.json")
+data = load_split("/home/qing/raid/paperwork/kgtool/data/kqa/full/train.json")
 
-L = [ len(s['program']) for s in data ]
+# 只解码 program 这一列
+L = [ len(p) for p in data.column('program') ]
 m = max(L)
 print(m)
-for s in data:
-    l = len(s['program'])
+for i, l in enumerate(L):
     if l == m :
         # print(s )
-        save_json(s, "./longest.json")
+        save_json(data[i], "./longest.json")
         break 
 
 # from collections import Counter
 
-# c = Counter(L)
\ No newline at end of file
+# c = Counter(L)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# @File    :   test_engine_snapshot.py
+# @Time    :   2026/10/18 21:10:05
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+engine_snapshot 的往返测试：打开快照时只读 header，从快照执行的结果与原 engine 相同
+'''
+import os
+import copy
+import json
+import shutil
+import tempfile
+import unittest
+
+from kopl.kopl import KoPLEngine
+from basic_kopl import example_kb
+from engine_snapshot import save_snapshot, open_snapshot, read_header, is_stale
+from test_executor import EXAMPLE_PROGRAMS, outcome, _eval
+
+
+class TestEngineSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.kb_path = os.path.join(self.tmp, "kb.json")
+        self.path = os.path.join(self.tmp, "engine.snapshot")
+        with open(self.kb_path, "w", encoding="utf-8") as f:
+            json.dump(example_kb, f)
+        self.engine = KoPLEngine(copy.deepcopy(example_kb))
+        save_snapshot(self.engine, self.path, self.kb_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_open_reads_only_the_header(self):
+        snapshot = open_snapshot(self.path)
+        kb = snapshot.kb
+        self.assertNotIn("entity_ids", vars(kb))
+        self.assertIsNone(kb.entities._pos)
+        self.assertEqual(kb.entities._records, {})
+
+        ent_id = next(iter(self.engine.kb.entities))
+        self.assertIn(ent_id, kb.entities)
+        self.assertIsNotNone(kb.entities._pos)
+        self.assertEqual(kb.entities[ent_id], self.engine.kb.entities[ent_id])
+        self.assertEqual(len(kb.entities._records), 1)
+
+    def test_results_match_engine(self):
+        snapshot = open_snapshot(self.path)
+        for i, program in enumerate(EXAMPLE_PROGRAMS):
+            with self.subTest(program=i):
+                self.assertEqual(outcome(_eval, snapshot, program), outcome(_eval, self.engine, program))
+        self.assertEqual(sorted(snapshot.kb.entities), sorted(self.engine.kb.entities))
+
+    def test_stale_after_kb_changes(self):
+        self.assertFalse(is_stale(read_header(self.path), self.kb_path))
+        with open(self.kb_path, "a", encoding="utf-8") as f:
+            f.write("\n")
+        self.assertTrue(is_stale(read_header(self.path), self.kb_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
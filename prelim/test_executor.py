@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# @File    :   test_executor.py
+# @Time    :   2026/10/18 21:10:05
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+ProgramExecutor 各种模式与 eval(convert_to_python(program)) 的一致性测试
+
+只用 basic_kopl.py 中的 example_kb 和 synthetic_kb.py 生成的小 KB，不需要 KQA 的 kb.json：
+    python -m pytest -q basic_kopl.py test_*.py
+实体列表的顺序在位图、索引等模式下可能不同，所以比较时实体列表和名字列表都先排序。
+'''
+import os
+import ast
+import json
+import copy
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+from kopl.kopl import KoPLEngine
+from basic_kopl import engine as example_engine, example_kb
+from convert_program_to_executable import (
+    ProgramExecutor, ProgramCache, OperatorCache, convert_to_python, compile_plan, _entities_key,
+)
+from kb_index import KBIndex
+from entity_sets import EntityBitmaps
+from program_optimizer import ProgramOptimizer
+from kopl_string import parse_kopl
+from budget import Budget, BudgetExceeded
+from synthetic_kb import SyntheticKB
+
+EXAMPLE_PROGRAMS = [
+    [
+        {"function": "Find", "dependencies": [], "inputs": ["LeBron James Jr."]},
+        {"function": "Relate", "dependencies": [0], "inputs": ["father", "forward"]},
+        {"function": "What", "dependencies": [1], "inputs": []},
+    ],
+    [
+        {"function": "Find", "dependencies": [], "inputs": ["LeBron James"]},
+        {"function": "Find", "dependencies": [], "inputs": ["LeBron James Jr."]},
+        {"function": "Or", "dependencies": [0, 1], "inputs": []},
+        {"function": "SelectAmong", "dependencies": [2], "inputs": ["height", "largest"]},
+    ],
+    [
+        {"function": "Find", "dependencies": [], "inputs": ["LeBron James Jr."]},
+        {"function": "Find", "dependencies": [], "inputs": ["LeBron James"]},
+        {"function": "SelectBetween", "dependencies": [0, 1], "inputs": ["height", "greater"]},
+    ],
+    [
+        {"function": "FindAll", "dependencies": [], "inputs": []},
+        {"function": "FilterConcept", "dependencies": [0], "inputs": ["athlete"]},
+        {"function": "FilterNum", "dependencies": [1], "inputs": ["height", "200 centimetre", ">"]},
+        {"function": "What", "dependencies": [2], "inputs": []},
+    ],
+    [
+        {"function": "FindAll", "dependencies": [], "inputs": []},
+        {"function": "FilterConcept", "dependencies": [0], "inputs": ["basketball player"]},
+        {"function": "FindAll", "dependencies": [], "inputs": []},
+        {"function": "FilterConcept", "dependencies": [2], "inputs": ["athlete"]},
+        {"function": "And", "dependencies": [1, 3], "inputs": []},
+        {"function": "Count", "dependencies": [4], "inputs": []},
+    ],
+    [
+        {"function": "Find", "dependencies": [], "inputs": ["LeBron James"]},
+        {"function": "QueryAttr", "dependencies": [0], "inputs": ["height"]},
+    ],
+    [
+        {"function": "Find", "dependencies": [], "inputs": ["LeBron James"]},
+        {"function": "Find", "dependencies": [], "inputs": ["Cleveland Cavaliers"]},
+        {"function": "QueryRelation", "dependencies": [0, 1], "inputs": []},
+    ],
+]
+
+
+def canonical(result):
+    """ 与顺序无关的比较形式：实体二元组只看实体集合，列表排序，其他值取字符串 """
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], list):
+        return ("entities", sorted(result[0]))
+    if isinstance(result, list):
+        return ("list", sorted(map(str, result)))
+    return (type(result).__name__, str(result))
+
+
+def outcome(func, *args, **kwargs):
+    try:
+        return ("ok", canonical(func(*args, **kwargs)))
+    except Exception as e:
+        return ("error", type(e).__name__)
+
+
+def _eval(engine, program):
+    return eval(convert_to_python(program), {"engine": engine})
+
+
+class TestExecutorModes(unittest.TestCase):
+    """ 每种模式在 example_kb 和合成 KB 上都应与嵌套表达式的 eval 结果相同 """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        kb = SyntheticKB(1500, seed=3)
+        path = os.path.join(cls.tmp, "kb.json")
+        kb.write(path)
+        with open(path, encoding="utf-8") as f:
+            cls.synthetic = KoPLEngine(json.load(f))
+        cls.cases = [(example_engine, p) for p in EXAMPLE_PROGRAMS]
+        cls.cases += [(cls.synthetic, item["program"]) for item in kb.programs(150)]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def executors(self, engine):
+        """ 模式名 -> ProgramExecutor，索引和位图的门槛设为 0，小 KB 上也走它们的实现 """
+        return {
+            "plain": ProgramExecutor(engine, lazy_universe=False),
+            "program_cache": ProgramExecutor(engine, program_cache=ProgramCache()),
+            "op_cache": ProgramExecutor(engine, op_cache=OperatorCache()),
+            "index": ProgramExecutor(engine, index=KBIndex(engine, min_scan_size=0)),
+            "optimizer": ProgramExecutor(engine, optimizer=ProgramOptimizer(engine)),
+            "bitmaps": ProgramExecutor(engine, bitmaps=EntityBitmaps(engine, min_size=0)),
+            "universe": ProgramExecutor(engine),
+            "combined": ProgramExecutor(
+                engine, program_cache=ProgramCache(), op_cache=OperatorCache(),
+                index=KBIndex(engine, min_scan_size=0), optimizer=ProgramOptimizer(engine),
+                bitmaps=EntityBitmaps(engine, min_size=0),
+            ),
+        }
+
+    def by_engine(self):
+        groups = {}
+        for engine, program in self.cases:
+            groups.setdefault(id(engine), (engine, []))[1].append(program)
+        return groups.values()
+
+    def test_modes_match_eval(self):
+        for engine, programs in self.by_engine():
+            executors = self.executors(engine)
+            for program in programs:
+                expected = outcome(_eval, engine, program)
+                for mode, executor in executors.items():
+                    # 第二遍命中 ProgramCache / OperatorCache
+                    for _ in range(2):
+                        with self.subTest(mode=mode, program=program):
+                            self.assertEqual(outcome(executor.run, program), expected)
+
+    def test_ssa_matches_nested(self):
+        for engine, program in self.cases:
+            namespace = {"engine": engine}
+            try:
+                exec(convert_to_python(program, ssa=True), namespace)
+                ssa = ("ok", canonical(namespace["ans"]))
+            except Exception as e:
+                ssa = ("error", type(e).__name__)
+            self.assertEqual(ssa, outcome(_eval, engine, program), program)
+
+    def test_batch_matches_single_runs(self):
+        for engine, programs in self.by_engine():
+            valid = [p for p in programs if outcome(_eval, engine, p)[0] == "ok"]
+            for mode, executor in self.executors(engine).items():
+                # 重复的 program 让 run_batch 有可以共享的步骤
+                batch = valid + valid[:10]
+                results, report = executor.run_batch(batch)
+                self.assertEqual(report["programs"], len(batch))
+                self.assertLess(report["engine_calls"], report["sequential_calls"])
+                for program, result in zip(batch, results):
+                    with self.subTest(mode=mode, program=program):
+                        self.assertEqual(canonical(result), outcome(_eval, engine, program)[1])
+
+    def test_limit_is_subset_of_full_result(self):
+        for engine, programs in self.by_engine():
+            for mode, executor in self.executors(engine).items():
+                for program in programs:
+                    try:
+                        full = executor.run(program)
+                    except Exception:
+                        continue
+                    for limit in (1, 2):
+                        limited = executor.run(program, limit=limit)
+                        with self.subTest(mode=mode, program=program, limit=limit):
+                            if isinstance(full, list):
+                                self.assertEqual(len(limited), min(limit, len(full)))
+                                remaining = Counter(map(str, full))
+                                remaining.subtract(map(str, limited))
+                                self.assertTrue(all(v >= 0 for v in remaining.values()))
+                            else:
+                                self.assertEqual(canonical(limited), canonical(full))
+                    # limit 的结果不能污染缓存
+                    self.assertEqual(canonical(executor.run(program)), canonical(full))
+
+    def test_batch_limits(self):
+        for engine, programs in self.by_engine():
+            valid = [p for p in programs if outcome(_eval, engine, p)[0] == "ok"]
+            for mode, executor in self.executors(engine).items():
+                batch = valid + valid[:10]
+                limited, _ = executor.run_batch(batch, [1] * len(batch))
+                for program, result in zip(batch, limited):
+                    single = executor.run(program, limit=1)
+                    with self.subTest(mode=mode, program=program):
+                        if isinstance(result, list):
+                            self.assertEqual(len(result), len(single))
+                        else:
+                            self.assertEqual(canonical(result), canonical(single))
+
+    def test_batch_limits_must_match_programs(self):
+        executor = ProgramExecutor(example_engine)
+        for limits in ([1], [1] * (len(EXAMPLE_PROGRAMS) + 1), []):
+            with self.assertRaises(ValueError):
+                executor.run_batch(EXAMPLE_PROGRAMS, limits)
+
+    def test_budget_isolates_bad_program(self):
+        executor = ProgramExecutor(example_engine, budget=Budget(max_set_size=1))
+        wide = parse_kopl("Find(LeBron James).Find(LeBron James Jr.).Or().Count()")
+        result = executor.run(wide)
+        self.assertIsInstance(result, BudgetExceeded)
+        self.assertEqual((result.reason, result.step, result.function), ("size", 2, "Or"))
+        results, report = executor.run_batch([wide, EXAMPLE_PROGRAMS[0]])
+        self.assertIsInstance(results[0], BudgetExceeded)
+        self.assertEqual(results[1], ["LeBron James"])
+        self.assertEqual(report["budget_exceeded"], 1)
+
+
+class TestLazyUniverse(unittest.TestCase):
+
+    @staticmethod
+    def tied_kb(seed):
+        """ weight 的两个单位出现次数相同，大部分实体没有 weight；实体 id 随机，set 的遍历顺序随之变化 """
+        rng = random.Random(seed)
+        kb = {"concepts": {"C0": {"name": "thing", "subclassOf": []}}, "entities": {}}
+        for i in range(300):
+            attributes = []
+            if i < 6:
+                attributes.append({"key": "weight", "qualifiers": {}, "value": {
+                    "type": "quantity", "value": rng.randint(1, 5), "unit": "kilogram" if i % 2 else "pound"}})
+            kb["entities"][f"Q{rng.randrange(10 ** 9)}"] = {
+                "name": f"entity {i}", "instanceOf": ["C0"], "attributes": attributes, "relations": []}
+        return kb
+
+    def test_select_among_unit_tie_matches_engine(self):
+        program = [
+            {"function": "FindAll", "dependencies": [], "inputs": []},
+            {"function": "SelectAmong", "dependencies": [0], "inputs": ["weight", "largest"]},
+        ]
+        for seed in range(100):
+            engine = KoPLEngine(self.tied_kb(seed))
+            expected = sorted(_eval(engine, program))
+            executor = ProgramExecutor(engine)
+            with self.subTest(seed=seed):
+                self.assertEqual(sorted(executor.run(program)), expected)
+                self.assertTrue(set(executor.run(program, limit=1)) <= set(expected))
+
+
+class TestProgramCache(unittest.TestCase):
+
+    def test_disk_cache_survives_restart(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "programs.sqlite")
+            program = EXAMPLE_PROGRAMS[1]
+            ProgramCache(path=path).get_plan(program)
+            cache = ProgramCache(path=path)
+            self.assertEqual(cache.get_plan(program), compile_plan(program))
+            code = cache.get_code(program)
+            self.assertEqual(ProgramCache(path=path).get_code(program), code)
+            self.assertEqual(cache.stats()["misses"], 1)
+            self.assertEqual(cache.stats()["disk_hits"], 1)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+class TestOperatorCache(unittest.TestCase):
+
+    def test_entities_key_depends_on_content(self):
+        ids = ["Q1", "Q2"]
+        # 同样的实体列表（不管三元组是什么）得到同样的 key，内容不同的列表 key 不同
+        self.assertEqual(_entities_key((ids, None)), _entities_key((list(ids), [{}, {}])))
+        keys = {_entities_key((x, None)) for x in (["Q1", "Q2"], ["Q2", "Q1"], ["Q1", "Q3"], ["Q1Q2"], [])}
+        self.assertEqual(len(keys), 5)
+        self.assertIsNone(_entities_key(["a name"]))
+
+    def test_shared_cache_is_scoped_to_each_kb(self):
+        kb = copy.deepcopy(example_kb)
+        lebron = next(e for e in kb["entities"].values() if e["name"] == "LeBron James")
+        height = next(a for a in lebron["attributes"] if a["key"] == "height")
+        height["value"]["value"] = 100
+        other = KoPLEngine(kb)
+        program = EXAMPLE_PROGRAMS[5]
+        cache = OperatorCache()
+        first = ProgramExecutor(example_engine, op_cache=cache)
+        second = ProgramExecutor(other, op_cache=cache)
+        # 交替执行，共享的缓存不能把一个 KB 的结果交给另一个
+        for _ in range(2):
+            self.assertEqual(first.run(program), _eval(example_engine, program))
+            self.assertEqual(second.run(program), _eval(other, program))
+        self.assertNotEqual(_eval(example_engine, program), _eval(other, program))
+        self.assertEqual(cache.stats()["QueryAttr"], {"hits": 2, "misses": 2, "hit_rate": 0.5})
+
+
+class TestConvertToPython(unittest.TestCase):
+
+    def test_escape_string(self):
+        for name in ["a\\b", "line\nbreak", "it's", "tab\\n literal", "cr\r", "\\'", "end\\"]:
+            code = convert_to_python([{"function": "Find", "dependencies": [], "inputs": [name]}])
+            call = ast.parse(code, mode="eval").body
+            self.assertEqual(call.args[0].value, name)
+            self.assertEqual(eval(code, {"engine": example_engine}), example_engine.Find(name))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# @File    :   test_fix_kqa_kb.py
+# @Time    :   2026/10/18 21:10:05
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+fix_kqa_kb 的流式修正与整个读入内存修正的一致性测试
+'''
+import os
+import io
+import json
+import random
+import shutil
+import tempfile
+import unittest
+
+from fix_kqa_kb import normalize_kb, fix_concept, fix_entity, SchemaReport, _StreamReader
+
+
+class TestNormalizeKB(unittest.TestCase):
+
+    def test_streaming_matches_in_memory(self):
+        rng = random.Random(0)
+        kb = {"concepts": {}, "entities": {}}
+        for i in range(30):
+            kb["concepts"][f"C{i}"] = {"name": f"concept \"{i}\" \\ é", "instanceOf": [f"C{i // 2}"] if i else []}
+        for i in range(200):
+            kb["entities"][f"Q{i}"] = {
+                "name": f"entity {i}, {{x}}",
+                "instanceOf": [f"C{rng.randrange(30)}"],
+                "attributes": [{"key": "height", "value": {"type": "quantity", "value": rng.random() * 1e6, "unit": "1"}, "qualifiers": {}}],
+                "relations": [{"predicate": "next", "direction": "forward", "object": f"Q{(i + 1) % 200}", "qualifiers": {}}],
+            }
+        kb["entities"]["Q0"].pop("instanceOf")
+        del kb["entities"]["Q1"]["relations"][0]["predicate"]
+
+        tmp = tempfile.mkdtemp()
+        try:
+            src, dst = os.path.join(tmp, "kb.json"), os.path.join(tmp, "fixed.json")
+            with open(src, "w", encoding="utf-8") as f:
+                json.dump(kb, f, ensure_ascii=False)
+            # 很小的缓冲区，每个值都会跨越多次读取
+            report = normalize_kb(src, dst, chunk_size=7)
+            with open(dst, encoding="utf-8") as f:
+                streamed = json.load(f)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        expected_report = SchemaReport()
+        expected = {
+            "concepts": {k: fix_concept(k, v, expected_report) for k, v in kb["concepts"].items()},
+            "entities": {k: fix_entity(k, v, expected_report) for k, v in kb["entities"].items()},
+        }
+        self.assertEqual(streamed, expected)
+        self.assertEqual(report.counts, expected_report.counts)
+        self.assertEqual(report.counts["entity_missing_instanceOf"], 1)
+        self.assertEqual(report.counts["relation_missing_predicate"], 1)
+
+    def test_long_value_is_not_redecoded_per_chunk(self):
+        # 一个值跨越几千个块时，raw_decode 的次数只随值的大小对数增长
+        value = {"entities": [f"entity {i}" for i in range(5000)]}
+        reader = _StreamReader(io.StringIO(json.dumps(value) + " "), chunk_size=16)
+        calls = []
+        raw_decode = reader.decoder.raw_decode
+        reader.decoder.raw_decode = lambda s, idx=0: (calls.append(idx), raw_decode(s, idx))[1]
+        self.assertEqual(reader.value(), value)
+        self.assertLess(len(calls), 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# @File    :   test_kb_index.py
+# @Time    :   2026/10/18 21:10:05
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+KBIndex 各个索引与引擎原来实现的一致性测试，在 synthetic_kb.py 生成的小 KB 上运行
+
+索引的实体顺序可能与引擎不同，比较的是 (实体, 三元组) 对的集合；三元组是 KB 中的同一个对象。
+'''
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from kopl.kopl import KoPLEngine
+from kb_index import KBIndex
+from convert_program_to_executable import ProgramExecutor
+from synthetic_kb import SyntheticKB
+
+
+def pairs(result):
+    ids, facts = result
+    if facts is None:
+        return sorted(ids)
+    return sorted(zip(ids, map(id, facts)))
+
+
+class TestKBIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.synthetic = SyntheticKB(1500, seed=3)
+        path = os.path.join(cls.tmp, "kb.json")
+        cls.synthetic.write(path)
+        with open(path, encoding="utf-8") as f:
+            cls.engine = KoPLEngine(json.load(f))
+        # 过滤条件取自前 100 个实体的真实属性
+        cls.attributes = [a for i in range(100) for a in cls.synthetic.attributes(i)]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def setUp(self):
+        self.index = KBIndex(self.engine, min_scan_size=0)
+
+    def attributes_of(self, typ):
+        return [a for a in self.attributes if a["value"]["type"] == typ]
+
+    def test_filter_str_over_find_all(self):
+        engine = self.engine
+        for attr in self.attributes_of("string"):
+            key, value = attr["key"], attr["value"]["value"]
+            with self.subTest(key=key, value=value):
+                self.assertEqual(
+                    pairs(self.index.filter_str_all(key, value)),
+                    pairs(engine.FilterStr(engine.FindAll(), key, value)),
+                )
+        self.assertEqual(self.index.filter_str_all("no such key", "x"), ([], []))
+
+    def test_range_filters(self):
+        engine = self.engine
+        everything = engine.FindAll()
+        subset = (everything[0][::3], None)
+        cases = []
+        for attr in self.attributes_of("quantity"):
+            value = attr["value"]
+            text = str(value["value"]) if value["unit"] == "1" else f"{value['value']} {value['unit']}"
+            cases.append(("FilterNum", attr["key"], text))
+        for attr in self.attributes_of("year"):
+            cases.append(("FilterYear", attr["key"], str(attr["value"]["value"])))
+        for attr in self.attributes_of("date"):
+            # 日期属性既可以按日期比较，也可以按年份比较
+            cases.append(("FilterDate", attr["key"], attr["value"]["value"]))
+            cases.append(("FilterYear", attr["key"], attr["value"]["value"][:4]))
+        for function, key, text in cases:
+            for op in ("=", "!=", "<", ">"):
+                for entities, dep in ((everything, "FindAll"), (subset, "Find")):
+                    with self.subTest(function=function, key=key, value=text, op=op, input=dep):
+                        self.assertEqual(
+                            pairs(self.index.execute(function, [entities], (key, text, op), [dep])),
+                            pairs(getattr(engine, function)(entities, key, text, op)),
+                        )
+
+    def test_select_among(self):
+        engine = self.engine
+        everything = engine.FindAll()
+        subset = (everything[0][::3], None)
+        for key in sorted({a["key"] for a in self.attributes_of("quantity")}):
+            for op in ("largest", "smallest"):
+                for entities, dep in ((everything, "FindAll"), (subset, "Find")):
+                    res = self.index.execute("SelectAmong", [entities], (key, op), [dep])
+                    # 单位数量并列时交给引擎
+                    if res is None:
+                        continue
+                    with self.subTest(key=key, op=op, input=dep):
+                        self.assertEqual(sorted(res), sorted(engine.SelectAmong(entities, key, op)))
+
+    def test_filter_concept(self):
+        engine = self.engine
+        everything = engine.FindAll()
+        subset = (everything[0][::3], None)
+        # 包括根概念（成员来自子概念）和不存在的概念
+        names = [self.synthetic.concept_name(k) for k in range(self.synthetic.num_concepts)] + ["no such concept"]
+        for name in names:
+            for entities, dep in ((everything, "FindAll"), (subset, "Find")):
+                with self.subTest(concept=name, input=dep):
+                    self.assertEqual(
+                        pairs(self.index.execute("FilterConcept", [entities], (name,), [dep])),
+                        pairs(engine.FilterConcept(entities, name)),
+                    )
+
+    def test_relate(self):
+        engine = self.engine
+        everything = engine.FindAll()
+        # 单个实体、重复的实体、整个 KB
+        inputs = [([self.synthetic.entity_id(i)], None) for i in range(0, 1500, 37)]
+        inputs += [(everything[0][:50] * 2, None), everything]
+        relations = [self.synthetic.relation_name(r) for r in range(self.synthetic.num_relations)] + ["no such relation"]
+        for entities in inputs:
+            for relation in relations:
+                for direction in ("forward", "backward"):
+                    with self.subTest(entities=entities[0][:3], relation=relation, direction=direction):
+                        self.assertEqual(
+                            pairs(self.index.execute("Relate", [entities], (relation, direction), ["Find"])),
+                            pairs(engine.Relate(entities, relation, direction)),
+                        )
+
+    def test_relate_output_is_a_list(self):
+        # 惰性的三元组不离开 ProgramExecutor：结果类型与引擎相同，pickle 时也不会带上整个 kb.entities
+        engine = self.engine
+        i = next(i for i in range(1500) if self.synthetic.forward_edges(i))
+        relation = self.synthetic.relation_name(self.synthetic.forward_edges(i)[0][0])
+        program = [
+            {"function": "Find", "dependencies": [], "inputs": [self.synthetic.entity_name(i)]},
+            {"function": "Relate", "dependencies": [0], "inputs": [relation, "forward"]},
+        ]
+        expected = engine.Relate(engine.Find(self.synthetic.entity_name(i)), relation, "forward")
+        executor = ProgramExecutor(engine, index=self.index)
+        for result in [executor.run(program), executor.run_batch([program])[0][0]]:
+            self.assertIs(type(result[1]), list)
+            self.assertEqual(pairs(result), pairs(expected))
+            self.assertLess(len(pickle.dumps(result)), 2 * len(pickle.dumps(expected)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# @File    :   test_kopl_server.py
+# @Time    :   2026/10/18 21:10:05
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+KoPLServer 的端到端测试：在 basic_kopl.engine 上起服务，通过 Unix socket 发请求
+'''
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+from basic_kopl import engine
+from kopl_server import KoPLServer, KoPLClient
+from convert_program_to_executable import ProgramExecutor
+from test_executor import EXAMPLE_PROGRAMS
+
+
+async def raw_request(path, data):
+    """ 直接发送字节，返回 (status, 连接是否被服务端关闭) """
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(data)
+    await writer.drain()
+    response = await asyncio.wait_for(reader.read(), 5)
+    writer.close()
+    head = response.partition(b"\r\n\r\n")[0]
+    return int(head.split(b" ", 2)[1]), b"Connection: close" in head
+
+
+class TestKoPLServer(unittest.IsolatedAsyncioTestCase):
+    processes = 0
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "kopl.sock")
+        self.server = KoPLServer(engine, workers=2, processes=self.processes, max_pending=8)
+        await self.server.start(path=self.path)
+        self.client = KoPLClient(path=self.path, retries=0)
+        self.expected = [
+            self.server.to_json(ProgramExecutor(engine).run(p)) for p in EXAMPLE_PROGRAMS
+        ]
+
+    async def asyncTearDown(self):
+        await self.server.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    async def test_program(self):
+        for program, expected in zip(EXAMPLE_PROGRAMS, self.expected):
+            status, response = await self.client.run_program(program)
+            self.assertEqual(status, 200)
+            self.assertEqual(response["result"], expected)
+        status, response = await self.client.run_program("Find(LeBron James).QueryAttr(height)")
+        self.assertEqual((status, response["result"]), (200, ["206 centimetre"]))
+
+    async def test_batch(self):
+        status, response = await self.client.run_batch(EXAMPLE_PROGRAMS)
+        self.assertEqual(status, 200)
+        self.assertEqual([r["result"] for r in response["results"]], self.expected)
+        self.assertEqual(response["report"]["programs"], len(EXAMPLE_PROGRAMS))
+
+        limits = [1] + [None] * (len(EXAMPLE_PROGRAMS) - 1)
+        status, response = await self.client.run_batch(EXAMPLE_PROGRAMS, limits)
+        self.assertEqual(status, 200)
+        self.assertEqual([r["result"] for r in response["results"]][1:], self.expected[1:])
+
+    async def test_bad_limit(self):
+        program = EXAMPLE_PROGRAMS[0]
+        for limit in [0, -1, "3", 1.5, True]:
+            with self.subTest(limit=limit):
+                status, response = await self.client.run_program(program, limit=limit)
+                self.assertEqual(status, 400)
+                self.assertIn("limit", response["error"])
+
+    async def test_bad_batch_limits(self):
+        programs = EXAMPLE_PROGRAMS[:3]
+        for limits in [[1], [1, 2, 3, 4], {"0": 1}, [1, 0, None], [1, "2", None]]:
+            with self.subTest(limits=limits):
+                status, response = await self.client.run_batch(programs, limits)
+                self.assertEqual(status, 400)
+                self.assertIn("limits", response["error"])
+        status, _ = await self.client.request("POST", "/batch", {"programs": {"0": programs[0]}})
+        self.assertEqual(status, 400)
+
+    async def test_busy(self):
+        self.server.pending = self.server.max_pending
+        status, response = await self.client.health()
+        self.assertEqual(status, 503)
+        self.assertEqual(self.server.rejected, 1)
+        self.server.pending = 0
+        status, response = await self.client.health()
+        self.assertEqual((status, response["rejected"]), (200, 1))
+
+    async def test_unknown_route(self):
+        self.assertEqual((await self.client.request("GET", "/nothing"))[0], 404)
+        self.assertEqual((await self.client.request("POST", "/health", {}))[0], 404)
+        self.assertEqual((await self.client.call("Bogus"))[0], 404)
+
+    async def test_engine_input_errors(self):
+        # 参数个数不对、依赖下标越界、数值无法解析
+        status, response = await self.client.call("Relate")
+        self.assertEqual(status, 400)
+        self.assertIn("TypeError", response["error"])
+        program = [{"function": "Relate", "dependencies": [5], "inputs": ["father", "forward"]}]
+        self.assertEqual((await self.client.run_program(program))[0], 400)
+        program = [
+            {"function": "FindAll", "dependencies": [], "inputs": []},
+            {"function": "FilterNum", "dependencies": [0], "inputs": ["height", "abc", "<"]},
+        ]
+        self.assertEqual((await self.client.run_batch([program]))[0], 400)
+        # 出错之后服务仍然正常
+        self.assertEqual((await self.client.run_program(EXAMPLE_PROGRAMS[0]))[0], 200)
+
+    async def test_internal_error(self):
+        self.server.program_pool.shutdown()
+        status, response = await self.client.run_program(EXAMPLE_PROGRAMS[0])
+        self.assertEqual(status, 500)
+        self.assertIn("RuntimeError", response["error"])
+        self.assertEqual((await self.client.run_batch(EXAMPLE_PROGRAMS))[0], 500)
+
+    async def test_malformed_request(self):
+        body = b'{"program": "Find(LeBron James)"}'
+        for data in [
+            b"GARBAGE\r\n\r\n",
+            b"POST /program HTTP/1.1\r\nHost: kopl\r\n\r\n" + body,
+            b"POST /program HTTP/1.1\r\nContent-Length: abc\r\n\r\n" + body,
+            b"POST /program HTTP/1.1\r\nContent-Length: -1\r\n\r\n" + body,
+        ]:
+            with self.subTest(data=data):
+                self.assertEqual(await raw_request(self.path, data), (400, True))
+        data = b"POST /program HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body
+        self.assertEqual(await raw_request(self.path, data), (200, True))
+
+
+class TestKoPLServerProcesses(TestKoPLServer):
+    """ /program 和 /batch 在 fork 出来的进程池中执行 """
+    processes = 2
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# @File    :   test_kopl_string.py
+# @Time    :   2026/10/18 21:10:05
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+点号形式 kopl 字符串的解析测试：与 KQA 样本中标注的 program 逐条比较，以及 run_kopl 与 run 的一致性
+'''
+import os
+import json
+import unittest
+
+from basic_kopl import engine as example_engine
+from convert_program_to_executable import ProgramExecutor, ProgramCache, compile_kopl
+from kopl_string import parse_kopl
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "kqa")
+
+
+class TestKoplString(unittest.TestCase):
+
+    def test_gold_programs(self):
+        files = [
+            os.path.join(DATA_DIR, "sampled", f"sampled_{n}.json") for n in (50, 100, 200)
+        ] + [os.path.join(DATA_DIR, "test.json")]
+        files = [f for f in files if os.path.exists(f)]
+        if not files:
+            self.skipTest("KQA samples not found")
+        checked = 0
+        for path in files:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            for item in data:
+                if not item.get("kopl") or not item.get("program"):
+                    continue
+                gold = [
+                    {"function": s["function"], "dependencies": list(s.get("dependencies", [])), "inputs": list(s.get("inputs", []))}
+                    for s in item["program"]
+                ]
+                self.assertEqual(parse_kopl(item["kopl"]), gold, item["kopl"])
+                checked += 1
+        self.assertGreater(checked, 0)
+
+    def test_or_select_becomes_select_between(self):
+        steps = parse_kopl("Find(A).Find(B, Jr.).Or().Select(height,largest,1,0).What()")
+        self.assertEqual(steps, [
+            {"function": "Find", "dependencies": [], "inputs": ["A"]},
+            {"function": "Find", "dependencies": [], "inputs": ["B, Jr."]},
+            {"function": "SelectBetween", "dependencies": [0, 1], "inputs": ["height", "greater"]},
+        ])
+
+    def test_run_kopl_matches_run(self):
+        executor = ProgramExecutor(example_engine, program_cache=ProgramCache())
+        text = "Find(LeBron James).Find(LeBron James Jr.).Or().Select(height,largest,1,0).What()"
+        self.assertEqual(executor.run_kopl(text), executor.run(parse_kopl(text)))
+        self.assertEqual(compile_kopl(text)[-1].function, "SelectBetween")
+
+    def test_errors(self):
+        for text in ["Find(A).Bogus()", "And()", "Find(A).FilterStr(k)", "Find(A", "Find(A).Select(k,largest,2,0)"]:
+            with self.assertRaises(ValueError, msg=text):
+                parse_kopl(text)
+
+
+if __name__ == "__main__":
+    unittest.main()
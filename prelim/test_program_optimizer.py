@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# @File    :   test_program_optimizer.py
+# @Time    :   2026/10/18 21:10:05
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+ProgramOptimizer 的重排测试；优化之后的结果与 eval 一致由 test_executor.py 的 optimizer 模式覆盖
+'''
+import unittest
+
+from basic_kopl import engine as example_engine
+from convert_program_to_executable import ProgramExecutor
+from program_optimizer import ProgramOptimizer
+from test_executor import EXAMPLE_PROGRAMS, _eval
+
+
+class TestProgramOptimizer(unittest.TestCase):
+
+    AND_TREE = [
+        {"function": "Find", "dependencies": [], "inputs": ["LeBron James"]},
+        {"function": "FindAll", "dependencies": [], "inputs": []},
+        {"function": "FilterConcept", "dependencies": [1], "inputs": ["athlete"]},
+        {"function": "FindAll", "dependencies": [], "inputs": []},
+        {"function": "FilterConcept", "dependencies": [3], "inputs": ["basketball player"]},
+        {"function": "And", "dependencies": [2, 4], "inputs": []},
+        {"function": "And", "dependencies": [5, 0], "inputs": []},
+        {"function": "Count", "dependencies": [6], "inputs": []},
+    ]
+
+    def test_and_tree_smallest_first(self):
+        optimizer = ProgramOptimizer(example_engine)
+        optimized = optimizer.optimize(self.AND_TREE)
+        self.assertEqual(optimized[5]["dependencies"], [0, 4])
+        self.assertEqual(optimized[6]["dependencies"], [5, 2])
+        self.assertEqual(
+            ProgramExecutor(example_engine, optimizer=optimizer).run(self.AND_TREE),
+            _eval(example_engine, self.AND_TREE),
+        )
+
+    def test_and_tree_order_sensitive_consumer(self):
+        # What 的输出顺序来自 And 的 set 遍历，不重排
+        program = self.AND_TREE[:-1] + [{"function": "What", "dependencies": [6], "inputs": []}]
+        self.assertEqual(ProgramOptimizer(example_engine).optimize(program), program)
+
+    def test_two_input_and_unchanged(self):
+        program = EXAMPLE_PROGRAMS[4]
+        self.assertEqual(ProgramOptimizer(example_engine).find_and_trees(program), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# @File    :   top_k.py
+# @Time    :   2026/10/18 17:41:09
+# @Author  :   Qing
+# @Email   :   aqsz2526@outlook.com
+######################### docstring ########################
+'''
+ProgramExecutor 的 limit 模式：调用方只需要前 limit 个答案时，program 的最后一步提前结束
+
+agent 和 compare_result 只看第一个（或前几个）答案，而引擎的
+    SelectAmong   取出所有候选的属性值，全量排序，再把所有并列最值的实体转换成名字
+    SelectBetween 同样全量排序，只为了取一个端点
+    QueryName     把整个实体列表转换成名字
+这里改成对候选扫描一遍：每个单位只维护当前的最值和最多 limit 个并列的名字，
+不排序；名字投影只转换前 limit 个实体。
+返回的是不带 limit 时结果的一个子集（SelectBetween 完全相同），引擎本身的顺序来自 set 的遍历，
+所以 SelectAmong 在并列的最值多于 limit 个时具体返回哪几个没有保证。
+'''
+from itertools import islice
+
+# 最后一步是这些算子时，按 limit 提前结束；其他返回列表的算子只截断结果
+LIMITED_FUNCTIONS = {"SelectAmong", "SelectBetween", "QueryName", "What"}
+
+
+def query_names(kb, entity_ids, limit):
+    """ 等价于 QueryName(...)[:limit]，entity_ids 可以是任意可迭代对象 """
+    entities = kb.entities
+    return [entities[ent_id]["name"] for ent_id in islice(entity_ids, limit)]
+
+
+def _quantities(kb, entity_ids, key):
+    """ 按引擎的遍历顺序产生 (实体, quantity 属性值) """
+    inv = kb.attribute_inv_index.get(key, {})
+    entities = kb.entities
+    for ent_id in entity_ids:
+        for idx in inv.get(ent_id, ()):
+            v = entities[ent_id]["attributes"][idx]["value"]
+            if v.type == "quantity":
+                yield ent_id, v
+
+
+def select_among(kb, entity_ids, key, op, limit):
+    """
+    等价于 SelectAmong(...) 的前 limit 个名字，entity_ids 已经按引擎的方式去重（set）
+
+    Returns:
+        list: 名字列表；没有候选（引擎会报错）时返回 None，交给引擎处理
+    """
+    entities = kb.entities
+    counts = {}
+    best = {}    # unit -> [最值, 并列的名字（最多 limit 个）]
+    for ent_id, v in _quantities(kb, entity_ids, key):
+        counts[v.unit] = counts.get(v.unit, 0) + 1
+        cur = best.get(v.unit)
+        if cur is None or (v.value < cur[0] if op == "smallest" else v.value > cur[0]):
+            best[v.unit] = [v.value, [entities[ent_id]["name"]]]
+        elif v.value == cur[0] and len(cur[1]) < limit:
+            name = entities[ent_id]["name"]
+            if name not in cur[1]:
+                cur[1].append(name)
+    if not counts:
+        return None
+    # max 在并列时返回第一个，与 Counter.most_common 的顺序一致
+    unit = max(counts, key=counts.get)
+    return best[unit][1]
+
+
+def select_between(kb, l_entity_ids, r_entity_ids, key, op):
+    """
+    等价于 SelectBetween，不排序；并列时与稳定排序一致：less 取第一个，greater 取最后一个
+
+    Returns:
+        str: 实体的名字；没有候选时返回 None，交给引擎处理
+    """
+    counts = {}
+    best = {}    # unit -> (最值, 实体)
+    for ent_id, v in _quantities(kb, list(l_entity_ids) + list(r_entity_ids), key):
+        counts[v.unit] = counts.get(v.unit, 0) + 1
+        cur = best.get(v.unit)
+        if cur is None or (v.value < cur[0] if op == "less" else v.value >= cur[0]):
+            best[v.unit] = (v.value, ent_id)
+    if not counts:
+        return None
+    unit = max(counts, key=counts.get)
+    return kb.entities[best[unit][1]]["name"]
+
+
+def truncate(result, limit):
+    """ 返回列表的结果只保留前 limit 个，实体集合等其他结果原样返回 """
+    if limit is not None and isinstance(result, list):
+        return result[:limit]
+    return result